@@ -0,0 +1,13 @@
+# The command-line arguments every client script takes to pick the server and user.
+# This file only loads the standard library, so a script can read its arguments, and hand a transfer to daemon.py,
+# before loading requests and the rest.
+
+"""
+This function adds the arguments every client script takes to pick the server and user.
+@param parser: The argparse parser to add the arguments to.
+"""
+def add_connection_arguments(parser):
+    parser.add_argument("--username", help="The username of the user.")
+    parser.add_argument("--auth_token", help="The authentication token of the user.")
+    parser.add_argument("--server_url", help="The server URL.")
+    parser.add_argument("--debug", action="store_true", help="Enable debug mode.")
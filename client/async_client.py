@@ -0,0 +1,321 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import aiohttp
+from cluster import HashRing
+from upload import UploadFailedException, DEFAULT_CHUNK_SIZE, backoff_delay
+from download import DownloadFailedException
+
+# How many chunks the client has in flight at once, across all files.
+DEFAULT_MAX_CHUNKS = 16
+# How many files the client moves at once. Any more wait their turn.
+DEFAULT_MAX_FILES = 8
+
+# Raised when the server turns down a request that is not an upload or a download, e.g. listing the files.
+class RequestFailedException(Exception):
+    pass
+
+"""
+An asyncio client for the storage server, for moving files from inside an event loop.
+Chunk transfers for every file share the same bounded semaphores, so any number of uploads and
+downloads can be started at once without overloading the server.
+
+Usage:
+    async with AsyncClient("http://localhost:5000", "user", "token") as client:
+        await asyncio.gather(client.upload("a.bin"), client.upload("b.bin"))
+
+Every transfer can be cancelled like any other task. A cancelled or failed upload throws away its
+session on the server, and a cancelled or failed download removes its partial file.
+If the server is a node of a cluster, the requests for a file go straight to the node that has it.
+"""
+class AsyncClient:
+    """
+    @param server_url: The server URL.
+    @param username: The username of the user.
+    @param auth_token: The authentication token of the user.
+    @param max_chunks: How many chunks to have in flight at once, across all files.
+    @param max_files: How many files to move at once.
+    @param request_timeout: How long a single request may take, in seconds, or None for no limit.
+    """
+    def __init__(self, server_url, username, auth_token, max_chunks=DEFAULT_MAX_CHUNKS, max_files=DEFAULT_MAX_FILES, request_timeout=300):
+        self.server_url = server_url.rstrip("/")
+        self.username = username
+        self.auth_token = auth_token
+        self.max_chunks = max_chunks
+        self.max_files = max_files
+        self.request_timeout = request_timeout
+        self._session = None
+        self._chunk_slots = None
+        self._file_slots = None
+        self._ring = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    """
+    This function opens the HTTP session. It is called by "async with", or can be called directly.
+    """
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.max_chunks + self.max_files)
+        timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self._chunk_slots = asyncio.Semaphore(self.max_chunks)
+        self._file_slots = asyncio.Semaphore(self.max_files)
+        await self._load_cluster()
+
+    """
+    This function asks the server whether it is a node of a cluster, and if so builds the hash ring of the cluster.
+    """
+    async def _load_cluster(self):
+        try:
+            async with self._session.get("{}/cluster".format(self.server_url)) as response:
+                cluster = await response.json(content_type=None) if response.status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            cluster = None
+        self._ring = HashRing(cluster["nodes"], cluster["vnodes"]) if cluster else None
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _credentials(self):
+        return {"userid": self.username, "auth_token": self.auth_token}
+
+    """
+    This function returns the URL of the node a file belongs to, or the server URL if the server is not part of a cluster.
+    @param filename: The name of the file on the server.
+    """
+    def _node_url(self, filename):
+        return self._ring.node_for(self.username, filename) if self._ring else self.server_url
+
+    """
+    This function sends a POST request to a route of the server. Returns (status, response).
+    @param route: The route, e.g. "list".
+    @param filename: The file the request is about, so it goes to the node that has it.
+    @param node: The URL of the node to send it to, e.g. the node of an upload session.
+    @param files: The files to send as a form with the data, as {field: (name, bytes)}. The form is built for every attempt, as it can only be sent once.
+    """
+    async def _post(self, route, filename=None, node=None, files=None, **kwargs):
+        url = node or (self._node_url(filename) if filename is not None else self.server_url)
+        status, response = await self._send(url, route, files, kwargs)
+        if status == 421 and node is None:
+            # The nodes of the cluster changed, so build the ring again and send the request to the node that was named.
+            await self._load_cluster()
+            status, response = await self._send(response["node"], route, files, kwargs)
+        return status, response
+
+    async def _send(self, url, route, files, kwargs):
+        if files:
+            form = aiohttp.FormData(kwargs.get("data", {}))
+            for field, (name, data) in files.items():
+                form.add_field(field, data, filename=name)
+            kwargs = dict(kwargs, data=form)
+        async with self._session.post("{}/{}".format(url, route), **kwargs) as response:
+            return response.status, await response.json(content_type=None)
+
+    """
+    This function lists the files of the user.
+    Raises RequestFailedException if the server answers with an error.
+    @param recursive: Whether to list the files inside folders by their full name.
+    """
+    async def list(self, recursive=False):
+        status, response = await self._post("list", data=dict(self._credentials(), recursive=str(recursive).lower()))
+        if status == 404:
+            return []
+        if "error" in response:
+            raise RequestFailedException(f"Error listing the files: {response['error']}")
+        return response["files"]
+
+    """
+    This function deletes a file on the server. Returns the response of the server.
+    @param filename: The name of the file.
+    """
+    async def delete(self, filename):
+        _, response = await self._post("delete", filename=filename, data=dict(self._credentials(), filename=filename))
+        return response
+
+    """
+    This function renames a file on the server. Returns the response of the server.
+    @param old_filename: The current name of the file.
+    @param new_filename: The new name of the file.
+    """
+    async def rename(self, old_filename, new_filename):
+        _, response = await self._post("rename", filename=old_filename, data=dict(self._credentials(), old_filename=old_filename, new_filename=new_filename))
+        return response
+
+    """
+    This function retrieves the hash of a file from the server.
+    @param filename: The name of the file.
+    """
+    async def get_hash(self, filename):
+        status, response = await self._post("get_hash", filename=filename, data=dict(self._credentials(), filename=filename))
+        if "error" in response:
+            raise DownloadFailedException(f"Error getting the hash of {filename}: {response['error']}")
+        return response["hash"]
+
+    """
+    This function uploads a file, using a single request if it fits in one chunk and an upload session otherwise.
+    Raises UploadFailedException if the upload does not go through, or asyncio.TimeoutError if it takes longer than timeout.
+    @param filepath: The path of the file to upload.
+    @param filename: The name to save the file as on the server. Defaults to the name of the file.
+    @param overwrite: Whether to overwrite the file if it already exists.
+    @param chunk_size: The size of each chunk in bytes.
+    @param check_chunk_hashes: Whether the server should check the hash of each chunk.
+    @param retries: The number of attempts to make for each chunk, at least 1.
+    @param timeout: How long the whole upload may take, in seconds, or None for no limit.
+    """
+    async def upload(self, filepath, filename=None, overwrite=False, chunk_size=DEFAULT_CHUNK_SIZE, check_chunk_hashes=False, retries=3, timeout=None):
+        if retries < 1:
+            raise ValueError("retries must be at least 1")
+        filename = filename or os.path.basename(filepath)
+        async with self._file_slots:
+            await asyncio.wait_for(self._upload(filepath, filename, overwrite, chunk_size, check_chunk_hashes, retries), timeout)
+
+    async def _upload(self, filepath, filename, overwrite, chunk_size, check_chunk_hashes, retries):
+        size = os.path.getsize(filepath)
+        if size <= chunk_size:
+            data = await asyncio.to_thread(_read_range, filepath, 0, size)
+            fields = dict(self._credentials(), filename=filename, overwrite=str(overwrite).lower())
+            async with self._chunk_slots:
+                _, result = await self._post("put", filename=filename, data=fields, files={"file": (os.path.basename(filepath), data)})
+        else:
+            _, result = await self._post("begin", filename=filename, data=dict(self._credentials(), filename=filename, size=size, chunk_size=chunk_size, overwrite=str(overwrite).lower()))
+        if result.get("error"):
+            raise UploadFailedException(f"Error uploading {filename}: {result['error']}")
+        if result.get("complete"):
+            return
+
+        session_id = result["session"]
+        node = result.get("node")
+        chunk_size = result["chunk_size"]
+        present = set(result["present"])
+        tasks = [asyncio.ensure_future(self._upload_chunk(session_id, filepath, index, chunk_size, check_chunk_hashes, retries, node)) for index in range(result["num_chunks"]) if index not in present]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # Covers cancellation and timeouts too: stop the other chunks and throw the session away.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.shield(self._abort(session_id, node))
+            raise
+
+        if not any(chunk_result.get("complete") for chunk_result in results):
+            raise UploadFailedException(f"Error validating {filename}: the server did not confirm the upload.")
+
+    async def _upload_chunk(self, session_id, filepath, index, chunk_size, check_chunk_hash, retries, node=None):
+        for attempt in range(retries):
+            if attempt:
+                # Waits outside the chunk slot, so the other chunks keep going meanwhile.
+                await asyncio.sleep(backoff_delay(attempt))
+            async with self._chunk_slots:
+                try:
+                    chunk_data, chunk_hash = await asyncio.to_thread(_read_chunk, filepath, index * chunk_size, chunk_size, check_chunk_hash)
+                    headers = {"Content-Type": "application/octet-stream"}
+                    if chunk_hash:
+                        headers["X-Chunk-Hash"] = chunk_hash
+                    status, response = await self._post("chunk/{}/{}".format(session_id, index), node=node, data=chunk_data, headers=headers)
+                    if "error" not in response:
+                        return response
+                    error = response["error"]
+                    if status == 404:
+                        break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = str(e) or type(e).__name__
+        raise UploadFailedException(f"Failed to upload chunk {index} of {filepath} after {attempt + 1} attempts: {error}")
+
+    async def _abort(self, session_id, node=None):
+        try:
+            await self._post("abort", node=node, data={"session": session_id})
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+    """
+    This function downloads a file from the server.
+    The file is written to a temporary file next to the output and only moved into place once it is complete.
+    Raises DownloadFailedException if the download does not go through, or asyncio.TimeoutError if it takes longer than timeout.
+    @param filename: The name of the file to download.
+    @param output_path: Where to save the file. Defaults to the filename in the current folder.
+    @param use_hash: Whether to use the hash to verify the file integrity.
+    @param timeout: How long the whole download may take, in seconds, or None for no limit.
+    """
+    async def download(self, filename, output_path=None, use_hash=True, timeout=None):
+        output_path = output_path or os.path.basename(filename)
+        async with self._file_slots:
+            await asyncio.wait_for(self._download(filename, output_path, use_hash), timeout)
+
+    async def _download(self, filename, output_path, use_hash):
+        data = dict(self._credentials(), tempid=os.urandom(5).hex().upper(), filename=filename)
+        output_folder = os.path.dirname(os.path.abspath(output_path))
+        temp_file, temp_path = tempfile.mkstemp(dir=output_folder, prefix=f".{os.path.basename(output_path)}.", suffix=".part")
+        file_hash_obj = hashlib.sha256()
+        try:
+            with os.fdopen(temp_file, "wb") as output_file:
+                async with self._chunk_slots:
+                    url = self._node_url(filename)
+                    for attempt in range(2):
+                        async with self._session.post("{}/download".format(url), data=data, timeout=aiohttp.ClientTimeout(sock_read=self.request_timeout)) as response:
+                            if response.status == 421 and attempt == 0:
+                                # The nodes of the cluster changed, so build the ring again and ask the node that was named.
+                                url = (await response.json(content_type=None))["node"]
+                                await self._load_cluster()
+                                continue
+                            if response.status == 404:
+                                raise DownloadFailedException(f"File {filename} does not exist.")
+                            if response.status != 200:
+                                raise DownloadFailedException(f"HTTP error occurred: {response.status}")
+                            async for chunk in response.content.iter_chunked(1024 * 1024):
+                                await asyncio.to_thread(_write_chunk, output_file, chunk, file_hash_obj)
+                        break
+
+            if use_hash:
+                expected_file_hash = await self.get_hash(filename)
+                if file_hash_obj.hexdigest() != expected_file_hash:
+                    raise DownloadFailedException("File hash mismatch! Expected {}, got {}. Your file may be corrupted!".format(expected_file_hash, file_hash_obj.hexdigest()))
+            os.replace(temp_path, output_path)
+        except BaseException as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if isinstance(e, aiohttp.ClientError):
+                raise DownloadFailedException(f"An error occurred: {e}")
+            raise
+
+"""
+This function reads part of a file. It runs in a worker thread so the event loop is never blocked on disk.
+@param filepath: The path of the file.
+@param offset: Where to start reading.
+@param length: How many bytes to read.
+"""
+def _read_range(filepath, offset, length):
+    with open(filepath, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+"""
+This function reads a chunk of a file, and hashes it if asked to. Like _read_range, it runs in a worker thread.
+Returns (data, hash or None).
+@param filepath: The path of the file.
+@param offset: Where to start reading.
+@param length: How many bytes to read.
+@param with_hash: Whether to hash the chunk.
+"""
+def _read_chunk(filepath, offset, length, with_hash):
+    data = _read_range(filepath, offset, length)
+    return data, hashlib.sha256(data).hexdigest() if with_hash else None
+
+"""
+This function writes a chunk of a download and adds it to the hash of the file. Like _read_range, it runs in a worker thread.
+The chunks of one download are written one after another, so the hash sees them in order.
+@param output_file: The file to write to.
+@param data: The chunk.
+@param file_hash_obj: The hash of the file so far.
+"""
+def _write_chunk(output_file, data, file_hash_obj):
+    file_hash_obj.update(data)
+    output_file.write(data)
@@ -0,0 +1,202 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# The range the auto mode tunes within.
+AUTO_MIN_CHUNK_SIZE = 1024 * 1024  # 1 MB
+AUTO_MAX_CHUNK_SIZE = (1024 * 1024) * 64  # 64 MB
+AUTO_MAX_CONCURRENCY = 16
+# The most data the auto mode keeps in flight at once, since every request is held in memory.
+AUTO_MAX_IN_FLIGHT_BYTES = (1024 * 1024) * 256  # 256 MB
+
+# A request should take at least this many round trips, so the time spent waiting on the round trip stays small.
+RTT_MULTIPLE = 10
+# And at least this long, so a very fast network does not end up with tiny requests.
+MIN_REQUEST_SECONDS = 0.2
+# A round has to be this much faster than the best one so far to count as a gain.
+GAIN = 0.05
+# A round this much slower than the best one means the server or the network is overloaded.
+DROP = 0.3
+# After this many rounds without a change, one more request is tried in case conditions got better.
+PROBE_ROUNDS = 4
+
+"""
+Picks the chunk size and the number of requests in flight while a transfer runs, AIMD-style.
+
+The transfer starts with small chunks and few requests and reports every finished request to record().
+After every round (as many requests as are in flight), the tuner:
+- sizes chunks so a request takes about RTT_MULTIPLE round trips at the speed a single request gets,
+- doubles the requests in flight while that keeps raising the total throughput (slow start),
+  then adds one at a time (additive increase), and takes back a step that did not help,
+- halves the requests in flight on errors or a sharp drop in throughput (multiplicative decrease).
+
+A tuner with the same minimum and maximum for a setting keeps that setting fixed.
+"""
+class AutoTuner:
+    """
+    @param min_chunk_size: The smallest chunk size in bytes. Chunks start at this size.
+    @param max_chunk_size: The largest chunk size in bytes.
+    @param min_concurrency: The fewest requests to have in flight.
+    @param max_concurrency: The most requests to have in flight.
+    @param max_in_flight_bytes: The most bytes to have in flight at once.
+    """
+    def __init__(self, min_chunk_size=AUTO_MIN_CHUNK_SIZE, max_chunk_size=AUTO_MAX_CHUNK_SIZE, min_concurrency=1, max_concurrency=AUTO_MAX_CONCURRENCY, max_in_flight_bytes=AUTO_MAX_IN_FLIGHT_BYTES):
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max(min_chunk_size, max_chunk_size)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(min_concurrency, max_concurrency)
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.lock = threading.Lock()
+
+        self.chunk_size = self.min_chunk_size
+        self.concurrency = min(self.max_concurrency, max(self.min_concurrency, 2))
+        self.rtt = None
+        self.best = None
+        self.last_step = 0
+        self.slow_start = True
+        self.stable_rounds = 0
+        self.rebaseline = False
+        self.history = []
+        self._new_round()
+
+    """
+    This function returns a tuner that always uses the given chunk size and number of requests.
+    @param chunk_size: The chunk size in bytes.
+    @param concurrency: The number of requests to have in flight.
+    """
+    @classmethod
+    def fixed(cls, chunk_size, concurrency):
+        return cls(chunk_size, chunk_size, concurrency, concurrency, max_in_flight_bytes=None)
+
+    def _new_round(self):
+        self.round_start = None
+        self.round_bytes = 0
+        self.round_requests = 0
+        self.round_errors = 0
+        self.round_rates = []
+
+    """
+    This function records the time of a small request, as a first measure of the round trip time.
+    @param seconds: How long the request took.
+    """
+    def probe(self, seconds):
+        with self.lock:
+            self.rtt = seconds if self.rtt is None else min(self.rtt, seconds)
+
+    """
+    This function records a request that went through.
+    @param size: How many bytes it moved.
+    @param seconds: How long it took.
+    """
+    def record(self, size, seconds):
+        with self.lock:
+            now = time.perf_counter()
+            if self.round_start is None:
+                self.round_start = now - seconds
+            self.round_bytes += size
+            self.round_requests += 1
+            if seconds > 0:
+                self.round_rates.append(size / seconds)
+            self.rtt = seconds if self.rtt is None else min(self.rtt, seconds)
+            if self.round_requests >= self.concurrency:
+                self._adjust(now)
+
+    """
+    This function records a request that failed, which counts as a sign of overload.
+    """
+    def record_error(self):
+        with self.lock:
+            self.round_errors += 1
+
+    def _adjust(self, now):
+        elapsed = now - self.round_start
+        throughput = self.round_bytes / elapsed if elapsed > 0 else 0
+        concurrency = self.concurrency
+
+        if self.round_errors or (self.best and not self.rebaseline and throughput < self.best * (1 - DROP)):
+            concurrency = concurrency // 2
+            self.slow_start = False
+            self.last_step = 0
+            self.rebaseline = True
+        elif self.rebaseline:
+            # The first round after going down only measures where the new setting stands.
+            self.best = throughput
+            self.rebaseline = False
+        elif self.best is None or throughput > self.best * (1 + GAIN):
+            self.last_step = concurrency if self.slow_start else 1
+            concurrency += self.last_step
+            self.best = throughput
+            self.stable_rounds = 0
+        elif self.last_step:
+            # The last step did not help, so take it back and stay there.
+            concurrency -= self.last_step
+            self.slow_start = False
+            self.last_step = 0
+            self.rebaseline = True
+        else:
+            self.stable_rounds += 1
+            if self.stable_rounds >= PROBE_ROUNDS:
+                self.last_step = 1
+                concurrency += 1
+                self.stable_rounds = 0
+        self.concurrency = max(self.min_concurrency, min(self.max_concurrency, concurrency))
+
+        if self.round_rates and self.rtt is not None:
+            target_seconds = max(MIN_REQUEST_SECONDS, RTT_MULTIPLE * self.rtt)
+            wanted = statistics.median(self.round_rates) * target_seconds
+            # Move at most a factor of two per round, so one odd round can't throw the size far off.
+            chunk_size = int(max(self.chunk_size / 2, min(self.chunk_size * 2, wanted)))
+            if self.max_in_flight_bytes:
+                chunk_size = min(chunk_size, self.max_in_flight_bytes // self.concurrency)
+            self.chunk_size = max(self.min_chunk_size, min(self.max_chunk_size, chunk_size))
+
+        self.history.append({"throughput": throughput, "concurrency": self.concurrency, "chunk_size": self.chunk_size, "errors": self.round_errors})
+        self._new_round()
+
+    """
+    This function runs tasks on a thread pool, keeping as many in flight as the tuner allows and
+    recording every one of them. If a task raises an exception, no new tasks are started and the exception is raised.
+    @param next_task: A function called with the current chunk size that returns the next (task, size) pair, or None when there are no tasks left.
+    @param run_task: A function that runs a task in a worker thread.
+    @param on_done: A function called with the task and the result of run_task once a task finishes.
+    """
+    def run(self, next_task, run_task, on_done):
+        def timed(task, size):
+            start = time.perf_counter()
+            result = run_task(task)
+            self.record(size, time.perf_counter() - start)
+            return result
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            try:
+                while True:
+                    while len(running) < self.concurrency:
+                        item = next_task(self.chunk_size)
+                        if item is None:
+                            break
+                        running[executor.submit(timed, *item)] = item[0]
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        task = running.pop(future)
+                        on_done(task, future.result())
+            finally:
+                for future in running:
+                    future.cancel()
+
+"""
+This function builds a tuner from the --chunk_size and --threads options, where either one can be "auto".
+A setting that is not "auto" stays fixed.
+@param chunk_size: The --chunk_size value: a size in MB, or "auto".
+@param threads: The --threads value: a number, or "auto".
+"""
+def tuner_from_args(chunk_size, threads):
+    tuner_args = {}
+    if str(chunk_size) != "auto":
+        tuner_args["min_chunk_size"] = tuner_args["max_chunk_size"] = int(float(chunk_size) * 1024 * 1024)
+    if str(threads) != "auto":
+        tuner_args["min_concurrency"] = tuner_args["max_concurrency"] = int(threads)
+    return AutoTuner(**tuner_args)
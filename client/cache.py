@@ -0,0 +1,175 @@
+# A local cache of downloaded files, kept by the hash of their content and limited in size.
+# When a file is downloaded again, the client tells the server which copy it has, and gets the file only if it changed.
+# If it did, only the chunks that are different from the cached copy are downloaded.
+# The files used the longest time ago are removed first once the cache is full.
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# The size of the chunks the cache compares files in. The server lists the chunk hashes of a file in the same size.
+CACHE_CHUNK_SIZE = (1024 * 1024) * 4  # 4 MB
+
+# Where the cache is kept when no folder is given.
+DEFAULT_CACHE_FOLDER = os.path.join(os.path.expanduser("~"), ".mcs_cache")
+
+# How much data is read at a time when hashing or copying a file.
+READ_BUFFER_SIZE = 1024 * 1024  # 1 MB
+
+"""
+This function hashes a file and each of its chunks in one pass. Returns (file hash, chunk hashes).
+@param path: The path of the file.
+@param chunk_size: The size of the chunks.
+"""
+def hash_chunks(path, chunk_size=CACHE_CHUNK_SIZE):
+    file_hash_obj = hashlib.sha256()
+    chunks = []
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            file_hash_obj.update(data)
+            chunks.append(hashlib.sha256(data).hexdigest())
+    return file_hash_obj.hexdigest(), chunks
+
+"""
+This function copies a file and returns the hash of what was copied, so a copy out of the cache can be checked.
+@param source_path: The file to copy.
+@param destination_path: Where to copy it.
+"""
+def copy_and_hash(source_path, destination_path):
+    file_hash_obj = hashlib.sha256()
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        while True:
+            data = source.read(READ_BUFFER_SIZE)
+            if not data:
+                break
+            file_hash_obj.update(data)
+            destination.write(data)
+    return file_hash_obj.hexdigest()
+
+"""
+Cached copies of downloaded files, by the hash of their content, with the hash the last download of every file had.
+Safe to share between downloads running at the same time.
+"""
+class ContentCache:
+    """
+    @param folder: The folder to keep the cache in.
+    @param max_bytes: How many bytes of files to keep at most.
+    """
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(folder, "index.json")
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            self.entries = index["entries"]
+            self.names = index["names"]
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+            self.names = {}
+
+    """
+    This function returns the key a file is remembered by, so the same name on another server or for another user is another file.
+    @param connection: The connection to the server.
+    @param filename: The name of the file on the server.
+    """
+    @staticmethod
+    def key(connection, filename):
+        return f"{connection.server_url}|{connection.username}|{filename}"
+
+    def path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest)
+
+    """
+    This function returns the cached copy of the last download of a file, as (hash, path, chunk hashes), or None if there is none.
+    @param key: The key of the file, from key().
+    """
+    def lookup(self, key):
+        with self.lock:
+            digest = self.names.get(key)
+            entry = self.entries.get(digest)
+            if entry is None or not os.path.exists(self.path(digest)):
+                return None
+            entry["used"] = time.time()
+            return digest, self.path(digest), entry["chunks"]
+
+    """
+    This function adds a downloaded file to the cache, as the last download of its name.
+    Files bigger than the whole cache are not kept.
+    @param key: The key of the file, from key().
+    @param source_path: The downloaded file. It is copied, so it can be changed or moved afterwards.
+    @param digest: The hash of the file.
+    @param chunks: The hashes of the chunks of the file.
+    """
+    def add(self, key, source_path, digest, chunks):
+        size = os.path.getsize(source_path)
+        if size > self.max_bytes:
+            return
+        cache_path = self.path(digest)
+        if not os.path.exists(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, cache_path)
+        with self.lock:
+            self.entries[digest] = {"size": size, "used": time.time(), "chunks": chunks}
+            self.names[key] = digest
+            self._evict(keep=digest)
+            self._save()
+
+    """
+    This function removes a copy that turned out to be damaged.
+    @param digest: The hash the copy should have had.
+    """
+    def discard(self, digest):
+        with self.lock:
+            self.entries.pop(digest, None)
+            self._remove(digest)
+            self._save()
+
+    def _remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep):
+        total = sum(entry["size"] for entry in self.entries.values())
+        for digest in sorted(self.entries, key=lambda digest: self.entries[digest]["used"]):
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            total -= self.entries.pop(digest)["size"]
+            self._remove(digest)
+        self.names = {key: digest for key, digest in self.names.items() if digest in self.entries}
+
+    def _save(self):
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"entries": self.entries, "names": self.names}, f)
+        os.replace(temp_path, self.index_path)
+
+"""
+This function adds the arguments that turn on the cache to a client script.
+@param parser: The argparse parser to add the arguments to.
+"""
+def add_cache_arguments(parser):
+    parser.add_argument("--cache_size", type=int, default=int(os.getenv("C_DOWNLOADER_CACHE_SIZE", 0)), help="Keep up to this many MB of downloaded files in a local cache, so files that did not change are not downloaded again. 0 turns the cache off.")
+    parser.add_argument("--cache_folder", default=os.getenv("C_DOWNLOADER_CACHE_FOLDER", DEFAULT_CACHE_FOLDER), help="The folder to keep the cache in.")
+
+"""
+This function creates the cache from the parsed arguments. Returns None if the cache is off.
+@param args: The parsed arguments.
+"""
+def cache_from_args(args):
+    if args.cache_size <= 0:
+        return None
+    return ContentCache(args.cache_folder, args.cache_size * 1024 * 1024)
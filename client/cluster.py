@@ -0,0 +1,38 @@
+# The client side of cluster mode: the same consistent hash ring the server nodes use (server/cluster.py),
+# so the client can send the requests for a file straight to the node that has it.
+import bisect
+import hashlib
+
+def ring_hash(value):
+    return int(hashlib.sha256(value.encode()).hexdigest()[:16], 16)
+
+"""
+This function returns the key a file is placed by on the ring.
+@param userid: The ID of the user.
+@param filename: The name of the file.
+"""
+def ring_key(userid, filename):
+    return userid + "/" + filename.replace("\\", "/")
+
+"""
+A consistent hash ring of the nodes of a cluster, built from what the /cluster route of a node returns.
+"""
+class HashRing:
+    """
+    @param nodes: The URLs of the nodes.
+    @param vnodes: How many points every node gets on the ring.
+    """
+    def __init__(self, nodes, vnodes):
+        self.nodes = list(nodes)
+        self.vnodes = vnodes
+        self.points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in self.points]
+
+    """
+    This function returns the node a file belongs to.
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    """
+    def node_for(self, userid, filename):
+        index = bisect.bisect(self.hashes, ring_hash(ring_key(userid, filename))) % len(self.points)
+        return self.points[index][1]
@@ -0,0 +1,137 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from cluster import HashRing
+from arguments import add_connection_arguments
+
+load_dotenv()
+
+# How many connections to the server are kept open for reuse.
+DEFAULT_POOL_SIZE = 32
+
+"""
+A connection to the server for one user.
+Holds the server URL, the credentials and a pooled HTTP session, so it can be shared by
+any number of uploads and downloads running at the same time.
+If the server is a node of a cluster, the requests for a file go straight to the node that has it.
+"""
+class Connection:
+    """
+    @param server_url: The server URL.
+    @param username: The username of the user.
+    @param auth_token: The authentication token of the user.
+    @param pool_size: How many connections to the server to keep open.
+    @param debug: Whether to print debug information.
+    """
+    def __init__(self, server_url, username, auth_token, pool_size=DEFAULT_POOL_SIZE, debug=False):
+        self.server_url = server_url.rstrip("/")
+        self.username = username
+        self.auth_token = auth_token
+        self.debug = debug
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.ring = None
+        self.ring_loaded = False
+        self.ring_lock = threading.Lock()
+
+    """
+    This function returns the credentials to send in the form of a request.
+    """
+    def credentials(self):
+        return {"userid": self.username, "auth_token": self.auth_token}
+
+    """
+    This function asks the server whether it is a node of a cluster, and if so builds the hash ring of the cluster.
+    """
+    def load_cluster(self):
+        try:
+            response = self.session.get("{}/cluster".format(self.server_url), timeout=30)
+            cluster = response.json() if response.status_code == 200 else None
+        except (requests.RequestException, ValueError):
+            cluster = None
+        self.ring = HashRing(cluster["nodes"], cluster["vnodes"]) if cluster else None
+        self.ring_loaded = True
+
+    """
+    This function returns the URL of the node a file belongs to, or the server URL if the server is not part of a cluster.
+    @param filename: The name of the file on the server.
+    """
+    def node_url(self, filename):
+        with self.ring_lock:
+            if not self.ring_loaded:
+                self.load_cluster()
+            ring = self.ring
+        return ring.node_for(self.username, filename) if ring else self.server_url
+
+    """
+    This function sends a POST request to a route of the server.
+    @param route: The route, e.g. "list".
+    @param filename: The file the request is about, so it goes to the node that has it.
+    @param node: The URL of the node to send it to, e.g. the node of an upload session.
+    """
+    def post(self, route, filename=None, node=None, **kwargs):
+        url = node or (self.node_url(filename) if filename is not None else self.server_url)
+        # Where a file body starts, so it can be sent again if the request goes to the wrong node.
+        data = kwargs.get("data")
+        start = data.tell() if hasattr(data, "seek") else None
+        response = self.session.post("{}/{}".format(url, route), **kwargs)
+        if response.status_code == 421 and node is None:
+            # The nodes of the cluster changed, so build the ring again and send the request to the node that was named.
+            try:
+                url = response.json()["node"]
+            except (ValueError, KeyError):
+                return response
+            response.close()
+            with self.ring_lock:
+                self.load_cluster()
+            if start is not None:
+                data.seek(start)
+            elif data is not None and not isinstance(data, (bytes, bytearray, str, dict, list, tuple)):
+                raise requests.RequestException(f"Request to {route} went to the wrong node and its body can't be sent again")
+            for file in kwargs.get("files", {}).values():
+                file[1].seek(0)
+            response = self.session.post("{}/{}".format(url, route), **kwargs)
+        return response
+
+    """
+    This function prints a message if debug mode is enabled.
+    @param message: The message to print.
+    """
+    def log(self, message):
+        if self.debug:
+            print(message)
+
+    def close(self):
+        self.session.close()
+
+"""
+This function creates a connection from the parsed arguments, falling back to the environment variables.
+Returns None if the username or auth token is missing.
+@param args: The parsed arguments.
+@param pool_size: How many connections to the server to keep open.
+"""
+def connection_from_args(args, pool_size=DEFAULT_POOL_SIZE):
+    username = args.username or os.getenv('C_DOWNLOADER_USERNAME')
+    auth_token = args.auth_token or os.getenv('C_DOWNLOADER_AUTH_TOKEN')
+    server_url = args.server_url or os.getenv('C_DOWNLOADER_SERVER_URL') or "http://localhost:5000"
+    if not username or not auth_token:
+        return None
+    return Connection(server_url, username, auth_token, pool_size=pool_size, debug=args.debug)
+
+"""
+This function turns a tqdm progress bar into a progress function for the transfer functions.
+@param progress_bar: The progress bar to update.
+"""
+def progress_bar_callback(progress_bar):
+    def update(transferred, total):
+        if progress_bar.total != total:
+            progress_bar.total = total
+            progress_bar.refresh()
+        progress_bar.update(transferred)
+    return update
+
+MISSING_CREDENTIALS = "Username and auth token must be provided either as arguments or environment variables. Please set ENV variables C_DOWNLOADER_USERNAME and C_DOWNLOADER_AUTH_TOKEN."
@@ -0,0 +1,309 @@
+# A client that keeps running in the background, so uploads and downloads started from scripts don't each pay for
+# starting Python with all the libraries, reading .env and opening new connections to the server.
+# The daemon listens on a Unix socket and keeps a pooled connection and a TransferManager for every user it is asked to
+# transfer for. upload.py and download.py with --daemon, the up and down commands of this script, and manager.py with
+# --daemon hand the transfer to it and return straight away. The status command shows the queued and running transfers.
+# This file only loads the standard library until the daemon itself is started, so handing off a transfer stays quick.
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from arguments import add_connection_arguments
+from cache import add_cache_arguments, cache_from_args
+
+# Where the daemon listens.
+DEFAULT_SOCKET_PATH = os.getenv("C_DOWNLOADER_DAEMON_SOCKET", os.path.join(os.path.expanduser("~"), ".mcs_daemon.sock"))
+
+# How many finished transfers of every user the daemon remembers for the status command.
+KEEP_FINISHED_JOBS = 100
+
+# The arguments of upload_file and download_file a transfer handed to the daemon may set.
+UPLOAD_OPTIONS = ("chunk_size", "threads", "check_hashes", "check_chunk_hashes", "retries", "retry_budget")
+DOWNLOAD_OPTIONS = ("version", "retries")
+
+class DaemonNotRunningException(Exception):
+    pass
+
+"""
+This function sends a command to the daemon and returns its answer.
+Raises DaemonNotRunningException if no daemon is listening.
+@param socket_path: The socket the daemon listens on.
+@param command: The command, e.g. "status".
+@param fields: The rest of the command, e.g. the credentials.
+"""
+def send_command(socket_path, command, **fields):
+    if not hasattr(socket, "AF_UNIX"):
+        raise DaemonNotRunningException("The daemon needs Unix sockets, which this system does not have.")
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(dict(fields, command=command)).encode() + b"\n")
+            with sock.makefile("rb") as reader:
+                answer = reader.readline()
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        raise DaemonNotRunningException(f"No daemon is running at {socket_path} ({e}). Start one with: python daemon.py start")
+    if not answer:
+        raise DaemonNotRunningException(f"The daemon at {socket_path} closed the connection.")
+    return json.loads(answer)
+
+"""
+This function returns the credentials to send to the daemon: the ones given as arguments or environment variables.
+The daemon fills in the missing ones from its own environment, which includes the .env it read when it started.
+@param args: The parsed arguments, from add_connection_arguments.
+"""
+def daemon_credentials(args):
+    return {
+        "username": args.username or os.getenv("C_DOWNLOADER_USERNAME"),
+        "auth_token": args.auth_token or os.getenv("C_DOWNLOADER_AUTH_TOKEN"),
+        "server_url": args.server_url or os.getenv("C_DOWNLOADER_SERVER_URL"),
+        "debug": args.debug,
+    }
+
+"""
+This function returns a line describing a transfer, as listed by the status command.
+@param job: The transfer, as returned by Job.to_dict().
+"""
+def format_job(job):
+    percent = f"{100 * job['transferred'] / job['total']:5.1f}%" if job["total"] else "    -"
+    line = f"[{job['id']}] {job['kind']:<4} {job['status']:<7} {percent} {job['speed'] / (1024 * 1024):8.2f} MB/s   {job['filename']}"
+    if job["error"]:
+        line += f"   ({job['error']})"
+    return line
+
+"""
+This function adds the arguments that hand a transfer to the daemon to a client script.
+@param parser: The argparse parser to add the arguments to.
+"""
+def add_daemon_arguments(parser):
+    parser.add_argument("--daemon", action="store_true", help="Hand the transfer to the running daemon.py and return straight away.")
+    parser.add_argument("--daemon_socket", default=DEFAULT_SOCKET_PATH, help="The socket the daemon listens on.")
+
+"""
+This function hands a transfer to the daemon and prints what happened. Returns the job, or None if it failed.
+@param args: The parsed arguments, from add_connection_arguments and add_daemon_arguments.
+@param command: "upload" or "download".
+@param fields: The rest of the command, e.g. the path to upload.
+"""
+def submit_to_daemon(args, command, **fields):
+    try:
+        answer = send_command(args.daemon_socket, command, credentials=daemon_credentials(args), **fields)
+    except DaemonNotRunningException as e:
+        print(e)
+        return None
+    if "error" in answer:
+        print(answer["error"])
+        return None
+    job = answer["job"]
+    print(f"[{job['id']}] Queued the {command} of {job['filename']}. See the progress with: python daemon.py status")
+    return job
+
+"""
+Handles one connection to the daemon: reads one command and writes one answer, both as a line of JSON.
+"""
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            answer = self.server.daemon.run_command(json.loads(self.rfile.readline()))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            answer = {"error": f"Invalid command: {e}"}
+        self.wfile.write(json.dumps(answer).encode() + b"\n")
+
+"""
+The daemon: a TransferManager with a pooled connection for every user, kept for as long as the daemon runs.
+"""
+class Daemon:
+    """
+    @param socket_path: The socket to listen on.
+    @param max_transfers: How many transfers of every user to run at the same time.
+    @param cache: The ContentCache downloads keep copies in, or None.
+    """
+    def __init__(self, socket_path, max_transfers, cache=None):
+        self.socket_path = socket_path
+        self.max_transfers = max_transfers
+        self.cache = cache
+        self.managers = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    """
+    This function returns the TransferManager for the credentials of a command, creating it the first time.
+    Returns None if the username or auth token is missing.
+    @param credentials: The credentials, from daemon_credentials().
+    """
+    def manager_for(self, credentials):
+        from connection import connection_from_args
+        from manager import TransferManager, report_finished_job
+
+        args = SimpleNamespace(username=credentials.get("username"), auth_token=credentials.get("auth_token"),
+                               server_url=credentials.get("server_url"), debug=bool(credentials.get("debug")))
+        connection = connection_from_args(args)
+        if connection is None:
+            return None
+        key = (connection.server_url, connection.username, connection.auth_token)
+        with self.lock:
+            manager = self.managers.get(key)
+            if manager is None:
+                manager = TransferManager(connection, self.max_transfers, on_finish=report_finished_job, cache=self.cache)
+                self.managers[key] = manager
+                return manager
+        # The connection of the manager is already open, so the new one is not needed.
+        connection.close()
+        return manager
+
+    """
+    This function runs a command sent to the daemon and returns the answer.
+    @param request: The command, from send_command().
+    """
+    def run_command(self, request):
+        from connection import MISSING_CREDENTIALS
+
+        command = request["command"]
+        if command == "ping":
+            return {"success": "Running"}
+        if command == "stop":
+            # shutdown() waits for serve_forever() to return, so it can't run in the thread answering this command.
+            threading.Thread(target=self.server.shutdown).start()
+            return {"success": "The daemon stops once the running and queued transfers are done."}
+
+        manager = self.manager_for(request.get("credentials") or {})
+        if manager is None:
+            return {"error": MISSING_CREDENTIALS}
+        manager.forget_finished(KEEP_FINISHED_JOBS)
+        if command == "upload":
+            path = request["path"]
+            if not os.path.isabs(path) or not os.path.exists(path):
+                return {"error": f"File {path} does not exist on your system."}
+            options = {key: value for key, value in request.get("options", {}).items() if key in UPLOAD_OPTIONS}
+            return {"job": manager.upload(path, bool(request.get("overwrite")), **options).to_dict()}
+        if command == "download":
+            output_path = request["output_path"]
+            if not os.path.isabs(output_path):
+                return {"error": "The output path must be absolute."}
+            options = {key: value for key, value in request.get("options", {}).items() if key in DOWNLOAD_OPTIONS}
+            return {"job": manager.download(request["filename"], output_path, **options).to_dict()}
+        if command == "status":
+            return {"jobs": [job.to_dict() for job in manager.jobs]}
+        return {"error": f"Unknown command {command}"}
+
+    """
+    This function listens for commands until the daemon is stopped, then waits for the transfers to finish.
+    """
+    def serve(self):
+        try:
+            send_command(self.socket_path, "ping")
+            print(f"A daemon is already running at {self.socket_path}.")
+            return False
+        except DaemonNotRunningException:
+            pass
+        # Loading the libraries and reading .env now, so the first transfer doesn't wait for it.
+        import manager
+        import upload
+        import download
+        if os.path.exists(self.socket_path):
+            # Left behind by a daemon that did not stop cleanly.
+            os.remove(self.socket_path)
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        # Only the user running the daemon may use it, as it transfers with their credentials.
+        umask = os.umask(0o077)
+        try:
+            self.server = Server(self.socket_path, DaemonRequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+        print(f"Daemon listening on {self.socket_path}. Stop it with: python daemon.py stop")
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+            with self.lock:
+                managers = list(self.managers.values())
+            active = sum(len(manager.active_jobs()) for manager in managers)
+            if active:
+                print(f"Waiting for {active} transfers to finish...")
+            for manager in managers:
+                manager.shutdown()
+                manager.connection.close()
+        print("Daemon stopped.")
+        return True
+
+"""
+This function prints the transfers of the user in the daemon.
+@param args: The parsed arguments.
+"""
+def print_status(args):
+    answer = send_command(args.daemon_socket, "status", credentials=daemon_credentials(args))
+    if "error" in answer:
+        print(answer["error"])
+        return None
+    jobs = answer["jobs"]
+    if not jobs:
+        print("No transfers yet.")
+    for job in jobs:
+        print(format_job(job))
+    queued = sum(job["status"] == "queued" for job in jobs)
+    running = sum(job["status"] == "running" for job in jobs)
+    print(f"{queued} queued, {running} running.")
+    return jobs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run uploads and downloads in a client that keeps running in the background, or talk to it.")
+    parser.add_argument("command", choices=["start", "stop", "status", "wait", "up", "down"],
+                        help="start runs the daemon (add & to run it in the background), stop stops it once its transfers are done, "
+                             "status lists the transfers, wait waits until none are queued or running, up and down queue transfers.")
+    parser.add_argument("targets", nargs="*", help="The files or directories to upload, or the names of the files to download.")
+    parser.add_argument("--overwrite", action="store_true", help="Overwrite files that already exist on the server.")
+    parser.add_argument("--output", help="Where to save the file, when downloading one file. Defaults to the filename in the current folder.")
+    parser.add_argument("--transfers", type=int, default=4, help="How many transfers of every user the daemon runs at the same time.")
+    parser.add_argument("--daemon_socket", default=DEFAULT_SOCKET_PATH, help="The socket the daemon listens on.")
+    add_connection_arguments(parser)
+    add_cache_arguments(parser)
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == "start":
+            sys.exit(0 if Daemon(args.daemon_socket, args.transfers, cache_from_args(args)).serve() else 1)
+        elif args.command == "stop":
+            print(send_command(args.daemon_socket, "stop")["success"])
+        elif args.command == "status":
+            sys.exit(0 if print_status(args) is not None else 1)
+        elif args.command == "wait":
+            while True:
+                answer = send_command(args.daemon_socket, "status", credentials=daemon_credentials(args))
+                if "error" in answer or not any(job["status"] in ("queued", "running") for job in answer["jobs"]):
+                    break
+                time.sleep(0.5)
+            print_status(args)
+        elif args.command == "up":
+            failed = False
+            for target in args.targets:
+                if not os.path.exists(target):
+                    print(f"File {target} does not exist on your system.")
+                    failed = True
+                elif not submit_to_daemon(args, "upload", path=os.path.abspath(target), overwrite=args.overwrite):
+                    failed = True
+            sys.exit(1 if failed or not args.targets else 0)
+        elif args.command == "down":
+            if args.output and len(args.targets) != 1:
+                print("--output can only be used when downloading one file.")
+                sys.exit(1)
+            failed = False
+            for target in args.targets:
+                output_path = os.path.abspath(args.output or os.path.basename(target))
+                if not submit_to_daemon(args, "download", filename=target, output_path=output_path):
+                    failed = True
+            sys.exit(1 if failed or not args.targets else 0)
+    except DaemonNotRunningException as e:
+        print(e)
+        sys.exit(1)
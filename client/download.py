@@ -1,156 +1,440 @@
-import requests
 import os
 import hashlib
-import shutil
 import argparse
-from tqdm import tqdm
-import random
-import string
+import tempfile
+import time
 import sys
-from dotenv import load_dotenv
+from arguments import add_connection_arguments
+from cache import ContentCache, CACHE_CHUNK_SIZE, hash_chunks, copy_and_hash, add_cache_arguments, cache_from_args
+from daemon import add_daemon_arguments, submit_to_daemon
+
+"""
+This function returns the parser for the arguments of this script.
+"""
+def build_parser():
+    parser = argparse.ArgumentParser(description="Download a file from the server.")
+    parser.add_argument("filename", help="The name of the file to download.")
+    parser.add_argument("--output", help="Where to save the file. Defaults to the filename in the current folder.")
+    parser.add_argument("--chunk_size", help="Download the file as ranges of this size in MB at once, or \"auto\" to tune it as the download goes.")
+    parser.add_argument("--threads", help="How many ranges to download at once, or \"auto\" to tune it as the download goes.")
+    parser.add_argument("--retries", type=int, default=3, help="The number of retries for each range.")
+    parser.add_argument("--version", type=int, help="Download this old version of the file instead (see the versions command of manager.py).")
+    parser.add_argument("--profile", action="store_true", help="Time every phase of the download and print a summary.")
+    parser.add_argument("--trace", help="Also write the timings to this file as a trace for chrome://tracing or Perfetto. Implies --profile.")
+    add_connection_arguments(parser)
+    add_cache_arguments(parser)
+    add_daemon_arguments(parser)
+    return parser
 
-load_dotenv()
+"""
+This function hands the download to the daemon. Returns the exit code of the script.
+@param args: The parsed arguments, from build_parser().
+"""
+def hand_off(args):
+    if args.profile or args.trace:
+        print("--profile and --trace can't be used with --daemon.")
+        return 1
+    # The daemon downloads with its own cache.
+    output_path = os.path.abspath(args.output or os.path.basename(args.filename))
+    job = submit_to_daemon(args, "download", filename=args.filename, output_path=output_path, options=dict(version=args.version, retries=args.retries))
+    return 0 if job else 1
 
-DEBUG = False
+# With --daemon the download is handed off before the libraries below are loaded and .env is read, so it returns straight away.
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    if args.daemon:
+        sys.exit(hand_off(args))
+
+import requests
+from tqdm import tqdm
+from connection import connection_from_args, progress_bar_callback, MISSING_CREDENTIALS
+from profiling import Profiler, NULL_PROFILER
+from autotune import tuner_from_args
+from upload import hash_file
+
+class DownloadFailedException(Exception):
+    pass
 
 """
-This function generates a random string of a given length.
-@param length: The length of the string to generate.
+This function returns the form data of a request about a file, or about an old version of it.
+@param connection: The connection to the server.
+@param filename: The name of the file.
+@param version: The ID of the old version, or None for the file itself.
+@param fields: Any other form fields to send.
 """
-def generate_random_string(length):
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+def file_request(connection, filename, version=None, **fields):
+    data = dict(connection.credentials(), filename=filename, **fields)
+    if version is not None:
+        data["version"] = version
+    return data
 
 """
-This function downloads a file from the server.
-@param username: The username of the user.
-@param auth_token: The authentication token of the user.
+This function retrieves the hash of a file from the server.
+@param connection: The connection to the server.
+@param filename: The name of the file to retrieve the hash for.
+@param version: The ID of an old version of the file, or None for the file itself.
+"""
+def retrieve_file_hash(connection, filename, version=None):
+    data = file_request(connection, filename, version)
+    response = connection.post("get_hash", filename=filename, data=data)
+    return response.json()["hash"]
+
+"""
+This function downloads a file from the server as one stream, writing it to an open file as it arrives.
+Returns the hash of what was received.
+@param connection: The connection to the server.
 @param filename: The name of the file to download.
-@param unique_id: The unique ID of the download.
+@param output_file: The open file to write to.
+@param progress: A function called with (bytes received, total bytes) as the download goes, or None.
+@param profiler: The profiler to record the timings in. Every megabyte received counts as one chunk.
+@param version: The ID of an old version of the file, or None for the file itself.
 """
-def download_file(username, auth_token, filename, unique_id):
-    data = {"userid": username, "auth_token": auth_token, "tempid": unique_id, "filename": filename}
+def download_stream(connection, filename, output_file, progress=None, profiler=NULL_PROFILER, version=None):
+    data = file_request(connection, filename, version, tempid=os.urandom(5).hex().upper())
     try:
-        response = requests.post("{}/download".format(SERVER_URL), data=data, stream=True)
+        with profiler.span("request"):
+            response = connection.post("download", filename=filename, data=data, stream=True)
         response.raise_for_status()  # Raise an error for bad status codes
     except requests.exceptions.HTTPError as http_err:
         if response.status_code == 404:
-            print("File does not exist.")
-        else:
-            print(f"HTTP error occurred: {http_err}")
-        remove_temp_folder(unique_id)
-        sys.exit(1)
-    except Exception as err:
-        print(f"An error occurred: {err}")
-        remove_temp_folder(unique_id)
-        sys.exit(1)
-    return response
+            raise DownloadFailedException(f"File {filename} does not exist.")
+        raise DownloadFailedException(f"HTTP error occurred: {http_err}")
+
+    total_size = int(response.headers.get('content-length', 0))
+    file_hash_obj = hashlib.sha256()
+    try:
+        pieces = response.iter_content(chunk_size=1024 * 1024)
+        index = 0
+        while True:
+            with profiler.span("receive", index) as span:
+                chunk = next(pieces, None)
+                span["size"] = len(chunk or b"")
+            if chunk is None:
+                break
+            if chunk:
+                with profiler.span("write", index, len(chunk)):
+                    output_file.write(chunk)
+                with profiler.span("hash", index, len(chunk)):
+                    file_hash_obj.update(chunk)
+                if progress:
+                    progress(len(chunk), total_size)
+                index += 1
+    finally:
+        response.close()
+    return file_hash_obj.hexdigest()
 
 """
-This function retrieves the hash of a file from the server.
-@param userid: The username of the user.
-@param auth_token: The authentication token of the user.
-@param filename: The name of the file to retrieve the hash for.
+This function downloads one range of a file into its place in the output file.
+Returns the size of the whole file, which the server sends along with every range.
+@param connection: The connection to the server.
+@param filename: The name of the file to download.
+@param output_path: The path of the file to write to. It must already exist.
+@param offset: Where the range starts.
+@param length: How many bytes to download.
+@param retries: The number of attempts to make.
+@param profiler: The profiler to record the timings in.
+@param tuner: The tuner to report failed attempts to.
+@param version: The ID of an old version of the file, or None for the file itself.
 """
-def retrieve_file_hash(userid, auth_token, filename):
-    data = {"userid": userid, "auth_token": auth_token, "filename": filename}
-    response = requests.post("{}/get_hash".format(SERVER_URL), data=data)
-    return response.json()["hash"]
+def download_range(connection, filename, output_path, offset, length, retries, profiler=NULL_PROFILER, tuner=None, version=None):
+    # Ranges can have any size, so the profiler labels them by their offset in MB.
+    index = offset // (1024 * 1024)
+    data = file_request(connection, filename, version, offset=offset, length=length)
+    for attempt in range(retries):
+        if attempt:
+            profiler.retry(index)
+        try:
+            with profiler.span("receive", index) as span, connection.post("download", filename=filename, data=data, stream=True) as response:
+                if response.status_code == 404:
+                    raise DownloadFailedException(f"File {filename} does not exist.")
+                response.raise_for_status()  # Raise an error for bad status codes
+                file_size = int(response.headers["X-File-Size"])
+                expected_size = max(0, min(length, file_size - offset))
+                received = 0
+                with open(output_path, "r+b") as output_file:
+                    output_file.seek(offset)
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        output_file.write(chunk)
+                        received += len(chunk)
+                        if received > expected_size:
+                            break
+                span["size"] = received
+            if received != expected_size:
+                raise requests.RequestException(f"Expected {expected_size} bytes, got {received}.")
+            return file_size
+        except DownloadFailedException:
+            raise
+        except Exception as e:
+            if tuner:
+                tuner.record_error()
+            connection.log(f"Download of bytes {offset}-{offset + length} failed (attempt {attempt + 1}/{retries}). Error: {e}")
+            error = e
+    raise DownloadFailedException(f"Failed to download bytes {offset}-{offset + length} of {filename} after {retries} attempts: {error}")
 
 """
-This function reassembles a file from its chunks.
-@param filename: The name of the file to reassemble.
-@param chunk_folder: The folder containing the file chunks.
-@param use_hash: Whether to use the hash to verify the file integrity.
-@param username: The username of the user.
-@param auth_token: The authentication token of the user.
+This function downloads a file as many ranges at once, with the tuner picking the range size and how many are in flight.
+The first range also tells how big the file is. Every range is written straight to its place in the output file.
+@param connection: The connection to the server.
+@param filename: The name of the file to download.
+@param output_path: The path of the file to write to. It must already exist.
+@param tuner: The AutoTuner to use.
+@param retries: The number of attempts to make for each range.
+@param progress: A function called with (bytes received, total bytes) as the download goes, or None.
+@param profiler: The profiler to record the timings in.
+@param version: The ID of an old version of the file, or None for the file itself.
 """
-def reassemble_file(filename, chunk_folder, use_hash=False, username=None, auth_token=None):
-    file_hash_obj = hashlib.sha256()
-    chunks = os.listdir(chunk_folder)
-    chunks.sort(key=lambda x: int(x.split('.')[-1]))
-
-    with open(filename, "wb") as output_file:
-        for chunk in chunks:
-            chunk_path = os.path.join(chunk_folder, chunk)
-            with open(chunk_path, "rb") as chunk_file:
-                chunk_data = chunk_file.read()
-                output_file.write(chunk_data)
-
-    if use_hash:
-        with open(f"{filename}", "rb") as f:
-            data = f.read()
-            file_hash_obj.update(data)
-            actual_file_hash = file_hash_obj.hexdigest()
-
-        expected_file_hash = retrieve_file_hash(username, auth_token, filename)
-
-        if actual_file_hash != expected_file_hash:
-            raise ValueError("File hash mismatch! Expected {}, got {}. Your file may be corrupted!".format(expected_file_hash, actual_file_hash))
-        
-    if DEBUG:
-        print(f"File {filename} has been reassembled.")
-        if use_hash and DEBUG:
-            print(f"Hash of file: {actual_file_hash}")
-
-"""This function will remove the temp folder in the case of an error.
-@param unique_id: The unique ID of the download.
-"""
-def remove_temp_folder(unique_id):
-    try:
-        shutil.rmtree(unique_id)
-        if DEBUG:
-            print(f"Removed temp folder {unique_id}.")
-    except Exception as e:
-        pass
+def download_ranges(connection, filename, output_path, tuner, retries=3, progress=None, profiler=NULL_PROFILER, version=None):
+    length = tuner.chunk_size
+    start = time.perf_counter()
+    file_size = download_range(connection, filename, output_path, 0, length, retries, profiler, tuner, version)
+    tuner.probe(time.perf_counter() - start)
+    tuner.record(min(length, file_size), time.perf_counter() - start)
+    if progress:
+        progress(min(length, file_size), file_size)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Download and reassemble a file from the server.")
-    parser.add_argument("filename", help="The name of the file to download.")
-    parser.add_argument("--username", help="The username of the user.")
-    parser.add_argument("--auth_token", help="The authentication token of the user.")
-    parser.add_argument("--server_url", help="The server URL.")
-    parser.add_argument("--debug", action="store_true", help="Enable debug mode.")
+    next_offset = [min(length, file_size)]
+    def next_range(max_size):
+        offset = next_offset[0]
+        if offset >= file_size:
+            return None
+        size = min(max_size, file_size - offset)
+        next_offset[0] += size
+        return (offset, size), size
 
-    args = parser.parse_args()
+    def fetch(task):
+        offset, size = task
+        download_range(connection, filename, output_path, offset, size, retries, profiler, tuner, version)
 
-    USERNAME = args.username or os.getenv('C_DOWNLOADER_USERNAME')
-    AUTH_TOKEN = args.auth_token or os.getenv('C_DOWNLOADER_AUTH_TOKEN')
-    FILENAME = args.filename 
+    def fetched(task, result):
+        if progress:
+            progress(task[1], file_size)
 
-    FILENAME = os.path.basename(FILENAME)
+    tuner.run(next_range, fetch, fetched)
 
-    SERVER_URL = args.server_url or os.getenv('C_DOWNLOADER_SERVER_URL') or "http://localhost:5000"
-    DEBUG = args.debug
+"""
+This function finds a copy of a file the client already has: the output file if it exists, otherwise the cached copy of its last download.
+Returns (hash, path, chunk hashes), or None if there is no copy.
+@param connection: The connection to the server.
+@param filename: The name of the file on the server.
+@param output_path: Where the file is being downloaded to.
+@param cache: The ContentCache, or None.
+"""
+def local_copy(connection, filename, output_path, cache):
+    if os.path.isfile(output_path):
+        file_hash, chunks = hash_chunks(output_path)
+        return file_hash, output_path, chunks
+    if cache:
+        return cache.lookup(ContentCache.key(connection, filename))
+    return None
 
-    if not USERNAME or not AUTH_TOKEN:
-        print("Username and auth token must be provided either as arguments or environment variables. Please set ENV variables C_DOWNLOADER_USERNAME and C_DOWNLOADER_AUTH_TOKEN.")
-        sys.exit(1)
+"""
+This function asks the server whether a copy of a file is still the same as the file, by sending its hash in the If-None-Match header.
+Returns (whether the copy is the same, the manifest of the file). The manifest lists the hashes of the chunks of the file,
+and is None if the copy is the same or the server can't list them.
+@param connection: The connection to the server.
+@param filename: The name of the file on the server.
+@param file_hash: The hash of the copy.
+"""
+def check_copy(connection, filename, file_hash):
+    data = dict(connection.credentials(), filename=filename, chunk_size=CACHE_CHUNK_SIZE)
+    response = connection.post("manifest", filename=filename, data=data, headers={"If-None-Match": f'"{file_hash}"'})
+    if response.status_code == 304:
+        return True, None
+    if response.status_code != 200:
+        return False, None
+    manifest = response.json()
+    return False, manifest if manifest.get("chunk_size") == CACHE_CHUNK_SIZE else None
 
-    UNIQUE_ID = unique_id = generate_random_string(10)
-    while os.path.exists(UNIQUE_ID):
-        UNIQUE_ID = generate_random_string(10)
-    
-    if not os.path.exists(UNIQUE_ID):
-        os.mkdir(UNIQUE_ID)
+"""
+This function puts a file together from a copy of an older version of it and the chunks that changed, which are downloaded.
+Returns whether the result has the hash of the file. If not (e.g. the file changed again meanwhile), it has to be downloaded whole.
+@param connection: The connection to the server.
+@param filename: The name of the file on the server.
+@param copy: The copy, as (hash, path, chunk hashes).
+@param manifest: The manifest of the file, from check_copy.
+@param output_path: The path of the file to write to. It must already exist.
+@param tuner: An AutoTuner to download the changed chunks many at once, or None to download them one after the other.
+@param retries: The number of attempts to make for each range.
+@param progress: A function called with (bytes done, total bytes) as the chunks are copied and downloaded, or None.
+@param profiler: The profiler to record the timings in.
+"""
+def download_changes(connection, filename, copy, manifest, output_path, tuner=None, retries=3, progress=None, profiler=NULL_PROFILER):
+    _, copy_path, copy_chunks = copy
+    chunk_size = manifest["chunk_size"]
+    file_size = manifest["size"]
 
-    print(f"Looking for file {FILENAME}")
+    # The chunks that are the same in the copy are copied from it, and runs of changed chunks become ranges to download.
+    ranges = []
+    with profiler.span("copy"), open(copy_path, "rb") as source, open(output_path, "r+b") as output_file:
+        output_file.truncate(file_size)
+        for index, chunk_hash in enumerate(manifest["chunks"]):
+            offset = index * chunk_size
+            length = min(chunk_size, file_size - offset)
+            if index < len(copy_chunks) and copy_chunks[index] == chunk_hash:
+                source.seek(offset)
+                output_file.seek(offset)
+                output_file.write(source.read(length))
+                if progress:
+                    progress(length, file_size)
+            elif ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1][1] += length
+            else:
+                ranges.append([offset, length])
+    connection.log(f"{sum(length for _, length in ranges)} of {file_size} bytes of {filename} changed.")
 
-    response = download_file(USERNAME, AUTH_TOKEN, FILENAME, UNIQUE_ID)
+    if tuner:
+        def next_range(max_size):
+            if not ranges:
+                return None
+            offset, length = ranges[0]
+            size = min(max_size, length)
+            if size == length:
+                ranges.pop(0)
+            else:
+                ranges[0] = [offset + size, length - size]
+            return (offset, size), size
 
-    total_size = int(response.headers.get('content-length', 0))
-    chunk_size = 1024 * 1024
-    with tqdm(total=total_size, desc="Downloading chunks", unit="B", unit_scale=True) as progress_bar:
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            if chunk:
-                chunk_filename = f"{UNIQUE_ID}/{FILENAME}.{progress_bar.n // chunk_size}"
-                with open(chunk_filename, "wb") as chunk_file:
-                    chunk_file.write(chunk)
-                progress_bar.update(len(chunk))
+        def fetch(task):
+            download_range(connection, filename, output_path, task[0], task[1], retries, profiler, tuner)
+
+        def fetched(task, result):
+            if progress:
+                progress(task[1], file_size)
+
+        tuner.run(next_range, fetch, fetched)
+    else:
+        for offset, length in ranges:
+            download_range(connection, filename, output_path, offset, length, retries, profiler)
+            if progress:
+                progress(length, file_size)
+
+    with profiler.span("verify", size=file_size):
+        return hash_file(output_path) == manifest["hash"]
+
+"""
+This function downloads a file from the server.
+The file is written to a temporary file next to the output and only moved into place once it is complete,
+so a failed download never leaves a half-written file behind.
+If the output file already exists, or the cache has a copy of the last download of the file, the server is asked whether it changed.
+A copy that is the same is used as it is, and one that is not only gets the chunks that changed downloaded.
+Raises DownloadFailedException if the download does not go through.
+@param connection: The connection to the server.
+@param filename: The name of the file to download.
+@param output_path: Where to save the file. Defaults to the filename in the current folder.
+@param use_hash: Whether to use the hash to verify the file integrity.
+@param progress: A function called with (bytes received, total bytes) as the download goes, or None.
+@param profiler: The profiler to record the timings in.
+@param tuner: An AutoTuner to download the file as many ranges at once, or None for a single stream.
+@param retries: The number of attempts to make for each range, when downloading ranges.
+@param version: The ID of an old version of the file to download, or None for the file itself.
+@param cache: The ContentCache to keep a copy of the file in, or None.
+"""
+def download_file(connection, filename, output_path=None, use_hash=True, progress=None, profiler=NULL_PROFILER, tuner=None, retries=3, version=None, cache=None):
+    output_path = output_path or os.path.basename(filename)
+    cache_key = ContentCache.key(connection, filename)
+
+    # Old versions never change, so only the file itself is compared with a copy
+    copy = None
+    unchanged = False
+    manifest = None
+    if version is None:
+        with profiler.span("hash"):
+            copy = local_copy(connection, filename, output_path, cache)
+    if copy:
+        try:
+            with profiler.span("request"):
+                unchanged, manifest = check_copy(connection, filename, copy[0])
+        except (requests.RequestException, ValueError) as err:
+            raise DownloadFailedException(f"An error occurred: {err}")
+        if unchanged and copy[1] == output_path:
+            if progress:
+                progress(os.path.getsize(output_path), os.path.getsize(output_path))
+            if cache:
+                cache.add(cache_key, output_path, copy[0], copy[2])
+            connection.log(f"File {filename} at {output_path} is up to date.")
+            return
+
+    output_folder = os.path.dirname(os.path.abspath(output_path))
+    temp_file, temp_path = tempfile.mkstemp(dir=output_folder, prefix=f".{os.path.basename(output_path)}.", suffix=".part")
+    os.close(temp_file)
+    try:
+        file_hash = chunks = None
+        if unchanged:
+            with profiler.span("copy"):
+                if copy_and_hash(copy[1], temp_path) == copy[0]:
+                    file_hash, chunks = copy[0], copy[2]
+            if progress:
+                progress(os.path.getsize(temp_path), os.path.getsize(temp_path))
+        elif manifest:
+            if download_changes(connection, filename, copy, manifest, temp_path, tuner, retries, progress, profiler):
+                file_hash, chunks = manifest["hash"], manifest["chunks"]
+        if copy and file_hash is None and copy[1] != output_path and cache:
+            # The cached copy was damaged, or the file changed again while it was being updated.
+            cache.discard(copy[0])
+
+        if file_hash is None:
+            if tuner:
+                open(temp_path, "wb").close()
+                download_ranges(connection, filename, temp_path, tuner, retries, progress, profiler, version)
+                actual_file_hash = None
+            else:
+                with open(temp_path, "wb") as output_file:
+                    actual_file_hash = download_stream(connection, filename, output_file, progress, profiler, version)
+
+        if file_hash is None and use_hash:
+            if actual_file_hash is None:
+                # Ranges arrive out of order, so the file is hashed once it is complete.
+                with profiler.span("hash", size=os.path.getsize(temp_path)):
+                    actual_file_hash = hash_file(temp_path)
+            with profiler.span("verify"):
+                expected_file_hash = retrieve_file_hash(connection, filename, version)
+            if actual_file_hash != expected_file_hash:
+                raise DownloadFailedException("File hash mismatch! Expected {}, got {}. Your file may be corrupted!".format(expected_file_hash, actual_file_hash))
+            connection.log(f"Hash of file: {actual_file_hash}")
+
+        if cache and version is None:
+            if chunks is None:
+                with profiler.span("hash", size=os.path.getsize(temp_path)):
+                    file_hash, chunks = hash_chunks(temp_path)
+            with profiler.span("cache"):
+                cache.add(cache_key, temp_path, file_hash, chunks)
+
+        with profiler.span("commit"):
+            os.replace(temp_path, output_path)
+    except DownloadFailedException:
+        os.remove(temp_path)
+        raise
+    except Exception as err:
+        os.remove(temp_path)
+        raise DownloadFailedException(f"An error occurred: {err}")
+
+    connection.log(f"File {filename} has been saved to {output_path}.")
 
-    reassemble_file(FILENAME, UNIQUE_ID, use_hash=True, username=USERNAME, auth_token=AUTH_TOKEN)
+if __name__ == "__main__":
+    # The arguments were read at the top.
+    FILENAME = args.filename
+
+    connection = connection_from_args(args)
+    if connection is None:
+        print(MISSING_CREDENTIALS)
+        sys.exit(1)
 
-    shutil.rmtree(UNIQUE_ID)
-    if DEBUG:
-        print(f"Removed temp folder {UNIQUE_ID}.")
+    print(f"Looking for file {FILENAME}")
+
+    profiler = Profiler() if args.profile or args.trace else NULL_PROFILER
+    # Either option alone turns on range downloads, with the other one tuned automatically.
+    tuner = tuner_from_args(args.chunk_size or "auto", args.threads or "auto") if args.chunk_size or args.threads else None
+    try:
+        with tqdm(total=0, desc="Downloading", unit="B", unit_scale=True) as progress_bar:
+            download_file(connection, FILENAME, args.output, use_hash=True, progress=progress_bar_callback(progress_bar), profiler=profiler, tuner=tuner, retries=args.retries, version=args.version, cache=cache_from_args(args))
+    except DownloadFailedException as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        if profiler.enabled:
+            profiler.print_summary()
+        if args.trace:
+            profiler.write_trace(args.trace)
+            print(f"Trace written to {args.trace}")
 
-    print(f"File {FILENAME} has been downloaded and reassembled.")
\ No newline at end of file
+    print(f"File {FILENAME} has been downloaded.")
@@ -8,6 +8,36 @@ curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/ref
 echo Downloading download.py...
 curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/download.py
 
+echo Downloading connection.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/connection.py
+
+echo Downloading arguments.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/arguments.py
+
+echo Downloading profiling.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/profiling.py
+
+echo Downloading autotune.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/autotune.py
+
+echo Downloading cluster.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/cluster.py
+
+echo Downloading cache.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/cache.py
+
+echo Downloading sync.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/sync.py
+
+echo Downloading watch.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/watch.py
+
+echo Downloading daemon.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/daemon.py
+
+echo Downloading async_client.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/async_client.py
+
 echo Downloading requirements.txt...
 curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/client/requirements.txt
 
@@ -1,74 +1,331 @@
 import argparse
 import requests
-import os
 import sys
-import subprocess
-from dotenv import load_dotenv
+import os
+import json
+import shlex
+import fnmatch
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from colorama import init, Fore, Style
+from connection import add_connection_arguments, connection_from_args, MISSING_CREDENTIALS
+from cache import add_cache_arguments, cache_from_args
+from daemon import add_daemon_arguments, submit_to_daemon, send_command, daemon_credentials, format_job, DaemonNotRunningException
 
-load_dotenv()
 init(autoreset=True)
 
-DEBUG = False
+# The most operations sent in a single /batch request.
+BATCH_SIZE = 1000
+
+# How many uploads and downloads run at the same time. Any more wait in the queue.
+MAX_TRANSFERS = 4
 
-def list_files(username, auth_token):
-    data = {"userid": username, "auth_token": auth_token}
-    response = requests.post("{}/list".format(SERVER_URL), data=data)
+def list_files(connection, recursive=False):
+    data = dict(connection.credentials(), recursive=str(recursive).lower())
+    response = connection.post("list", data=data)
     if response.status_code == 404:
         return {"error": "No files found"}
-    if DEBUG:
-        print(response.json())
+    connection.log(response.json())
     return response.json()
 
-def delete_file(username, auth_token, filename):
-    data = {"userid": username, "auth_token": auth_token, "filename": filename}
-    response = requests.post("{}/delete".format(SERVER_URL), data=data)
+def delete_file(connection, filename):
+    data = dict(connection.credentials(), filename=filename)
+    response = connection.post("delete", filename=filename, data=data)
     if response.status_code == 404:
         return {"error": "File not found"}
-    if DEBUG:
-        print(response.json())
+    connection.log(response.json())
     return response.json()
 
-def rename_file(username, auth_token, old_filename, new_filename):
-    data = {"userid": username, "auth_token": auth_token, "old_filename": old_filename, "new_filename": new_filename}
-    response = requests.post("{}/rename".format(SERVER_URL), data=data)
+def rename_file(connection, old_filename, new_filename):
+    data = dict(connection.credentials(), old_filename=old_filename, new_filename=new_filename)
+    response = connection.post("rename", filename=old_filename, data=data)
     if response.status_code == 404:
         return {"error": "File not found"}
-    if DEBUG:
-        print(response.json())
+    connection.log(response.json())
+    return response.json()
+
+def list_versions(connection, filename):
+    data = dict(connection.credentials(), filename=filename)
+    response = connection.post("versions", filename=filename, data=data)
+    connection.log(response.json())
     return response.json()
 
-def run_script(script_name, args):
-    command = [script_name] + args
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
-    for line in process.stdout:
-        print(line, end='')
-    process.stdout.close()
-    process.wait()
-    return process.returncode
+def restore_version(connection, filename, version):
+    data = dict(connection.credentials(), filename=filename, version=version)
+    response = connection.post("restore", filename=filename, data=data)
+    connection.log(response.json())
+    return response.json()
+
+def delete_version(connection, filename, version):
+    data = dict(connection.credentials(), filename=filename, version=version)
+    response = connection.post("delete_version", filename=filename, data=data)
+    connection.log(response.json())
+    return response.json()
+
+"""
+This function runs many delete, rename, stat and hash operations on the server with as few requests as possible.
+Returns one result per operation, in the same order.
+@param connection: The connection to the server.
+@param operations: The operations to run, e.g. [{"op": "delete", "filename": "cat.png"}].
+"""
+def batch_operations(connection, operations):
+    results = []
+    for start in range(0, len(operations), BATCH_SIZE):
+        batch = operations[start:start + BATCH_SIZE]
+        data = dict(connection.credentials(), operations=json.dumps(batch))
+        response = connection.post("batch", data=data)
+        response_data = response.json()
+        connection.log(response_data)
+        if "error" in response_data:
+            results.extend({"filename": operation.get("filename"), "error": response_data["error"]} for operation in batch)
+        else:
+            results.extend(response_data["results"])
+    return results
+
+"""
+This function turns a list of filenames and glob patterns (like *.txt) into the matching files on the server.
+The file list is only fetched when there is a pattern to match.
+@param connection: The connection to the server.
+@param patterns: The filenames and patterns to expand.
+"""
+def expand_patterns(connection, patterns):
+    server_files = None
+    filenames = []
+    for pattern in patterns:
+        if not any(c in pattern for c in "*?["):
+            filenames.append(pattern)
+            continue
+        if server_files is None:
+            response = list_files(connection, recursive=True)
+            server_files = response.get("files", [])
+        filenames.extend(f for f in server_files if fnmatch.fnmatchcase(f, pattern))
+    return list(dict.fromkeys(filenames))
+
+"""
+This function prints the results of a batch of operations, and a summary of how many of them failed.
+@param results: The results returned by batch_operations.
+@param action: What the operations did, e.g. "deleted".
+@param verbose: Whether to print every file that succeeded too.
+"""
+def print_batch_results(results, action, verbose=False):
+    failed = [result for result in results if result.get("error")]
+    for result in failed:
+        print(Fore.RED + f"{result.get('filename')}: {result['error']}")
+    if verbose or len(results) == 1:
+        for result in results:
+            if not result.get("error"):
+                print(Fore.GREEN + f"{result['filename']} {action} successfully.")
+    if len(results) > 1:
+        color = Fore.RED if failed else Fore.GREEN
+        print(color + f"{len(results) - len(failed)} of {len(results)} files {action}.")
+
+"""
+An upload or download run by the TransferManager, with its progress.
+"""
+class Job:
+    def __init__(self, job_id, kind, filename):
+        self.id = job_id
+        self.kind = kind
+        self.filename = filename
+        self.status = "queued"
+        self.transferred = 0
+        self.total = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+        # The transfer functions report progress from several threads at once.
+        self.lock = threading.Lock()
+
+    """
+    This function is passed to the transfer functions to keep track of the progress.
+    @param transferred: How many bytes were just transferred.
+    @param total: The total size of the transfer in bytes.
+    """
+    def progress(self, transferred, total):
+        with self.lock:
+            self.transferred += transferred
+            self.total = total
+
+    """
+    This function returns the average transfer speed so far, in bytes per second.
+    """
+    def speed(self):
+        if not self.started:
+            return 0
+        elapsed = (self.finished or time.time()) - self.started
+        with self.lock:
+            transferred = self.transferred
+        return transferred / elapsed if elapsed > 0 else 0
+
+    """
+    This function returns the job as a dict, e.g. to send it to another process.
+    """
+    def to_dict(self):
+        with self.lock:
+            transferred, total = self.transferred, self.total
+        return {"id": self.id, "kind": self.kind, "filename": self.filename, "status": self.status, "transferred": transferred,
+                "total": total, "speed": self.speed(), "error": self.error}
+
+"""
+Runs uploads and downloads in this process, several at once, all sharing the pooled connection.
+"""
+class TransferManager:
+    """
+    @param connection: The connection to the server.
+    @param max_transfers: How many transfers to run at the same time.
+    @param on_finish: A function called with the job when a transfer finishes or fails, or None.
+    @param cache: The ContentCache downloads keep copies in, or None.
+    """
+    def __init__(self, connection, max_transfers=MAX_TRANSFERS, on_finish=None, cache=None):
+        self.connection = connection
+        self.on_finish = on_finish
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=max_transfers)
+        self.jobs = []
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def _run(self, job, function, args, kwargs):
+        from upload import UploadFailedException
+        from download import DownloadFailedException
+
+        job.status = "running"
+        job.started = time.time()
+        try:
+            function(self.connection, *args, progress=job.progress, **kwargs)
+            job.status = "done"
+        except (UploadFailedException, DownloadFailedException, requests.RequestException, OSError) as e:
+            job.status = "failed"
+            job.error = str(e)
+        except Exception as e:
+            # Anything else (like an unexpected answer from the server) still fails the job, or it would look running forever.
+            job.status = "failed"
+            job.error = f"{type(e).__name__}: {e}"
+        finally:
+            job.finished = time.time()
+            if self.on_finish:
+                self.on_finish(job)
+
+    """
+    This function queues a transfer and returns its job straight away.
+    @param kind: "up" or "down".
+    @param filename: The file being transferred, to show in the job list.
+    @param function: The transfer function to run. It is called with the connection, the arguments and a progress function.
+    """
+    def submit(self, kind, filename, function, *args, **kwargs):
+        with self.lock:
+            job = Job(self.next_id, kind, filename)
+            self.next_id += 1
+            self.jobs.append(job)
+        self.executor.submit(self._run, job, function, args, kwargs)
+        return job
+
+    """
+    This function queues the upload of a file or a whole directory.
+    @param filepath: The path of the file or directory to upload.
+    @param overwrite: Whether to overwrite files that already exist.
+    @param options: More arguments for upload_file, e.g. chunk_size.
+    """
+    def upload(self, filepath, overwrite=False, **options):
+        from upload import upload_file
+
+        filename = os.path.basename(os.path.normpath(filepath))
+        if os.path.isdir(filepath):
+            return self.submit("up", filename + "/", upload_tree, filepath, overwrite=overwrite, **options)
+        return self.submit("up", filename, upload_file, filepath, filename, overwrite=overwrite, **options)
+
+    """
+    This function queues the download of a file.
+    @param filename: The name of the file on the server.
+    @param output_path: Where to save the file, or None for the filename in the current folder.
+    @param options: More arguments for download_file, e.g. version.
+    """
+    def download(self, filename, output_path=None, **options):
+        from download import download_file
+
+        return self.submit("down", filename, download_file, filename, output_path, cache=self.cache, **options)
+
+    """
+    This function returns the jobs that are still queued or running.
+    """
+    def active_jobs(self):
+        return [job for job in self.jobs if job.status in ("queued", "running")]
+
+    """
+    This function forgets the oldest finished jobs, so a manager that runs for a long time doesn't keep every job.
+    @param keep: How many finished jobs to keep.
+    """
+    def forget_finished(self, keep):
+        with self.lock:
+            finished = [job for job in self.jobs if job.status in ("done", "failed")]
+            forget = set(id(job) for job in finished[:max(0, len(finished) - keep)])
+            self.jobs = [job for job in self.jobs if id(job) not in forget]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+"""
+This function uploads a whole directory, and raises UploadFailedException if any of the files failed.
+@param connection: The connection to the server.
+@param dirpath: The path of the directory to upload.
+"""
+def upload_tree(connection, dirpath, **kwargs):
+    from upload import upload_directory, UploadFailedException
+
+    failures = upload_directory(connection, dirpath, **kwargs)
+    if failures:
+        filename, error = failures[0]
+        raise UploadFailedException(f"{len(failures)} files failed to upload, e.g. {filename}: {error}")
+
+"""
+This function prints the state of every transfer.
+@param jobs: The transfers, as returned by Job.to_dict().
+"""
+def print_jobs(jobs):
+    if not jobs:
+        print(Fore.YELLOW + "No transfers yet.")
+    colors = {"queued": Fore.WHITE, "running": Fore.CYAN, "done": Fore.GREEN, "failed": Fore.RED}
+    for job in jobs:
+        print(colors[job["status"]] + format_job(job))
+
+"""
+This function prints a message when a transfer finishes in the background.
+@param job: The job that finished.
+"""
+def report_finished_job(job):
+    if job.status == "done":
+        print(Fore.GREEN + f"\n[{job.id}] {job.filename} {'uploaded' if job.kind == 'up' else 'downloaded'}.")
+    else:
+        print(Fore.RED + f"\n[{job.id}] {job.filename} failed: {job.error}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Manage files on the server.")
-    parser.add_argument("--username", help="The username of the user.")
-    parser.add_argument("--auth_token", help="The authentication token of the user.")
-    parser.add_argument("--server_url", help="The server URL.")
-    parser.add_argument("--debug", action="store_true", help="Enable debug mode.")
+    parser.add_argument("--transfers", type=int, default=MAX_TRANSFERS, help="How many uploads and downloads to run at the same time.")
+    add_connection_arguments(parser)
+    add_cache_arguments(parser)
+    add_daemon_arguments(parser)
 
     args = parser.parse_args()
 
-    USERNAME = args.username or os.getenv('C_DOWNLOADER_USERNAME')
-    AUTH_TOKEN = args.auth_token or os.getenv('C_DOWNLOADER_AUTH_TOKEN')
-    SERVER_URL = args.server_url or os.getenv('C_DOWNLOADER_SERVER_URL') or "http://localhost:5000"
-    DEBUG = args.debug
-
-    if not USERNAME or not AUTH_TOKEN:
-        print(Fore.RED + "Username and auth token must be provided either as arguments or environment variables. Please set ENV variables C_DOWNLOADER_USERNAME and C_DOWNLOADER_AUTH_TOKEN.")
+    connection = connection_from_args(args)
+    if connection is None:
+        print(Fore.RED + MISSING_CREDENTIALS)
         sys.exit(1)
 
+    # With --daemon, transfers are handed to daemon.py, so the upload and download code is never loaded here.
+    manager = None if args.daemon else TransferManager(connection, args.transfers, on_finish=report_finished_job, cache=cache_from_args(args))
+
     while True:
-        command = input(Fore.WHITE + "Enter command (ls, mv filename newfilename, rm filename, up filename, down filename, exit): ").strip()
+        command = input(Fore.WHITE + "Enter command (ls, mv filename newfilename, rm filename, stat filename, versions filename, restore filename version, up filename, down filename, jobs, exit): ").strip()
+        try:
+            words = shlex.split(command)
+        except ValueError as e:
+            print(Fore.RED + f"Invalid command: {e}")
+            continue
         if command == "ls":
-            files = list_files(USERNAME, AUTH_TOKEN)
+            files = list_files(connection)
             if "error" in files:
                 print(Fore.RED + files["error"])
             else:
@@ -79,34 +336,103 @@ if __name__ == "__main__":
                     files_on_server += f + "   "
                 print(Fore.GREEN + files_on_server)
         elif command.startswith("mv "):
-            parts = command.split()
+            parts = words
             if len(parts) == 3:
-                old_filename, new_filename = parts[1], parts[2]
-                response = rename_file(USERNAME, AUTH_TOKEN, old_filename, new_filename)
-                if response.get("error"):
-                    print(Fore.RED + f"Error renaming file: {response.get('error')}")
+                sources = expand_patterns(connection, [parts[1]])
+                destination = parts[2]
+                if not sources:
+                    print(Fore.RED + f"No files match {parts[1]}")
+                elif len(sources) > 1 and not destination.endswith("/"):
+                    print(Fore.YELLOW + "Moving several files needs a folder as the destination, e.g. mv *.txt notes/")
                 else:
-                    print(Fore.GREEN + f"File {old_filename} renamed to {new_filename} successfully.")
+                    if destination.endswith("/"):
+                        operations = [{"op": "rename", "filename": f, "new_filename": destination + f.split("/")[-1]} for f in sources]
+                    else:
+                        operations = [{"op": "rename", "filename": sources[0], "new_filename": destination}]
+                    print_batch_results(batch_operations(connection, operations), "renamed", connection.debug)
             else:
-                print(Fore.YELLOW + "Invalid command format. Use: mv filename newfilename")
+                print(Fore.YELLOW + "Invalid command format. Use: mv filename newfilename, or mv pattern folder/")
         elif command.startswith("rm "):
-            parts = command.split()
-            if len(parts) == 2:
-                filename = parts[1]
-                response = delete_file(USERNAME, AUTH_TOKEN, filename)
-                if response.get("error"):
-                    print(Fore.RED + f"Error deleting file: {response.get('error')}")
+            parts = words
+            filenames = expand_patterns(connection, parts[1:])
+            if not filenames:
+                print(Fore.RED + "No files match.")
+            else:
+                operations = [{"op": "delete", "filename": f} for f in filenames]
+                print_batch_results(batch_operations(connection, operations), "deleted", connection.debug)
+        elif command.startswith("stat "):
+            parts = words
+            filenames = expand_patterns(connection, parts[1:])
+            results = batch_operations(connection, [{"op": "stat", "filename": f} for f in filenames])
+            if not results:
+                print(Fore.RED + "No files match.")
+            for result in results:
+                if result.get("error"):
+                    print(Fore.RED + f"{result.get('filename')}: {result['error']}")
                 else:
-                    print(Fore.GREEN + f"File {filename} deleted successfully.")
+                    modified = datetime.fromtimestamp(result["mtime"]).strftime("%Y-%m-%d %H:%M:%S")
+                    print(Fore.GREEN + f"{result['filename']}   {result['size']} bytes   modified {modified}")
+        elif command.startswith("versions "):
+            for filename in words[1:]:
+                result = list_versions(connection, filename)
+                if "error" in result:
+                    print(Fore.RED + f"{filename}: {result['error']}")
+                elif not result["versions"]:
+                    print(Fore.YELLOW + f"{filename} has no old versions.")
+                for version in result.get("versions", []):
+                    modified = datetime.fromtimestamp(version["mtime"]).strftime("%Y-%m-%d %H:%M:%S")
+                    replaced = datetime.fromtimestamp(version["created"]).strftime("%Y-%m-%d %H:%M:%S")
+                    print(Fore.GREEN + f"{filename}   version {version['version']}   {version['size']} bytes   modified {modified}   replaced {replaced}")
+        elif command.startswith("restore ") or command.startswith("rmversion "):
+            parts = words
+            if len(parts) == 3:
+                if parts[0] == "restore":
+                    result = restore_version(connection, parts[1], parts[2])
+                else:
+                    result = delete_version(connection, parts[1], parts[2])
+                if "error" in result:
+                    print(Fore.RED + result["error"])
+                else:
+                    print(Fore.GREEN + result["success"])
             else:
-                print(Fore.YELLOW + "Invalid command format. Use: rm filename")
+                print(Fore.YELLOW + f"Invalid command format. Use: {parts[0]} filename version")
         elif command.startswith("up "):
-            args = command.split()[1:]
-            run_script("cupload.bat", args)
+            parts = words[1:]
+            overwrite = "--overwrite" in parts
+            for filepath in [part for part in parts if part != "--overwrite"]:
+                if not os.path.exists(filepath):
+                    print(Fore.RED + f"File {filepath} does not exist on your system.")
+                    continue
+                if args.daemon:
+                    submit_to_daemon(args, "upload", path=os.path.abspath(filepath), overwrite=overwrite)
+                    continue
+                job = manager.upload(filepath, overwrite)
+                print(Fore.CYAN + f"[{job.id}] Uploading {job.filename}. Use jobs to see the progress.")
         elif command.startswith("down "):
-            args = command.split()[1:]
-            run_script("cdownload.bat", args)
+            for filename in words[1:]:
+                if args.daemon:
+                    submit_to_daemon(args, "download", filename=filename, output_path=os.path.abspath(os.path.basename(filename)))
+                    continue
+                job = manager.download(filename)
+                print(Fore.CYAN + f"[{job.id}] Downloading {job.filename}. Use jobs to see the progress.")
+        elif command == "jobs":
+            if args.daemon:
+                try:
+                    answer = send_command(args.daemon_socket, "status", credentials=daemon_credentials(args))
+                except DaemonNotRunningException as e:
+                    answer = {"error": str(e)}
+                if "error" in answer:
+                    print(Fore.RED + answer["error"])
+                else:
+                    print_jobs(answer["jobs"])
+            else:
+                print_jobs([job.to_dict() for job in manager.jobs])
         elif command == "exit":
+            if manager is None:
+                break
+            if manager.active_jobs():
+                print(Fore.YELLOW + f"Waiting for {len(manager.active_jobs())} transfers to finish...")
+            manager.shutdown()
             break
         else:
-            print(Fore.YELLOW + "Invalid command. Use: ls, mv filename newfilename, rm filename, up filename, down filename, exit")
\ No newline at end of file
+            print(Fore.YELLOW + "Invalid command. Use: ls, mv filename newfilename, rm filename, stat filename, versions filename, restore filename version, rmversion filename version, up filename [--overwrite], down filename, jobs, exit (rm, mv and stat accept patterns like *.txt)")
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+"""
+Records how long each phase of a transfer takes (hashing, reading, sending, ...), per chunk and per thread.
+A disabled profiler records nothing, so the transfer functions can always be given one.
+
+At the end, summary() gives the time and throughput of every phase, the slowest chunks and the retries,
+and write_trace() saves everything in the Chrome trace event format (chrome://tracing, Perfetto, speedscope).
+"""
+class Profiler:
+    """
+    @param enabled: Whether to record anything.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.retries = {}
+        self.server_phases = {}
+
+    """
+    This function times the code inside a with block as one span of a phase.
+    The block gets the span as a dictionary, so it can set "size" once it knows how many bytes it moved.
+    @param phase: The phase, e.g. "send".
+    @param chunk: The index of the chunk the span is for, or None.
+    @param size: How many bytes the span moved, for the throughput.
+    """
+    def span(self, phase, chunk=None, size=0):
+        if not self.enabled:
+            return nullcontext({})
+        return self._span(phase, chunk, size)
+
+    @contextmanager
+    def _span(self, phase, chunk, size):
+        span = {"phase": phase, "chunk": chunk, "size": size, "thread": threading.get_ident()}
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            end = time.perf_counter()
+            span["start"] = start - self.origin
+            span["duration"] = end - start
+            with self.lock:
+                self.spans.append(span)
+
+    """
+    This function counts a retry of a chunk.
+    @param chunk: The index of the chunk.
+    """
+    def retry(self, chunk):
+        if self.enabled:
+            with self.lock:
+                self.retries[chunk] = self.retries.get(chunk, 0) + 1
+
+    """
+    This function records time the server reported it spent on a phase, like putting the file together.
+    @param phase: The phase, e.g. "process".
+    @param seconds: How long the server spent on it.
+    """
+    def server_phase(self, phase, seconds):
+        if self.enabled:
+            with self.lock:
+                self.server_phases[phase] = self.server_phases.get(phase, 0) + seconds
+
+    """
+    This function returns the summary of everything recorded, as a dictionary.
+    @param slowest: How many of the slowest chunks to include.
+    """
+    def summary(self, slowest=5):
+        phases = {}
+        for span in self.spans:
+            phase = phases.setdefault(span["phase"], {"count": 0, "seconds": 0.0, "bytes": 0})
+            phase["count"] += 1
+            phase["seconds"] += span["duration"]
+            phase["bytes"] += span["size"]
+        for phase in phases.values():
+            phase["mb_per_s"] = phase["bytes"] / (1024 * 1024) / phase["seconds"] if phase["bytes"] and phase["seconds"] else None
+
+        chunk_times = {}
+        for span in self.spans:
+            if span["chunk"] is not None:
+                chunk_times[span["chunk"]] = chunk_times.get(span["chunk"], 0) + span["duration"]
+        slowest_chunks = sorted(chunk_times.items(), key=lambda item: item[1], reverse=True)[:slowest]
+
+        wall = max((span["start"] + span["duration"] for span in self.spans), default=0)
+        return {
+            "wall_seconds": wall,
+            "phases": phases,
+            "server_phases": dict(self.server_phases),
+            "slowest_chunks": [{"chunk": chunk, "seconds": seconds, "retries": self.retries.get(chunk, 0)} for chunk, seconds in slowest_chunks],
+            "retries": sum(self.retries.values()),
+            "chunks_retried": len(self.retries),
+        }
+
+    """
+    This function prints the summary as a table.
+    """
+    def print_summary(self):
+        summary = self.summary()
+        print(f"Profile ({summary['wall_seconds']:.2f}s wall time). Phase times add up over all threads.")
+        print(f"{'phase':<12}{'count':>8}{'seconds':>10}{'MB':>10}{'MB/s':>10}")
+        for name, phase in sorted(summary["phases"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+            throughput = f"{phase['mb_per_s']:10.1f}" if phase["mb_per_s"] else f"{'-':>10}"
+            print(f"{name:<12}{phase['count']:>8}{phase['seconds']:>10.3f}{phase['bytes'] / (1024 * 1024):>10.1f}{throughput}")
+        for name, seconds in summary["server_phases"].items():
+            print(f"{'server ' + name:<20}{seconds:>10.3f}")
+        if summary["slowest_chunks"]:
+            print("Slowest chunks: " + ", ".join(f"#{chunk['chunk']} {chunk['seconds']:.3f}s" + (f" ({chunk['retries']} retries)" if chunk["retries"] else "") for chunk in summary["slowest_chunks"]))
+        print(f"Retries: {summary['retries']} over {summary['chunks_retried']} chunks")
+
+    """
+    This function writes everything recorded as a Chrome trace event file.
+    @param path: Where to write the trace.
+    """
+    def write_trace(self, path):
+        threads = {}
+        events = []
+        for span in self.spans:
+            tid = threads.setdefault(span["thread"], len(threads) + 1)
+            args = {"bytes": span["size"]}
+            if span["chunk"] is not None:
+                args["chunk"] = span["chunk"]
+            events.append({
+                "name": span["phase"] if span["chunk"] is None else f"{span['phase']} #{span['chunk']}",
+                "cat": span["phase"],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["duration"] * 1e6,
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": args,
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": self.summary()}, f)
+
+# Passed to the transfer functions when nothing should be recorded.
+NULL_PROFILER = Profiler(enabled=False)
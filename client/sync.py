@@ -0,0 +1,306 @@
+# Keeps a local folder and a folder on the server the same, transferring only the files that differ.
+# What the server has is fetched with one request (/list with details), and a state database in the local folder
+# remembers what both sides looked like after the last sync, so files that did not change are not hashed again,
+# and a file deleted on one side can be told apart from a file that is new on the other.
+import argparse
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from connection import add_connection_arguments, connection_from_args, MISSING_CREDENTIALS
+from upload import upload_files, hash_file, DEFAULT_THREADS
+from download import download_file, DownloadFailedException
+from manager import batch_operations
+
+# The state database, kept in the local folder. It is hidden, so it is never synced itself.
+STATE_FILE = ".mcs_sync.db"
+
+class SyncFailedException(Exception):
+    pass
+
+"""
+What the local folder and the server had after the last sync, by filename (relative to the folder).
+"""
+class SyncState:
+    """
+    @param path: The path of the state database.
+    @param target: What the folder is synced with (server, user and remote folder). A state for another target is cleared.
+    """
+    def __init__(self, path, target):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                filename TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                hash TEXT,
+                server_size INTEGER,
+                server_mtime REAL)""")
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'target'").fetchone()
+            if row is None or row["value"] != target:
+                self.db.execute("DELETE FROM files")
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('target', ?)", (target,))
+
+    def load(self):
+        return {row["filename"]: row for row in self.db.execute("SELECT * FROM files")}
+
+    """
+    This function records files as synced.
+    @param rows: (filename, size, mtime_ns, hash, server_size, server_mtime) for every file.
+    """
+    def record(self, rows):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files (filename, size, mtime_ns, hash, server_size, server_mtime) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def forget(self, filenames):
+        with self.db:
+            self.db.executemany("DELETE FROM files WHERE filename = ?", [(filename,) for filename in filenames])
+
+    def close(self):
+        self.db.close()
+
+"""
+This function returns the name a file of the local folder has on the server.
+@param prefix: The folder on the server, or "" for the top.
+@param filename: The name of the file, relative to the local folder.
+"""
+def remote_name(prefix, filename):
+    return f"{prefix}/{filename}" if prefix else filename
+
+"""
+This function lists the files of the local folder, as {filename: (size, mtime_ns)}.
+Hidden files and folders (like the state database) are left out, since the server does not list them.
+@param folder: The local folder.
+"""
+def scan_local(folder):
+    files = {}
+    for root, folders, names in os.walk(folder):
+        folders[:] = [name for name in folders if not name.startswith(".")]
+        for name in names:
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files[os.path.relpath(path, folder).replace(os.sep, "/")] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+"""
+This function lists the files in a folder on the server with their size, modification time and hash (if the server knows it),
+as {filename: details}, with the filenames relative to the folder.
+@param connection: The connection to the server.
+@param prefix: The folder on the server, or "" for everything.
+"""
+def scan_server(connection, prefix):
+    data = dict(connection.credentials(), recursive="true", details="true")
+    response = connection.post("list", data=data)
+    if response.status_code == 404:
+        return {}
+    result = response.json()
+    if "error" in result:
+        raise SyncFailedException(result["error"])
+    if "details" not in result:
+        raise SyncFailedException("The server is too old to sync with.")
+    start = len(prefix) + 1 if prefix else 0
+    return {filename[start:]: details for filename, details in result["details"].items() if not prefix or filename.startswith(prefix + "/")}
+
+"""
+This function decides what to do with a file that is different on the two sides. Returns "upload", "download" or "conflict".
+@param mode: "push" to make the server like the folder, "pull" to make the folder like the server, or "both".
+@param local_same: Whether the local file did not change since the last sync.
+@param server_same: Whether the file on the server did not change since the last sync.
+"""
+def resolve_difference(mode, local_same, server_same):
+    if mode == "push":
+        return "upload"
+    if mode == "pull":
+        return "download"
+    if server_same:
+        return "upload"
+    if local_same:
+        return "download"
+    return "conflict"
+
+"""
+This function compares the local folder, the server and the state of the last sync, and returns what has to be done,
+as lists of filenames by action. Files that are on both sides with the same size but changed since the last sync
+(or were never synced) go to "compare", to be decided on by their hashes.
+@param local: The local files, from scan_local.
+@param server: The files on the server, from scan_server.
+@param state: The state of the last sync.
+@param mode: "push", "pull" or "both".
+@param delete: Whether files may be deleted to match the other side.
+"""
+def plan_sync(local, server, state, mode, delete):
+    plan = {action: [] for action in ("upload", "download", "delete_server", "delete_local", "conflict", "compare", "forget")}
+    for filename in sorted(set(local) | set(server) | set(state)):
+        local_file = local.get(filename)
+        server_file = server.get(filename)
+        synced = state.get(filename)
+        local_same = synced is not None and local_file == (synced["size"], synced["mtime_ns"])
+        server_same = synced is not None and server_file is not None and (server_file["size"], server_file["mtime"]) == (synced["server_size"], synced["server_mtime"])
+
+        if local_file and server_file:
+            if local_same and server_same:
+                continue
+            if local_file[0] == server_file["size"]:
+                plan["compare"].append(filename)
+            else:
+                plan[resolve_difference(mode, local_same, server_same)].append(filename)
+        elif local_file:
+            # Gone from the server: deleted there since the last sync, or never uploaded
+            if mode == "pull" or (mode == "both" and local_same):
+                if delete:
+                    plan["delete_local"].append(filename)
+            else:
+                plan["upload"].append(filename)
+        elif server_file:
+            # Gone from the folder: deleted here since the last sync, or never downloaded
+            if mode == "push" or (mode == "both" and server_same):
+                if delete:
+                    plan["delete_server"].append(filename)
+            else:
+                plan["download"].append(filename)
+        else:
+            plan["forget"].append(filename)
+    return plan
+
+"""
+This function keeps a local folder and a folder on the server the same.
+Returns the plan that was carried out, with a "failed" list of (filename, error) pairs.
+@param connection: The connection to the server.
+@param folder: The local folder.
+@param prefix: The folder on the server, or "" for the top.
+@param mode: "push" to make the server like the folder, "pull" to make the folder like the server, or "both" to bring changes both ways.
+@param delete: Whether files may be deleted to match the other side. Without it, nothing is ever deleted.
+@param threads: How many files to hash and transfer at once.
+@param dry_run: Whether to only work out what would be done.
+@param state_path: The path of the state database. Defaults to STATE_FILE in the folder.
+"""
+def sync_folder(connection, folder, prefix, mode="push", delete=False, threads=DEFAULT_THREADS, dry_run=False, state_path=None):
+    state_db = SyncState(state_path or os.path.join(folder, STATE_FILE), f"{connection.server_url}|{connection.username}|{prefix}")
+    try:
+        state = state_db.load()
+        local = scan_local(folder)
+        server = scan_server(connection, prefix)
+        plan = plan_sync(local, server, state, mode, delete)
+
+        # Files of the same size are compared by hash. The local hash is reused if the file did not change since it was last hashed,
+        # and the server hash is asked for (in bulk) if the listing did not have it.
+        def local_hash(filename):
+            synced = state.get(filename)
+            if synced is not None and synced["hash"] and local[filename] == (synced["size"], synced["mtime_ns"]):
+                return synced["hash"]
+            return hash_file(os.path.join(folder, filename))
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            local_hashes = dict(zip(plan["compare"], executor.map(local_hash, plan["compare"])))
+        missing = [filename for filename in plan["compare"] if not server[filename]["hash"]]
+        for result in batch_operations(connection, [{"op": "hash", "filename": remote_name(prefix, filename)} for filename in missing]) if missing else []:
+            if result.get("hash"):
+                server[result["filename"][len(prefix) + 1 if prefix else 0:]]["hash"] = result["hash"]
+
+        same = []
+        for filename in plan.pop("compare"):
+            if local_hashes[filename] == server[filename]["hash"]:
+                same.append(filename)
+            else:
+                synced = state.get(filename)
+                local_same = synced is not None and local[filename] == (synced["size"], synced["mtime_ns"])
+                server_same = synced is not None and (server[filename]["size"], server[filename]["mtime"]) == (synced["server_size"], synced["server_mtime"])
+                plan[resolve_difference(mode, local_same, server_same)].append(filename)
+        plan["same"] = same
+        plan["failed"] = []
+        if dry_run:
+            return plan
+
+        failed = plan["failed"]
+        if plan["upload"]:
+            files = [(os.path.join(folder, filename), remote_name(prefix, filename)) for filename in plan["upload"]]
+            failed.extend((filename[len(prefix) + 1 if prefix else 0:], error) for filename, error in upload_files(connection, files, threads=threads, overwrite=True))
+
+        def download(filename):
+            path = os.path.join(folder, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                download_file(connection, remote_name(prefix, filename), path)
+            except DownloadFailedException as e:
+                return filename, str(e)
+            return None
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            failed.extend(failure for failure in executor.map(download, plan["download"]) if failure)
+
+        if plan["delete_server"]:
+            results = batch_operations(connection, [{"op": "delete", "filename": remote_name(prefix, filename)} for filename in plan["delete_server"]])
+            failed.extend((filename, result["error"]) for filename, result in zip(plan["delete_server"], results) if result.get("error"))
+        for filename in plan["delete_local"]:
+            try:
+                os.remove(os.path.join(folder, filename))
+            except OSError as e:
+                failed.append((filename, str(e)))
+
+        # What both sides have now is recorded for the files that were synced. The local size and time are the ones from
+        # before an upload, so a file that changed while it was being uploaded is uploaded again next time.
+        failed_names = {filename for filename, _ in failed}
+        server = scan_server(connection, prefix)
+        rows = []
+        for filename in plan["upload"] + plan["download"] + same:
+            if filename in failed_names or filename not in server:
+                continue
+            if filename in plan["download"]:
+                stat = os.stat(os.path.join(folder, filename))
+                size, mtime_ns, file_hash = stat.st_size, stat.st_mtime_ns, None
+            else:
+                (size, mtime_ns), file_hash = local[filename], local_hashes.get(filename)
+            rows.append((filename, size, mtime_ns, file_hash, server[filename]["size"], server[filename]["mtime"]))
+        state_db.record(rows)
+        state_db.forget([filename for filename in plan["delete_server"] + plan["delete_local"] + plan["forget"] if filename not in failed_names])
+        return plan
+    finally:
+        state_db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep a local folder and a folder on the server the same, transferring only the files that differ.")
+    parser.add_argument("folder", help="The local folder.")
+    parser.add_argument("--remote", help="The folder on the server. Defaults to the name of the local folder, like uploading the folder does. Use \"\" for the top.")
+    parser.add_argument("--mode", choices=["push", "pull", "both"], default="push", help="push makes the server like the folder, pull makes the folder like the server, both brings changes both ways.")
+    parser.add_argument("--delete", action="store_true", help="Delete files to match the other side. Without it, nothing is deleted.")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="How many files to hash and transfer at once.")
+    parser.add_argument("--dry_run", action="store_true", help="Only print what would be done.")
+    parser.add_argument("--state", help=f"The state database. Defaults to {STATE_FILE} in the folder.")
+    add_connection_arguments(parser)
+
+    args = parser.parse_args()
+
+    connection = connection_from_args(args, pool_size=max(args.threads, 1) * 2)
+    if connection is None:
+        print(MISSING_CREDENTIALS)
+        sys.exit(1)
+    if not os.path.isdir(args.folder):
+        print(f"Folder {args.folder} does not exist.")
+        sys.exit(1)
+
+    prefix = args.remote if args.remote is not None else os.path.basename(os.path.abspath(args.folder))
+    try:
+        plan = sync_folder(connection, args.folder, prefix.strip("/"), args.mode, args.delete, args.threads, args.dry_run, args.state)
+    except SyncFailedException as e:
+        print(e)
+        sys.exit(1)
+
+    for action in ("upload", "download", "delete_server", "delete_local"):
+        for filename in plan[action]:
+            connection.log(f"{action}: {filename}")
+    for filename in plan["conflict"]:
+        print(f"Conflict, changed on both sides since the last sync: {filename}")
+    for filename, error in plan["failed"]:
+        print(f"Failed: {filename}: {error}")
+    counts = (len(plan["upload"]), len(plan["download"]), len(plan["delete_server"]), len(plan["delete_local"]))
+    if args.dry_run:
+        print("Would upload {}, download {}, delete {} on the server and {} here.".format(*counts))
+    else:
+        print("Uploaded {}, downloaded {}, deleted {} on the server and {} here.".format(*counts))
+    print(f"{len(plan['same'])} compared the same, {len(plan['conflict'])} conflicts, {len(plan['failed'])} failed.")
+    if plan["failed"]:
+        sys.exit(1)
@@ -1,318 +1,584 @@
 import argparse
-import requests
-import random
-import string
 import os
-import shutil
+import io
 import hashlib
-import math
+import json
+import random
 import sys
+import shutil
+import tarfile
 import threading
-import queue
+import time
+from collections import deque
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from arguments import add_connection_arguments
+from daemon import add_daemon_arguments, submit_to_daemon
+
+# When uploading a directory, files up to this size are packed together into batches.
+# A batch is sent once it holds this many files or this many bytes.
+BATCH_MAX_FILES = 1000
+BATCH_MAX_BYTES = (1024 * 1024) * 16  # 16 MB
+
+DEFAULT_CHUNK_SIZE = (1024 * 1024) * 5  # 5 MB
+DEFAULT_THREADS = 8
+
+# Retries wait a random time of up to RETRY_BASE_DELAY * 2^attempt seconds, capped at RETRY_MAX_DELAY,
+# so chunks that failed together don't all come back at the same moment.
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+# How many retries one upload may make in total, plus one for every 10 chunks.
+DEFAULT_RETRY_BUDGET = 16
+
+"""
+This function returns the parser for the arguments of this script.
+"""
+def build_parser():
+    parser = argparse.ArgumentParser(description="Upload a file or a whole directory to the server.")
+    parser.add_argument("filename", help="The name of the file or directory to upload.")
+    parser.add_argument("--overwrite", action="store_true", help="Overwrite the file if it already exists.")
+    parser.add_argument("--chunk_size", default="5", help="The size of each chunk in MB, or \"auto\" to tune it as the upload goes.")
+    parser.add_argument("--threads", default=str(DEFAULT_THREADS), help="The number of chunks (or files, for a directory) to upload at once, or \"auto\" to tune it as the upload goes.")
+    parser.add_argument("--check_hashes", action="store_true", help="Check the hash of the file.")
+    parser.add_argument("--check_chunk_hashes", action="store_true", help="Check the hash of each chunk.")
+    parser.add_argument("--rm", action="store_true", help="Remove the file after upload.")
+    parser.add_argument("--retries", type=int, default=3, help="The number of retries for each chunk.")
+    parser.add_argument("--retry_budget", type=int, help="The number of retries the whole upload may make. Defaults to 16 plus one per 10 chunks.")
+    parser.add_argument("--profile", action="store_true", help="Time every phase and chunk of the upload and print a summary.")
+    parser.add_argument("--trace", help="Also write the timings to this file as a trace for chrome://tracing or Perfetto. Implies --profile.")
+    add_connection_arguments(parser)
+    add_daemon_arguments(parser)
+    return parser
+
+"""
+This function hands the upload to the daemon. Returns the exit code of the script.
+@param args: The parsed arguments, from build_parser().
+"""
+def hand_off(args):
+    if args.rm or args.profile or args.trace:
+        print("--rm, --profile and --trace can't be used with --daemon.")
+        return 1
+    if not os.path.exists(args.filename):
+        print(f"File {args.filename} does not exist on your system.")
+        return 1
+    # Sizes the tuner would pick are left to the daemon.
+    options = dict(check_hashes=args.check_hashes, check_chunk_hashes=args.check_chunk_hashes, retries=args.retries, retry_budget=args.retry_budget)
+    if args.chunk_size != "auto":
+        options["chunk_size"] = int(float(args.chunk_size) * 1024 * 1024)
+    if args.threads != "auto":
+        options["threads"] = int(args.threads)
+    job = submit_to_daemon(args, "upload", path=os.path.abspath(args.filename), overwrite=args.overwrite, options=options)
+    return 0 if job else 1
+
+# With --daemon the upload is handed off before the libraries below are loaded and .env is read, so it returns straight away.
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    if args.daemon:
+        sys.exit(hand_off(args))
+
+import requests
 from tqdm import tqdm
-from dotenv import load_dotenv
+from connection import connection_from_args, progress_bar_callback, MISSING_CREDENTIALS
+from profiling import Profiler, NULL_PROFILER
+from autotune import AutoTuner, tuner_from_args
+
+# Sessions of uploads that did not finish, so running the upload again only sends the missing chunks.
+UPLOAD_SESSIONS_FILE = os.getenv("UPLOAD_SESSIONS_FILE", os.path.join(os.path.expanduser("~"), ".mcs_upload_sessions.json"))
+upload_sessions_lock = threading.Lock()
 
-load_dotenv()
+class UploadFailedException(Exception):
+    pass
+
+"""
+The retries one upload has left, shared by all of its chunks.
+"""
+class RetryBudget:
+    """
+    @param retries: How many retries the upload may make in total.
+    """
+    def __init__(self, retries):
+        self.remaining = retries
+        self.lock = threading.Lock()
+
+    """
+    This function takes one retry from the budget. Returns False if there are none left.
+    """
+    def take(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+"""
+This function returns how long to wait before a retry, with full jitter.
+@param attempt: The number of the attempt about to be made, starting at 1 for the first retry.
+"""
+def backoff_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+"""
+This function returns the key an unfinished upload is remembered under.
+The size and modification time are part of it, so a changed file never resumes an old session.
+@param connection: The connection to the server.
+@param filepath: The path of the file being uploaded.
+@param filename: The name of the file on the server.
+"""
+def upload_session_key(connection, filepath, filename):
+    stat = os.stat(filepath)
+    return "|".join([connection.server_url, connection.username, filename, os.path.abspath(filepath), str(stat.st_size), str(stat.st_mtime_ns)])
 
-DEBUG = False
+def load_upload_sessions():
+    try:
+        with open(UPLOAD_SESSIONS_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 """
-This function generates a random string of a given length.
-@param length: The length of the string to generate.
+This function remembers (or with session_id None, forgets) the session of an unfinished upload.
+@param key: The key from upload_session_key.
+@param session_id: The ID of the session, or None.
+"""
+def save_upload_session(key, session_id):
+    with upload_sessions_lock:
+        sessions = load_upload_sessions()
+        if session_id:
+            sessions[key] = session_id
+        elif sessions.pop(key, None) is None:
+            return
+        temp_path = UPLOAD_SESSIONS_FILE + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(sessions, f)
+        os.replace(temp_path, UPLOAD_SESSIONS_FILE)
+
 """
-def generate_random_string(length):
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+This function hashes a file without loading it into memory all at once.
+@param filename: The path of the file to hash.
+"""
+def hash_file(filename):
+    file_hash_obj = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            file_hash_obj.update(data)
+    return file_hash_obj.hexdigest()
 
 """
-This function will check for a unique ID before uploading the file.
-@param username: The username of the user.
-@param auth_token: The authentication token of the user.
-@param unique_id: The unique ID to check.
-@param filename: The name of the file to upload. (This is just to check if the file exists.)
+This function asks the server to start an upload session.
+The server answers with the session ID, the chunk plan, and the chunks it already has (when resuming).
+@param connection: The connection to the server.
+@param filename: The name to save the file as on the server.
+@param size: The size of the file in bytes.
+@param chunk_size: The chunk size to ask for, in bytes. The server may pick a different one.
+@param overwrite: Whether to overwrite the file if it already exists.
+@param file_hash: The hash of the whole file, if the server should verify it.
+@param session_id: The ID of an earlier session to resume.
 """
-def check_unique_id(username, auth_token, unique_id, filename, overwrite):
-    #This filename is just to check if the file exists.
-    data = {"userid": username, "auth_token": auth_token, "tempid": unique_id, "filename": filename, "overwrite": overwrite}
-    response = requests.post("{}/id".format(SERVER_URL), data=data)
+def begin_upload(connection, filename, size, chunk_size, overwrite=False, file_hash=None, session_id=None):
+    data = dict(connection.credentials(), filename=filename, size=size, chunk_size=chunk_size, overwrite=str(overwrite).lower())
+    if file_hash:
+        data["hash"] = file_hash
+    if session_id:
+        data["session"] = session_id
+    response = connection.post("begin", filename=filename, data=data)
+    connection.log(response.json())
     return response.json()
 
 """
-This function sends a request to the server to upload a file.
-@param username: The username of the user.
-@param auth_token: The authentication token of the user.
-@param filename: The name of the file to upload.
-@param unique_id: The unique ID to use for the upload.
-@param progress_bar: The progress bar to update.
-@param CHECK_CHUNK_HASHES: Whether to check the hash of each chunk.
-@param retries: The number of retries to attempt.
+This function reads one chunk of a file, or several consecutive chunks.
+@param filename: The path of the file.
+@param index: The index of the chunk.
+@param chunk_size: The size of each chunk in bytes.
+@param count: How many chunks to read.
 """
-class UploadFailedException(Exception):
-    pass
+def read_chunk(filename, index, chunk_size, count=1):
+    with open(filename, "rb") as f:
+        f.seek(index * chunk_size)
+        return f.read(chunk_size * count)
 
-progress_bar_lock = threading.Lock()  # Create a lock for the progress bar
-
-def upload_file(username, auth_token, filename, unique_id, progress_bar, CHECK_CHUNK_HASHES, retries, exception_queue):
-    chunk_hash = "IGNORE"
-    if CHECK_CHUNK_HASHES:
-        with open(filename, "rb") as f:
-            chunk_data = f.read()
-        chunk_hash = hashlib.sha256(chunk_data).hexdigest()
-    
-    data = {"userid": username, "auth_token": auth_token, "tempid": unique_id, "chunk_hash": chunk_hash}
-    files = {"file": open(filename, "rb")}
-    
+"""
+This function sends one chunk of a file to the server, or several consecutive chunks in one request.
+The chunk is read from the file again on every attempt, so a retry always sends the full chunk.
+@param connection: The connection to the server.
+@param session_id: The ID of the upload session.
+@param filename: The path of the file being uploaded.
+@param index: The index of the chunk.
+@param chunk_size: The size of each chunk in bytes.
+@param check_chunk_hash: Whether the server should check the hash of the chunk.
+@param retries: The number of attempts to make.
+@param profiler: The profiler to record the timings in.
+@param count: How many consecutive chunks to send, starting at index.
+@param tuner: The tuner to report failed attempts to, or None.
+@param budget: The RetryBudget of the upload, or None for no limit besides retries.
+@param node: The URL of the node that has the session, in a cluster.
+"""
+def upload_chunk(connection, session_id, filename, index, chunk_size, check_chunk_hash, retries, profiler=NULL_PROFILER, count=1, tuner=None, budget=None, node=None):
+    route = "chunk/{}/{}".format(session_id, index) + (f"?count={count}" if count > 1 else "")
     for attempt in range(retries):
+        if attempt:
+            if budget and not budget.take():
+                raise UploadFailedException(f"Failed to upload chunk {index} of {filename}: the upload ran out of retries. Pass the --debug flag for more information.")
+            profiler.retry(index)
+            time.sleep(backoff_delay(attempt))
         try:
-            response = requests.post("{}/upload".format(SERVER_URL), data=data, files=files)
-            response.raise_for_status()  # Raise an error for bad status codes
-            response_data = response.json()
+            with profiler.span("read", index) as span:
+                chunk_data = read_chunk(filename, index, chunk_size, count)
+                span["size"] = len(chunk_data)
+            headers = {"Content-Type": "application/octet-stream"}
+            if check_chunk_hash:
+                with profiler.span("chunk hash", index, len(chunk_data)):
+                    headers["X-Chunk-Hash"] = hashlib.sha256(chunk_data).hexdigest()
+            with profiler.span("send", index, len(chunk_data)):
+                response = connection.post(route, node=node, data=chunk_data, headers=headers)
+                if 400 <= response.status_code < 500:
+                    # The session is gone or the request is wrong, so sending it again won't help.
+                    # A proxy in between may answer with a page instead of JSON, which is just as final.
+                    try:
+                        error = response.json().get("error", response.status_code)
+                    except ValueError:
+                        error = response.status_code
+                    raise UploadFailedException(f"Failed to upload chunk {index} of {filename}: {error}")
+                response.raise_for_status()  # Raise an error for bad status codes
+                response_data = response.json()
             if "error" in response_data:
-                if DEBUG:
-                    print(f"Server error: {response_data['error']}")
+                connection.log(f"Server error: {response_data['error']}")
                 raise requests.RequestException(response_data["error"])
-            with progress_bar_lock:
-                progress_bar.update(1)
+            for phase, seconds in response_data.get("timings", {}).items():
+                profiler.server_phase(phase, seconds)
             return response_data
+        except UploadFailedException:
+            raise
         except Exception as e:
+            if tuner:
+                tuner.record_error()
             if attempt < retries - 1:
-                if DEBUG:
-                    print(f"Upload failed (attempt {attempt + 1}/{retries}). Retrying... Error: {e}")
+                connection.log(f"Upload of chunk {index} failed (attempt {attempt + 1}/{retries}). Retrying... Error: {e}")
             else:
-                if DEBUG:
-                    print(f"Upload failed after {retries} attempts. Error: {e}")
-                exception_queue.put(UploadFailedException(f"Failed to upload {filename} after {retries} attempts. Pass the --debug flag for more information."))
-                return
-        finally:
-            files["file"].close()
-
-"""
-This function will remove the temp file client and server side in the event of an error.
-@param unique_id: The unique ID to delete.
-@username: The username of the user.
-@auth_token: The authentication token of the user.
-"""
-def cleanup_failed_upload(unique_id, username, auth_token):
-    if os.path.exists(unique_id):
-        shutil.rmtree(unique_id)
-        if DEBUG:
-            print(f"Removed temp folder {unique_id}.")
-    else:
-        if DEBUG:
-            print(f"Temp folder {unique_id} does not exist.")
-    data = {"userid": username, "auth_token": auth_token, "tempid": unique_id}
-    response = requests.post("{}/cleanup".format(SERVER_URL), data=data)
-    if DEBUG:
-        print(response.json())
-
-"""This function will check if the file exists,
-and give you a unique ID you can use for the folder chunking.
-@param filename: The name of the file to upload.
+                connection.log(f"Upload of chunk {index} failed after {retries} attempts. Error: {e}")
+                raise UploadFailedException(f"Failed to upload chunk {index} of {filename} after {retries} attempts. Pass the --debug flag for more information.")
+
+"""
+This function uploads a file that fits in one chunk with a single request.
+@param connection: The connection to the server.
+@param filepath: The path of the file to upload.
+@param filename: The name to save the file as on the server.
 @param overwrite: Whether to overwrite the file if it already exists.
+@param file_hash: The hash of the file, if the server should verify it.
 """
-def prepare_upload(filename, overwrite=False):
-    if not os.path.exists(filename):
-        return f"File {filename} does not exist on your system."
-    unique_id = generate_random_string(10)
-    if DEBUG:
-        print("Checking if ID is unique...")
-    if not overwrite:
-        overwrite = "IGNORE"
-    while True:
-        response = check_unique_id(USERNAME, AUTH_TOKEN, unique_id, filename, overwrite)
-        if response.get("error") == "File already exists":
-            return f"Error: File {filename} already exists on the server. Remove the file, choose a different name, or use the --overwrite flag."
-        elif response.get("error") or os.path.exists(unique_id):
-            unique_id = generate_random_string(10)
-            if DEBUG:
-                print("ID is not unique, generating new ID...")
-        else:
-            break
-    if DEBUG:
-        print("ID is unique. Using ID:", unique_id)
-    unique_id = "C_" + unique_id
-    return unique_id
-
-"""This function will remove the temp folder after the file has been uploaded.
-@param unique_id: The unique ID to delete.
-"""
-def cleanup_upload(unique_id):
-    if os.path.exists(unique_id):
-        shutil.rmtree(unique_id)
-        if DEBUG:
-            print(f"Removed temp folder {unique_id}.")
-    else:
-        if DEBUG:
-            print(f"Temp folder {unique_id} does not exist.")
-
-"""This function will send a request to the server to start processing and reassembling the file.
-@param username: The username of the user.
-@param auth_token: The authentication token of the user.
-@param unique_id: The unique ID to process.
-@param output_file: The name you want to save the file as (server side).
-@param check_hash: Whether to check the hash of the file.
-@param check_chunk_hashes: Whether to check the hash of each chunk.
-"""
-def process_file_server_side(username, auth_token, unique_id, output_file, check_hash=True, check_chunk_hashes=False):
-    data = {"userid": username, "auth_token": auth_token, "tempid": unique_id, "output_file": output_file, "check_hash": check_hash, "check_chunk_hashes": check_chunk_hashes}
-    response = requests.post("{}/process".format(SERVER_URL), data=data)
-    if DEBUG:
-        print(response.json())
+def put_file(connection, filepath, filename, overwrite=False, file_hash=None):
+    data = dict(connection.credentials(), filename=filename, overwrite=str(overwrite).lower())
+    if file_hash:
+        data["hash"] = file_hash
+    with open(filepath, "rb") as f:
+        response = connection.post("put", filename=filename, data=data, files={"file": (os.path.basename(filepath), f)})
+    connection.log(response.json())
     return response.json()
 
 """
-This function deconstructs a file into chunks and stores them in a folder.
-@param filename: The name of the file to deconstruct.
-@param chunk_size: The size of each chunk in MB.
-@param chunk_output: The folder to store the chunks.
-@param use_hash: Whether to hash the file.
-@param use_chunk_hashes: Whether to hash each chunk.
+This function uploads many small files with a single request by packing them into a tar archive.
+The server unpacks the archive as it arrives and reports back the result of every file.
+In a cluster, every node gets one request with the files that belong to it.
+@param connection: The connection to the server.
+@param files: A list of (path on disk, name on the server) pairs.
+@param overwrite: Whether to overwrite files that already exist.
+@param check_hashes: Whether the server should check the hash of every file.
 """
-def deconstruct_file(filename, chunk_size, chunk_output, use_hash, use_chunk_hashes):
-    # Check if the file exists
-    if not os.path.exists(filename):
-        print(f"File {filename} does not exist.")
-        sys.exit(1)
-
-    # Check if the chunk output folder exists
-    if not os.path.exists(chunk_output):
-        os.mkdir(chunk_output)
+def put_batch(connection, files, overwrite=False, check_hashes=False):
+    files_by_node = {}
+    for filepath, filename in files:
+        files_by_node.setdefault(connection.node_url(filename), []).append((filepath, filename))
+    if len(files_by_node) <= 1:
+        return put_node_batch(connection, connection.node_url(files[0][1]) if files else connection.server_url, files, overwrite, check_hashes)
+
+    results = []
+    for node, node_files in files_by_node.items():
+        response = put_node_batch(connection, node, node_files, overwrite, check_hashes)
+        if response.get("error") and not response.get("results"):
+            results.extend({"filename": filename, "error": response["error"]} for _, filename in node_files)
+        else:
+            results.extend(response["results"])
+    return {"success": "Batch processed", "results": results}
 
-    # Initialize hash objects
-    file_hash_obj = hashlib.sha256()
-    chunk_hashes = []
+"""
+This function sends a batch of files to one node.
+@param connection: The connection to the server.
+@param node: The URL of the node.
+@param files: A list of (path on disk, name on the server) pairs.
+@param overwrite: Whether to overwrite files that already exist.
+@param check_hashes: Whether the server should check the hash of every file.
+"""
+def put_node_batch(connection, node, files, overwrite=False, check_hashes=False):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as archive:
+        for filepath, filename in files:
+            info = archive.gettarinfo(filepath, arcname=filename)
+            if check_hashes:
+                info.pax_headers = {"MCS.hash": hash_file(filepath)}
+            with open(filepath, "rb") as f:
+                archive.addfile(info, f)
+
+    headers = {"X-Userid": connection.username, "X-Auth-Token": connection.auth_token, "Content-Type": "application/x-tar"}
+    response = connection.post("put_batch", node=node, params={"overwrite": str(overwrite).lower()}, data=buffer.getvalue(), headers=headers)
+    connection.log(response.json())
+    return response.json()
 
-    # Open the file
-    with open(filename, "rb") as f:
-        data = f.read()
-        file_size = os.path.getsize(filename)
-        file_hash_obj.update(data)
+"""
+This function will throw away the upload session server side in the event of an error.
+@param connection: The connection to the server.
+@param session_id: The ID of the upload session.
+@param node: The URL of the node that has the session, in a cluster.
+"""
+def abort_upload(connection, session_id, node=None):
+    response = connection.post("abort", node=node, data={"session": session_id})
+    connection.log(response.json())
 
-    if use_hash:
-        # Write the hash to a .hash file
-        file_hash = file_hash_obj.hexdigest()
-        with open(f"{chunk_output}/{filename}.hash", "w") as hash_file:
-            hash_file.write(file_hash)
+"""
+This function uploads one file, using a single request if it fits in one chunk and an upload session otherwise.
+Raises UploadFailedException if the upload does not go through.
+@param connection: The connection to the server.
+@param filepath: The path of the file to upload.
+@param filename: The name to save the file as on the server.
+@param chunk_size: The size of each chunk in bytes.
+@param threads: The number of chunks to upload at once.
+@param overwrite: Whether to overwrite the file if it already exists.
+@param check_hashes: Whether the server should check the hash of the file.
+@param check_chunk_hashes: Whether the server should check the hash of each chunk.
+@param retries: The number of attempts to make for each chunk.
+@param progress: A function called with (bytes sent, total bytes) as the upload goes, or None.
+@param profiler: The profiler to record the timings in.
+@param tuner: An AutoTuner that picks the request size and the number of chunks in flight as the upload goes,
+              instead of chunk_size and threads. The session is planned in chunks of the tuner's smallest size.
+@param retry_budget: How many retries the upload may make over all its chunks. Defaults to DEFAULT_RETRY_BUDGET plus one per 10 chunks.
+"""
+def upload_file(connection, filepath, filename, chunk_size=DEFAULT_CHUNK_SIZE, threads=DEFAULT_THREADS, overwrite=False, check_hashes=False, check_chunk_hashes=False, retries=3, progress=None, profiler=NULL_PROFILER, tuner=None, retry_budget=None):
+    tuner = tuner or AutoTuner.fixed(chunk_size, threads)
+    chunk_size = tuner.min_chunk_size
+    size = os.path.getsize(filepath)
+    file_hash = None
+    if check_hashes:
+        with profiler.span("file hash", size=size):
+            file_hash = hash_file(filepath)
+
+    if size <= chunk_size:
+        with profiler.span("put", size=size):
+            result = put_file(connection, filepath, filename, overwrite, file_hash)
+        if progress and not result.get("error"):
+            progress(size, size)
+    else:
+        # If an earlier run of this upload failed, its session still holds the chunks that made it.
+        session_key = upload_session_key(connection, filepath, filename)
+        with profiler.span("begin"):
+            start = time.perf_counter()
+            result = begin_upload(connection, filename, size, chunk_size, overwrite, file_hash, load_upload_sessions().get(session_key))
+            tuner.probe(time.perf_counter() - start)
+    if result.get("error") == "File already exists":
+        raise UploadFailedException(f"File {filename} already exists on the server. Remove the file, choose a different name, or use the --overwrite flag.")
+    elif result.get("error"):
+        raise UploadFailedException(f"Error uploading {filename}: {result.get('error')}")
+    if result.get("complete"):
+        return
+
+    session_id = result["session"]
+    node = result.get("node")
+    present = set(result["present"])
+    pending = [index for index in range(result["num_chunks"]) if index not in present]
+    connection.log(f"Using session {session_id}, {len(pending)} of {result['num_chunks']} chunks to send.")
+    chunk_size = result["chunk_size"]
+    if progress:
+        progress(sum(min(chunk_size, size - index * chunk_size) for index in present), size)
+
+    # Every request carries a run of consecutive chunks, as many as fit in the tuner's current chunk size.
+    queue = deque(pending)
+    def request_size(index, count):
+        return min(count * chunk_size, size - index * chunk_size)
+
+    def next_request(max_size):
+        if not queue:
+            return None
+        index = queue.popleft()
+        count = 1
+        while queue and queue[0] == index + count and (count + 1) * chunk_size <= max_size:
+            queue.popleft()
+            count += 1
+        return (index, count), request_size(index, count)
+
+    budget = RetryBudget(retry_budget if retry_budget is not None else DEFAULT_RETRY_BUDGET + len(pending) // 10)
+    def send_request(request):
+        index, count = request
+        return upload_chunk(connection, session_id, filepath, index, chunk_size, check_chunk_hashes, retries, profiler, count, tuner, budget, node)
+
+    # The server puts the file together when the last chunk arrives, and says so in that chunk's response.
+    results = []
+    def request_done(request, result):
+        results.append(result)
+        if progress:
+            progress(request_size(*request), size)
+
+    # A failed upload keeps its session, so the chunks that made it are not sent again next time.
+    try:
+        tuner.run(next_request, send_request, request_done)
+    except UploadFailedException as e:
+        save_upload_session(session_key, session_id)
+        raise UploadFailedException(f"{e} The chunks already sent are kept; run the upload again to send only the rest.")
+
+    save_upload_session(session_key, None)
+    if not any(chunk_result.get("complete") for chunk_result in results):
+        raise UploadFailedException(f"Error validating {filename}: the server did not confirm the upload.")
 
-    # Calculate the number of chunks
-    num_chunks = math.ceil(file_size / (chunk_size * 1024 * 1024))
+"""
+This function uploads many files. Small files are packed into batches, and batches and large files are uploaded at the same time.
+Returns a list of (filename, error) pairs for the files that failed.
+@param connection: The connection to the server.
+@param files: The files to upload, as (local path, name on the server) pairs.
+@param chunk_size: The size of each chunk in bytes. Files up to this size go into batches.
+@param threads: The number of uploads to run at once.
+@param overwrite: Whether to overwrite files that already exist.
+@param check_hashes: Whether the server should check the hash of every file.
+@param check_chunk_hashes: Whether the server should check the hash of each chunk.
+@param retries: The number of attempts to make for each chunk.
+@param progress: A function called with (bytes sent, total bytes) as the upload goes, or None.
+@param profiler: The profiler to record the timings in.
+@param tuner: An AutoTuner shared by all the large files, or None. Files up to its smallest chunk size go into batches.
+@param retry_budget: How many retries each large file may make over all its chunks, or None for the default.
+"""
+def upload_files(connection, files, chunk_size=DEFAULT_CHUNK_SIZE, threads=DEFAULT_THREADS, overwrite=False, check_hashes=False, check_chunk_hashes=False, retries=3, progress=None, profiler=NULL_PROFILER, tuner=None, retry_budget=None):
+    if tuner:
+        chunk_size = tuner.min_chunk_size
+    # In a cluster, a batch only holds files of one node, so the batches of all the nodes go at the same time.
+    batches_by_node = {}
+    batch_bytes = {}
+    large_files = []
+    total_size = 0
+    for filepath, filename in files:
+        size = os.path.getsize(filepath)
+        total_size += size
+        if size > chunk_size:
+            large_files.append((filepath, filename))
+            continue
+        node = connection.node_url(filename)
+        batches = batches_by_node.setdefault(node, [[]])
+        if len(batches[-1]) >= BATCH_MAX_FILES or (batches[-1] and batch_bytes.get(node, 0) + size > BATCH_MAX_BYTES):
+            batches.append([])
+            batch_bytes[node] = 0
+        batches[-1].append((filepath, filename))
+        batch_bytes[node] = batch_bytes.get(node, 0) + size
+    batches = [batch for round_batches in zip_longest(*batches_by_node.values()) for batch in round_batches if batch]
+
+    # Large files report their progress from the worker threads, so updates are passed on one at a time.
+    progress_lock = threading.Lock()
+    def report(sent):
+        if progress:
+            with progress_lock:
+                progress(sent, total_size)
+
+    def send_batch(batch):
+        batch_size = sum(os.path.getsize(filepath) for filepath, _ in batch)
+        with profiler.span("batch", size=batch_size):
+            response = put_batch(connection, batch, overwrite, check_hashes)
+        report(batch_size)
+        if response.get("error") and not response.get("results"):
+            return [(filename, response["error"]) for _, filename in batch]
+        return [(item["filename"], item["error"]) for item in response["results"] if item.get("error")]
+
+    def send_large_file(filepath, filename):
+        try:
+            upload_file(connection, filepath, filename, chunk_size, threads, overwrite, check_hashes, check_chunk_hashes, retries, lambda sent, total: report(sent), profiler, tuner, retry_budget)
+            return []
+        except UploadFailedException as e:
+            return [(filename, str(e))]
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(send_batch, batch): batch for batch in batches}
+        futures.update({executor.submit(send_large_file, filepath, filename): [(filepath, filename)] for filepath, filename in large_files})
+        for future in as_completed(futures):
+            try:
+                failures.extend(future.result())
+            except requests.RequestException as e:
+                failures.extend((filename, str(e)) for _, filename in futures[future])
+    return failures
 
-    # Split the file into chunks
-    with open(filename, "rb") as f:
-        for i in range(num_chunks):
-            start = i * chunk_size * 1024 * 1024
-            end = min(file_size, (i + 1) * chunk_size * 1024 * 1024)
-            chunk_data = data[start:end]
-            
-            # Hash each chunk if enabled
-            if use_chunk_hashes:
-                chunk_hash_obj = hashlib.sha256()
-                chunk_hash_obj.update(chunk_data)
-                chunk_hashes.append(chunk_hash_obj.hexdigest())
-
-            # Write the chunk to a file
-            with open(f"{chunk_output}/{filename}.{i}", "wb") as chunk_file:
-                chunk_file.write(chunk_data)
-
-    # Write chunk hashes to a .hashes file
-    if use_chunk_hashes:
-        with open(f"{chunk_output}/{filename}.hashes", "w") as hashes_file:
-            hashes_file.write("\n".join(chunk_hashes))
-
-    if DEBUG:
-        print(f"File {filename} has been split into {num_chunks} chunks.")
-    if use_hash:
-        if DEBUG:
-            print(f"Hash of file: {file_hash}")
-    if use_chunk_hashes:
-        if DEBUG:
-            print(f"Chunk hashes saved to {filename}.hashes.")\
+"""
+This function uploads a whole directory tree, keeping the folder structure on the server.
+Hidden files and folders (like the state of sync.py) are left out, as the server hides them anyway.
+Returns a list of (filename, error) pairs for the files that failed.
+@param connection: The connection to the server.
+@param dirpath: The path of the directory to upload.
+The other parameters are the same as for upload_files.
+"""
+def upload_directory(connection, dirpath, **kwargs):
+    base = os.path.dirname(os.path.abspath(dirpath))
+    files = []
+    for root, folders, names in os.walk(dirpath):
+        folders[:] = [name for name in folders if not name.startswith(".")]
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+            filepath = os.path.join(root, name)
+            files.append((filepath, os.path.relpath(os.path.abspath(filepath), base).replace(os.sep, "/")))
+    return upload_files(connection, files, **kwargs)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Upload a file to the server.")
-    parser.add_argument("filename", help="The name of the file to upload.")
-    parser.add_argument("--overwrite", action="store_true", help="Overwrite the file if it already exists.")
-    parser.add_argument("--username", help="The username of the user.")
-    parser.add_argument("--auth_token", help="The authentication token of the user.")
-    parser.add_argument("--server_url", help="The server URL.")
-    parser.add_argument("--chunk_size", type=int, default=5, help="The size of each chunk in MB.")
-    parser.add_argument("--check_hashes", action="store_true", help="Check the hash of the file.")
-    parser.add_argument("--check_chunk_hashes", action="store_true", help="Check the hash of each chunk.")
-    parser.add_argument("--rm", action="store_true", help="Remove the file after upload.")
-    parser.add_argument("--retries", type=int, default=3, help="The number of retries for each chunk.")
-    parser.add_argument("--debug", action="store_true", help="Enable debug mode.")
-
-    args = parser.parse_args()
-
-    USERNAME = args.username or os.getenv('C_DOWNLOADER_USERNAME')
-    AUTH_TOKEN = args.auth_token or os.getenv('C_DOWNLOADER_AUTH_TOKEN')
-    FILENAME = args.filename
-
-    FILENAME = os.path.basename(FILENAME)
+    # The arguments were read at the top.
+    FILEPATH = args.filename
+    FILENAME = os.path.basename(os.path.normpath(FILEPATH))
 
-    SERVER_URL = args.server_url or os.getenv('C_DOWNLOADER_SERVER_URL') or "http://localhost:5000"
-    CHUNK_SIZE = args.chunk_size
-    CHECK_HASHES = args.check_hashes
-    CHECK_CHUNK_HASHES = args.check_chunk_hashes
-    REMOVE_AFTER_UPLOAD = args.rm
-    RETRIES = args.retries
-    DEBUG = args.debug
-    OVERWRITE = args.overwrite
-
-    if not USERNAME or not AUTH_TOKEN:
-        print("Username and auth token must be provided either as arguments or environment variables. Please set ENV variables C_DOWNLOADER_USERNAME and C_DOWNLOADER_AUTH_TOKEN.")
+    connection = connection_from_args(args)
+    if connection is None:
+        print(MISSING_CREDENTIALS)
         sys.exit(1)
 
-    # Prepare the file for upload
-    unique_id = prepare_upload(FILENAME, OVERWRITE)
-    if not unique_id.startswith("C_"):
-        print(unique_id)
+    if not os.path.exists(FILEPATH):
+        print(f"File {FILEPATH} does not exist on your system.")
         sys.exit(1)
 
+    profiler = Profiler() if args.profile or args.trace else NULL_PROFILER
+    tuner = tuner_from_args(args.chunk_size, args.threads)
+    chunk_size = DEFAULT_CHUNK_SIZE if args.chunk_size == "auto" else int(float(args.chunk_size) * 1024 * 1024)
+    threads = DEFAULT_THREADS if args.threads == "auto" else int(args.threads)
+    options = dict(chunk_size=chunk_size, threads=threads, overwrite=args.overwrite, check_hashes=args.check_hashes, check_chunk_hashes=args.check_chunk_hashes, retries=args.retries, profiler=profiler, tuner=tuner, retry_budget=args.retry_budget)
+
+    """
+    This function prints the profile and writes the trace, if they were asked for.
+    """
+    def report_profile():
+        if profiler.enabled:
+            profiler.print_summary()
+        if args.trace:
+            profiler.write_trace(args.trace)
+            print(f"Trace written to {args.trace}")
+
+    if os.path.isdir(FILEPATH):
+        print(f"Uploading directory {FILENAME}")
+        with tqdm(total=0, desc="Uploading files", unit="B", unit_scale=True) as progress_bar:
+            failures = upload_directory(connection, FILEPATH, progress=progress_bar_callback(progress_bar), **options)
+        report_profile()
+        for filename, error in failures:
+            print(f"Upload failed for {filename}: {error}")
+        if failures:
+            sys.exit(1)
+        print(f"Saved on the server under {FILENAME}/")
+        if args.rm:
+            shutil.rmtree(FILEPATH)
+            print(f"Removed directory {FILEPATH}")
+        sys.exit(0)
+
     print(f"Uploading file {FILENAME}")
 
-    # Deconstruct the file into chunks
-    deconstruct_file(FILENAME, CHUNK_SIZE, unique_id, CHECK_HASHES, CHECK_CHUNK_HASHES)  # Use hash and chunk hashes
-
-    # Get the list of chunks
-    chunks = os.listdir(unique_id)
-    total_chunks = len(chunks)
-
-    # Track threads in a list
-    threads = []
-    exception_queue = queue.Queue()
-
-    # Create a progress bar
-    with tqdm(total=total_chunks, desc="Uploading chunks", unit="chunks") as progress_bar:
-        # Upload the file to the server
-        for chunk in chunks:
-            thread = threading.Thread(target=upload_file, args=(USERNAME, AUTH_TOKEN, f"{unique_id}/{chunk}", unique_id, progress_bar, CHECK_CHUNK_HASHES, RETRIES, exception_queue))
-            threads.append(thread)
-            thread.start()
-        
-        # Wait for all threads to finish
-        for thread in threads:
-            thread.join()  # Join only the threads you started, otherwise the program will hang
-
-    # Check for exceptions
-    while not exception_queue.empty():
-        exception = exception_queue.get()
-        print(f"Upload failed: {exception}")
-        cleanup_failed_upload(unique_id, USERNAME, AUTH_TOKEN)
+    try:
+        with tqdm(total=0, desc="Uploading chunks", unit="B", unit_scale=True) as progress_bar:
+            upload_file(connection, FILEPATH, FILENAME, progress=progress_bar_callback(progress_bar), **options)
+    except UploadFailedException as e:
+        print(f"Upload failed: {e}")
+        report_profile()
         sys.exit(1)
-
-    # Cleanup the temp folder
-    cleanup_upload(unique_id)
+    report_profile()
 
     print(f"Saved on the server as {FILENAME}")
 
-    if REMOVE_AFTER_UPLOAD:
-        os.remove(FILENAME)
-        print(f"Removed file {FILENAME}")
-
-    # Process the file on the server side
-    validation = process_file_server_side(USERNAME, AUTH_TOKEN, unique_id, FILENAME)
-    if(validation.get("error")):
-        print(f"Error validating file: {validation.get('error')}")
-    else:
-        if DEBUG:
-            print(f"File validated: {validation.get('success')}")
\ No newline at end of file
+    if args.rm:
+        os.remove(FILEPATH)
+        print(f"Removed file {FILEPATH}")
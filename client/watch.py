@@ -0,0 +1,311 @@
+# Watches a local folder and uploads new and changed files as soon as they are done being written.
+# On Linux the kernel reports the changes (inotify), so the folder is never rescanned. Elsewhere, or if inotify
+# can't be used, the folder is polled instead. A file is uploaded once it has seen no changes for a few seconds,
+# and the files that are ready at the same time go up together: small ones packed into batches, large ones as
+# resumable chunked uploads. Deleting a file here does not delete it on the server; use sync.py --delete for that.
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from connection import add_connection_arguments, connection_from_args, MISSING_CREDENTIALS
+from upload import upload_files, DEFAULT_THREADS
+from sync import sync_folder, remote_name, SyncFailedException
+
+# How long a file must see no changes before it is uploaded, in seconds.
+DEFAULT_SETTLE_SECONDS = 2
+# How often the folder is scanned when inotify can't be used, in seconds.
+DEFAULT_POLL_INTERVAL = 5
+# How many times a file that failed to upload is tried again before it is given up on (until it changes again).
+MAX_ATTEMPTS = 3
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+"""
+This function tells whether a path in the watched folder should be uploaded. Hidden files and folders (like the
+state of sync.py, or the swap files of editors) are left out, as the server hides them anyway.
+@param folder: The watched folder.
+@param path: The path.
+"""
+def is_watched(folder, path):
+    return not any(part.startswith(".") for part in os.path.relpath(path, folder).split(os.sep))
+
+"""
+Reports the files that change in a folder tree, using Linux inotify through ctypes.
+Raises OSError if inotify can't be used.
+"""
+class InotifyWatcher:
+    """
+    @param folder: The folder to watch, with all its subfolders.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        self.add_tree(folder)
+
+    def add_folder(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # A folder that is already gone again is fine, running out of watches is not.
+            if error == errno.ENOSPC:
+                raise OSError(error, "Out of inotify watches, raise fs.inotify.max_user_watches")
+            return
+        self.folders[wd] = folder
+
+    """
+    This function watches a folder and everything in it. Returns the files in it, which may have been written before the watch started.
+    @param folder: The folder.
+    """
+    def add_tree(self, folder):
+        files = []
+        for root, folders, names in os.walk(folder):
+            folders[:] = [name for name in folders if is_watched(self.folder, os.path.join(root, name))]
+            self.add_folder(root)
+            files.extend(os.path.join(root, name) for name in names)
+        return files
+
+    """
+    This function waits for changes. Returns the paths of the files that changed,
+    or None if the kernel dropped events, so the caller has to find the changes some other way.
+    @param timeout: How long to wait at most, in seconds.
+    """
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        changed = []
+        lost = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    lost = True
+                elif mask & IN_IGNORED:
+                    self.folders.pop(wd, None)
+                elif wd in self.folders:
+                    path = os.path.join(self.folders[wd], name)
+                    if mask & IN_ISDIR:
+                        # A new folder can have files in it before its watch is added, so they are reported too.
+                        if mask & (IN_CREATE | IN_MOVED_TO) and is_watched(self.folder, path):
+                            changed.extend(self.add_tree(path))
+                    else:
+                        changed.append(path)
+        return None if lost else changed
+
+    def close(self):
+        os.close(self.fd)
+
+"""
+Reports the files that change in a folder tree by scanning it every few seconds, for when inotify can't be used.
+"""
+class PollingWatcher:
+    """
+    @param folder: The folder to watch, with all its subfolders.
+    @param interval: How often to scan the folder, in seconds.
+    """
+    def __init__(self, folder, interval=DEFAULT_POLL_INTERVAL):
+        self.folder = folder
+        self.interval = interval
+        self.next_scan = time.monotonic() + interval
+        self.files = self.scan()
+
+    def scan(self):
+        files = {}
+        for root, folders, names in os.walk(self.folder):
+            folders[:] = [name for name in folders if not name.startswith(".")]
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    """
+    This function waits until the next scan is due, and returns the paths of the files that changed since the last one.
+    @param timeout: How long to wait at most, in seconds.
+    """
+    def wait(self, timeout):
+        delay = self.next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, delay))
+        self.next_scan = time.monotonic() + self.interval
+        files = self.scan()
+        changed = [path for path, stat in files.items() if self.files.get(path) != stat]
+        self.files = files
+        return changed
+
+    def close(self):
+        pass
+
+"""
+This function returns an InotifyWatcher for a folder, or a PollingWatcher if inotify can't be used.
+@param folder: The folder to watch.
+@param poll_interval: How often to scan the folder when polling, in seconds.
+@param poll: Whether to poll even if inotify could be used.
+"""
+def open_watcher(folder, poll_interval=DEFAULT_POLL_INTERVAL, poll=False):
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError) as e:
+            print(f"Can't use inotify ({e}), scanning the folder every {poll_interval} seconds instead.")
+    return PollingWatcher(folder, poll_interval)
+
+"""
+This function watches a folder and uploads new and changed files until stop is set.
+@param connection: The connection to the server.
+@param folder: The local folder.
+@param prefix: The folder on the server, or "" for the top.
+@param settle: How long a file must see no changes before it is uploaded, in seconds.
+@param threads: How many uploads to run at once.
+@param poll_interval: How often to scan the folder when inotify can't be used, in seconds.
+@param poll: Whether to poll even if inotify could be used.
+@param stop: A threading.Event that ends the watch when set, or None to watch forever.
+@param log: A function called with a message after every round of uploads.
+"""
+def watch_folder(connection, folder, prefix, settle=DEFAULT_SETTLE_SECONDS, threads=DEFAULT_THREADS, poll_interval=DEFAULT_POLL_INTERVAL, poll=False, stop=None, log=print):
+    stop = stop or threading.Event()
+    watcher = open_watcher(folder, poll_interval, poll)
+    # The time every file last changed, and how many times the ones that failed were tried.
+    pending = {}
+    attempts = {}
+
+    def upload_round(paths):
+        files = []
+        size = 0
+        for path in paths:
+            try:
+                if not os.path.isfile(path):
+                    continue
+                size += os.path.getsize(path)
+            except OSError:
+                # Gone (or moved away) since it changed. If it comes back, it is reported as changed again.
+                continue
+            files.append((path, remote_name(prefix, os.path.relpath(path, folder).replace(os.sep, "/"))))
+        if not files:
+            return []
+        start = time.monotonic()
+        failures = upload_files(connection, files, threads=threads, overwrite=True)
+        log(f"Uploaded {len(files) - len(failures)} of {len(files)} files ({size / (1024 * 1024):.2f} MB) in {time.monotonic() - start:.2f}s.")
+        failed = {filename for filename, _ in failures}
+        for filename, error in failures:
+            log(f"Failed: {filename}: {error}")
+        return [path for path, filename in files if filename in failed]
+
+    def catch_up():
+        # The kernel dropped events, so the folder is compared with the server instead, once.
+        log("Lost track of changes, comparing the folder with the server.")
+        try:
+            sync_folder(connection, folder, prefix, "push", threads=threads)
+        except SyncFailedException as e:
+            log(f"Failed to compare the folder with the server: {e}")
+        return []
+
+    # Uploads run one round at a time in the background, so changes keep being collected meanwhile.
+    running = None
+    running_paths = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            while not stop.is_set():
+                changed = watcher.wait(0.5)
+                now = time.monotonic()
+                if changed is None:
+                    changed = []
+                    executor.submit(catch_up)
+                for path in changed:
+                    if is_watched(folder, path):
+                        pending[path] = now
+                        attempts.pop(path, None)
+
+                if running is not None and running.done():
+                    try:
+                        failed = running.result()
+                    except Exception as e:
+                        # E.g. a file replaced or removed while it was being read. The watch goes on, and the round is tried again.
+                        log(f"Upload round failed: {type(e).__name__}: {e}")
+                        failed = running_paths
+                    for path in failed:
+                        attempts[path] = attempts.get(path, 0) + 1
+                        if attempts[path] < MAX_ATTEMPTS:
+                            pending.setdefault(path, now)
+                    running = None
+                if running is None:
+                    ready = [path for path, changed_at in pending.items() if now - changed_at >= settle]
+                    if ready:
+                        for path in ready:
+                            del pending[path]
+                        running = executor.submit(upload_round, ready)
+                        running_paths = ready
+        finally:
+            watcher.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch a folder and upload new and changed files as soon as they are written.")
+    parser.add_argument("folder", help="The local folder to watch.")
+    parser.add_argument("--remote", help="The folder on the server. Defaults to the name of the local folder, like uploading the folder does. Use \"\" for the top.")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SECONDS, help="How long a file must see no changes before it is uploaded, in seconds.")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="How many uploads to run at once.")
+    parser.add_argument("--poll", action="store_true", help="Scan the folder every few seconds instead of using inotify.")
+    parser.add_argument("--poll_interval", type=float, default=DEFAULT_POLL_INTERVAL, help="How often to scan the folder when polling, in seconds.")
+    parser.add_argument("--no_initial_sync", action="store_true", help="Don't upload the files that changed while nothing was watching before starting.")
+    add_connection_arguments(parser)
+
+    args = parser.parse_args()
+
+    connection = connection_from_args(args, pool_size=max(args.threads, 1) * 2)
+    if connection is None:
+        print(MISSING_CREDENTIALS)
+        sys.exit(1)
+    if not os.path.isdir(args.folder):
+        print(f"Folder {args.folder} does not exist.")
+        sys.exit(1)
+
+    prefix = (args.remote if args.remote is not None else os.path.basename(os.path.abspath(args.folder))).strip("/")
+    if not args.no_initial_sync:
+        try:
+            plan = sync_folder(connection, args.folder, prefix, "push", threads=args.threads)
+            print(f"Uploaded {len(plan['upload'])} files that changed while nothing was watching.")
+        except SyncFailedException as e:
+            print(e)
+            sys.exit(1)
+
+    print(f"Watching {args.folder}. Press Ctrl+C to stop.")
+    try:
+        watch_folder(connection, args.folder, prefix, args.settle, args.threads, args.poll_interval, args.poll)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
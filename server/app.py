@@ -1,5 +1,5 @@
 # Flask app for accepting the files and returning the results.
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 import os
 import sys
@@ -7,6 +7,20 @@ import hashlib
 import shutil
 import dotenv
 import json
+import metrics
+import usage
+import hashcache
+import storage
+import cluster
+import versions
+import requests
+import math
+import secrets
+import tarfile
+import threading
+import time
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
 dotenv.load_dotenv()
 
@@ -25,6 +39,32 @@ except Exception as e:
 
 print("Users loaded.")
 
+#The "QUOTAS" variable can hold a JSON object with the most bytes each user may store, e.g. {"alice": 10000000000}.
+#Users that are not in it get DEFAULT_QUOTA, and without either there is no limit.
+try:
+    QUOTAS = json.loads(os.getenv("QUOTAS") or "{}")
+    DEFAULT_QUOTA = int(os.getenv("DEFAULT_QUOTA")) if os.getenv("DEFAULT_QUOTA") else None
+except Exception as e:
+    print("Error parsing quotas: " + str(e))
+    sys.exit(1)
+
+#Cluster mode: the "CLUSTER_NODES" variable can hold a JSON list of the URLs of all the server nodes, e.g. ["http://10.0.0.1:5000", "http://10.0.0.2:5000"],
+#and "NODE_URL" the URL of this node as it is written in that list. Every node then only stores the files that hash to it (see cluster.py),
+#and clients send the requests for a file straight to its node. Any node answers list, usage and batch requests for the whole cluster
+#by asking the other nodes. All nodes need the same USERS and CLUSTER_NODES.
+try:
+    CLUSTER_NODES = [node.rstrip("/") for node in json.loads(os.getenv("CLUSTER_NODES") or "[]")]
+except Exception as e:
+    print("Error parsing cluster nodes: " + str(e))
+    sys.exit(1)
+NODE_URL = (os.getenv("NODE_URL") or "").rstrip("/")
+RING = None
+if CLUSTER_NODES:
+    if NODE_URL not in CLUSTER_NODES:
+        print("NODE_URL must be set to the URL of this node, as it is written in CLUSTER_NODES.")
+        sys.exit(1)
+    RING = cluster.HashRing(CLUSTER_NODES)
+PEERS = [node for node in CLUSTER_NODES if node != NODE_URL]
 
 
 app = Flask(__name__)
@@ -32,20 +72,366 @@ CORS(app)
 
 # This operates on a user system, so each user gets a folder with their files.
 # The "uploads" folder contains all the files uploaded by all users.
-UPLOAD_FOLDER = "uploads"
+# It can be moved with the UPLOAD_FOLDER variable in the ENV.
+# To use several disks, the STORAGE_ROOTS variable can list a folder on each of them instead, as a JSON list.
+# Every root holds part of the files, and the first one is also used as the UPLOAD_FOLDER.
+#
+# How the files are laid out in every root is set with the STORAGE_LAYOUT variable in the ENV:
+# "flat" keeps every user's files in uploads/<userid>/, "sharded" spreads them over hash-prefix subfolders
+# so no folder gets too big. Use migrate.py to move existing files from one layout to the other. See storage.py.
+try:
+    STORAGE = storage.open_pool(storage.roots_from_env(), os.getenv("STORAGE_LAYOUT", "flat"))
+except (storage.StorageLayoutError, ValueError) as e:
+    print("Error opening storage: " + str(e))
+    sys.exit(1)
+UPLOAD_FOLDER = STORAGE.primary.root
+
+# Upload sessions live outside the user folders, since chunk requests only carry the session ID.
+# Every root has its own, so the chunks of a file are written to the disk the file ends up on.
+SESSION_FOLDERS = [os.path.join(root.root, ".sessions") for root in STORAGE.roots]
+
+# The chunks of legacy /upload uploads wait here (per user and tempid) until /process, also outside the user folders.
+TEMP_FOLDER = os.path.join(UPLOAD_FOLDER, ".temp")
+
+# How long a node waits for another node to answer, in seconds.
+CLUSTER_TIMEOUT = 30
+# How long a node trusts what the other nodes said a user stores, for quotas, in seconds.
+CLUSTER_USAGE_TTL = int(os.getenv("CLUSTER_USAGE_TTL", 30))
+# The chunk size used to move a file to another node when it is renamed to a name owned by that node.
+NODE_COPY_CHUNK_SIZE = (1024 * 1024) * 16  # 16 MB
+
+# Upload sessions and legacy temp folders that see no activity for this long are removed by the reaper, in seconds.
+TEMP_TTL = int(os.getenv("TEMP_TTL", 60 * 60 * 24))
+# How often the reaper runs, in seconds. It also saves the usage counters.
+REAPER_INTERVAL = int(os.getenv("REAPER_INTERVAL", 60 * 10))
+# How often the usage counters are rebuilt from the disk, in case they drifted (e.g. after a crash), in seconds.
+USAGE_RECOUNT_INTERVAL = int(os.getenv("USAGE_RECOUNT_INTERVAL", 60 * 60 * 24))
+
+# Limits for the chunk size a client can ask for when starting an upload session.
+DEFAULT_CHUNK_SIZE = (1024 * 1024) * 5  # 5 MB
+MIN_CHUNK_SIZE = 1024 * 64  # 64 KB
+MAX_CHUNK_SIZE = (1024 * 1024) * 100  # 100 MB
+
+# How much data is read or written at a time when streaming chunks to and from disk.
+COPY_BUFFER_SIZE = 1024 * 1024  # 1 MB
+
+# The most files a single /put_batch request may contain.
+MAX_BATCH_FILES = 10000
+
+# The most operations a single /batch request may contain.
+MAX_BATCH_OPERATIONS = 10000
+
+# The chunk size /manifest lists the chunk hashes of a file in, when the client does not ask for another one.
+MANIFEST_CHUNK_SIZE = (1024 * 1024) * 4  # 4 MB
+
+# With VERSIONS_KEEP set, overwriting or deleting a file keeps the old file as a version, up to that many per file.
+# Old versions are split into chunks in the background, and chunks that several versions share are stored once,
+# so keeping many versions of a big file that changes a little costs only the changed chunks. See versions.py.
+# Versions don't count towards the quota.
+VERSIONS_KEEP = int(os.getenv("VERSIONS_KEEP", 0))
+VERSIONS = versions.VersionStore(UPLOAD_FOLDER) if VERSIONS_KEEP > 0 else None
+# How often new versions are split into chunks, and chunks no version uses anymore are removed, in seconds.
+VERSIONS_COMPACT_INTERVAL = int(os.getenv("VERSIONS_COMPACT_INTERVAL", 60))
+
+"""
+This function returns the total size of the files in a folder and all its subfolders.
+@param folder: The folder to measure.
+@param skip_hidden: Whether to leave out files and folders starting with a dot, like the temporary files of uploads.
+"""
+def folder_size(folder, skip_hidden=False):
+    total = 0
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if skip_hidden and entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    total += folder_size(entry.path, skip_hidden)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+    except FileNotFoundError:
+        pass
+    return total
+
+"""
+This function counts the upload sessions that are still in progress.
+"""
+def count_sessions():
+    return sum(len(subfolders(folder)) for folder in SESSION_FOLDERS)
+
+# Everything /metrics reports. Latency is measured until the response starts, so it doesn't include streaming a download.
+METRICS = metrics.Registry()
+REQUESTS = METRICS.counter("mcs_requests_total", "Requests handled, by route, method and status.")
+REQUEST_LATENCY = METRICS.histogram("mcs_request_duration_seconds", "Time until the response starts, by route.")
+BYTES_RECEIVED = METRICS.counter("mcs_received_bytes_total", "Request body bytes received, by route.")
+BYTES_SENT = METRICS.counter("mcs_sent_bytes_total", "Response body bytes sent, by route.")
+PROCESS_SECONDS = METRICS.counter("mcs_process_seconds_total", "Time spent putting uploaded files together, by phase (hash or copy).")
+HASH_MISMATCHES = METRICS.counter("mcs_hash_mismatches_total", "Uploads rejected because a hash did not match, by kind (chunk or file).")
+METRICS.gauge("mcs_active_upload_sessions", "Upload sessions in progress.", count_sessions)
+METRICS.gauge("mcs_temp_bytes", "Bytes on disk used by uploads in progress.", lambda: sum(folder_size(folder) for folder in SESSION_FOLDERS + STORAGE.temp_folders) + folder_size(TEMP_FOLDER))
+ROOT_FREE_BYTES = METRICS.gauge("mcs_root_free_bytes", "Free space on the disk of every storage root.")
+ROOT_ACTIVE = METRICS.gauge("mcs_root_active_transfers", "Reads and writes going on in every storage root.")
+REAPED = METRICS.counter("mcs_reaped_total", "Abandoned temporary folders and files removed by the reaper, by kind (session, upload or file).")
+NOT_MODIFIED = METRICS.counter("mcs_not_modified_total", "Requests answered with 304 Not Modified because the client already had the file, by route.")
+VERSION_BYTES = METRICS.gauge("mcs_version_bytes", "Bytes taken by old versions of files, after deduplication.", lambda: VERSIONS.stored_bytes() if VERSIONS else 0)
+
+# How many bytes every user has stored, updated as files change. See usage.py.
+USAGE = usage.UsageTracker(os.path.join(UPLOAD_FOLDER, ".usage.json"))
+
+# The hashes of the stored files, so they are only worked out again when a file changes. See hashcache.py.
+HASHES = hashcache.HashCache()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    REQUEST_LATENCY.observe(time.perf_counter() - g.request_start, route=route)
+    if request.content_length:
+        BYTES_RECEIVED.inc(request.content_length, route=route)
+    if response.is_streamed:
+        response.response = count_sent_bytes(response.response, route)
+    else:
+        BYTES_SENT.inc(response.content_length or 0, route=route)
+    return response
+
+"""
+This function passes a streamed response through, counting the bytes as they are sent.
+@param iterable: The body of the response.
+@param route: The route the response is for.
+"""
+def count_sent_bytes(iterable, route):
+    try:
+        for data in iterable:
+            BYTES_SENT.inc(len(data), route=route)
+            yield data
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
 
 def authorize_user(userid, auth_token):
     if userid not in USERS:
         return False
     return USERS[userid] == auth_token
 
+# Requests between nodes carry this header, so a node answers them for itself only instead of asking the other nodes again.
+PEER_HEADER = "X-Cluster-Local"
+PEER_SESSION = requests.Session()
+# What the other nodes store for every user, as (when it was asked, bytes), so quotas count the whole cluster.
+PEER_USAGE = {}
+
+def from_peer():
+    return request.headers.get(PEER_HEADER) == "true"
+
+"""
+This function checks whether a file belongs to this node. Returns None if so (or if there is no cluster),
+otherwise the response that tells the client which node to send the request to.
+@param userid: The ID of the user.
+@param filename: The name of the file.
+"""
+def wrong_node(userid, filename):
+    if RING is None:
+        return None
+    owner = RING.node_for(userid, filename)
+    if owner == NODE_URL:
+        return None
+    return jsonify({"error": f"File belongs to node {owner}", "node": owner}), 421
+
+"""
+This function sends a request to several nodes at once and returns their answers as (status code, JSON) by node.
+Raises requests.RequestException if a node can't be reached.
+@param route: The route, e.g. "list".
+@param data_by_node: The form data to send to every node, by node URL.
+"""
+def ask_nodes(route, data_by_node):
+    def ask(node):
+        response = PEER_SESSION.post(f"{node}/{route}", data=data_by_node[node], headers={PEER_HEADER: "true"}, timeout=CLUSTER_TIMEOUT)
+        return response.status_code, response.json()
+
+    if not data_by_node:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(data_by_node)) as executor:
+        return dict(zip(data_by_node, executor.map(ask, data_by_node)))
+
+"""
+This function sends the same request to every other node, for a question about the whole cluster.
+@param route: The route, e.g. "list".
+@param data: The form data to send.
+"""
+def ask_peers(route, data):
+    return ask_nodes(route, {peer: data for peer in PEERS})
+
+"""
+This function asks the other nodes how much a user stores there, if the last answer is older than CLUSTER_USAGE_TTL seconds.
+If a node can't be reached, the last answer is kept.
+@param userid: The ID of the user.
+@param auth_token: The authentication token of the user, to ask the other nodes with.
+"""
+def refresh_peer_usage(userid, auth_token):
+    if not PEERS or from_peer() or time.time() - PEER_USAGE.get(userid, (0, 0))[0] < CLUSTER_USAGE_TTL:
+        return
+    try:
+        answers = ask_peers("usage", {"userid": userid, "auth_token": auth_token})
+        PEER_USAGE[userid] = (time.time(), sum(answer.get("usage", 0) for _, answer in answers.values()))
+    except (requests.RequestException, ValueError):
+        pass
+
+"""
+This function moves a file of a user to the node its new name belongs to, when it is renamed, using an upload session there.
+Returns None on success, otherwise the error message. The file is left in place either way.
+@param node: The URL of the node.
+@param userid: The ID of the user.
+@param auth_token: The authentication token of the user.
+@param file_path: The file.
+@param new_filename: The new name of the file.
+@param overwrite: Whether to replace a file that already has the new name.
+"""
+def send_to_node(node, userid, auth_token, file_path, new_filename, overwrite):
+    credentials = {"userid": userid, "auth_token": auth_token}
+    size = file_size(file_path)
+    response = PEER_SESSION.post(f"{node}/begin", data=dict(credentials, filename=new_filename, size=size, chunk_size=NODE_COPY_CHUNK_SIZE, overwrite=str(bool(overwrite)).lower()), headers={PEER_HEADER: "true"}, timeout=CLUSTER_TIMEOUT)
+    result = response.json()
+    if "error" in result or result.get("complete"):
+        return result.get("error")
+
+    with open(file_path, "rb") as f:
+        for index in range(result["num_chunks"]):
+            data = f.read(result["chunk_size"])
+            response = PEER_SESSION.post(f"{node}/chunk/{result['session']}/{index}", data=data, headers={PEER_HEADER: "true"}, timeout=CLUSTER_TIMEOUT)
+            chunk_result = response.json()
+            if "error" in chunk_result:
+                PEER_SESSION.post(f"{node}/abort", data={"session": result["session"]}, headers={PEER_HEADER: "true"}, timeout=CLUSTER_TIMEOUT)
+                return chunk_result["error"]
+    return None
+
+"""
+This function keeps a file of a user as an old version, if versions are kept, and removes the oldest versions beyond VERSIONS_KEEP.
+@param userid: The ID of the user.
+@param filename: The name of the file.
+@param path: The file. Nothing is kept if there is no file.
+@param move: Whether to move the file away instead of linking it, for a file that is being deleted or written in place.
+"""
+def keep_version(userid, filename, path, move=False):
+    if VERSIONS is None or not os.path.isfile(path):
+        return
+    VERSIONS.keep(userid, filename, path, STORAGE.root_of(path).root, move)
+    VERSIONS.prune(userid, filename, VERSIONS_KEEP)
+
+"""
+This function removes a file of a user and updates the usage of the user.
+@param userid: The ID of the user.
+@param file_path: The file.
+@param filename: The name of the file, to keep it as an old version, or None if it is not really gone (e.g. moved to another node).
+"""
+def remove_user_file(userid, file_path, filename=None):
+    size = file_size(file_path)
+    if filename is not None and VERSIONS is not None:
+        keep_version(userid, filename, file_path, move=True)
+    else:
+        os.remove(file_path)
+    STORAGE.forget(userid, file_path)
+    USAGE.add(userid, -size)
+
+"""
+This function checks whether a user may store more bytes. Returns None if so, otherwise the error message.
+Making a file smaller is always allowed, even over the quota.
+@param userid: The ID of the user.
+@param extra_bytes: How many bytes the user would store on top of what they have now.
+"""
+def quota_error(userid, extra_bytes):
+    quota = QUOTAS.get(userid, DEFAULT_QUOTA)
+    if quota is None or extra_bytes <= 0:
+        return None
+    used = USAGE.get(userid) + PEER_USAGE.get(userid, (0, 0))[1]
+    if used + extra_bytes > quota:
+        return f"Quota exceeded: {used} of {quota} bytes used, {extra_bytes} more needed"
+    return None
+
+"""
+This function returns the size of a file, or 0 if there is no file.
+@param path: The path of the file.
+"""
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+"""
+This function reads a number of bytes (a size, offset or length) from the form of the request.
+Returns the default if the field is missing, and raises ValueError if it is not a whole number of 0 or more.
+@param name: The name of the field.
+@param default: What to return if the field is missing.
+"""
+def form_bytes(name, default=None):
+    value = request.form.get(name)
+    if value is None:
+        return default
+    number = int(value)
+    if number < 0:
+        raise ValueError(f"{name} can't be negative")
+    return number
+
+"""
+This function moves a finished file into its place in the users folder, and updates the usage of the user.
+@param userid: The ID of the user.
+@param source_path: The finished file.
+@param output_path: Where the file goes. A file already there is replaced.
+@param filename: The name of the file, to keep the file that is replaced as an old version.
+@param file_hash: The hash of the finished file if it was checked, so it does not have to be worked out again.
+"""
+def replace_user_file(userid, source_path, output_path, filename=None, file_hash=None):
+    delta = file_size(source_path) - file_size(output_path)
+    if filename is not None:
+        keep_version(userid, filename, output_path)
+    STORAGE.move(source_path, output_path)
+    USAGE.add(userid, delta)
+    if file_hash:
+        HASHES.remember(output_path, file_hash)
+
 @app.route("/status", methods=["GET"])
 def status():
     return jsonify({"status": "OK"})
 
+# Tells clients which nodes the cluster has, so they can build the same hash ring and send the requests for a file to its node.
+@app.route("/cluster", methods=["GET"])
+def cluster_endpoint():
+    if RING is None:
+        return jsonify({"error": "Not in cluster mode"}), 404
+    return jsonify({"nodes": RING.nodes, "vnodes": RING.vnodes, "node": NODE_URL})
+
+@app.route("/usage", methods=["POST"])
+def usage_endpoint():
+    userid = request.form["userid"]
+    auth_token = request.form["auth_token"]
+
+    # Check if the user is authenticated
+    if not authorize_user(userid, auth_token):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    used = USAGE.get(userid)
+    if PEERS and not from_peer():
+        try:
+            answers = ask_peers("usage", request.form.to_dict())
+        except (requests.RequestException, ValueError) as e:
+            return jsonify({"error": "Error asking the other nodes: " + str(e)}), 502
+        used += sum(answer.get("usage", 0) for _, answer in answers.values())
+    return jsonify({"usage": used, "quota": QUOTAS.get(userid, DEFAULT_QUOTA)})
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    for root, free in STORAGE.free_space().items():
+        ROOT_FREE_BYTES.set(free, root=root)
+        ROOT_ACTIVE.set(STORAGE.active[root], root=root)
+    return app.response_class(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
 # When a user uploads a file, it will contain a "tempid" field.
 # This tempid is used as the folder name for the user while the file is being processed.
 # Then, once the file is processed, the file is saved in the users folder with the proper filename, and the tempid folder is deleted.
+# The tempid folders are kept under TEMP_FOLDER, so the reaper can remove the ones that are abandoned.
 @app.route("/upload", methods=["POST"])
 def upload():
     if "file" not in request.files:
@@ -66,13 +452,8 @@ def upload():
     if not authorize_user(userid, auth_token):
         return jsonify({"error": "Unauthorized"})
     
-    # Create a folder for the user if it doesn't exist
-    user_folder = f"{UPLOAD_FOLDER}/{userid}"
-    if not os.path.exists(user_folder):
-        os.makedirs(user_folder)
-
     # Check if the tempid folder exists
-    temp_folder = f"{UPLOAD_FOLDER}/{userid}/{tempid}"
+    temp_folder = legacy_temp_folder(userid, tempid)
     if not os.path.exists(temp_folder):
         os.makedirs(temp_folder)
 
@@ -85,15 +466,72 @@ def upload():
                 file_hash_obj.update(data)
                 file_hash = file_hash_obj.hexdigest()
             if file_hash != chunk_hash:
+                HASH_MISMATCHES.inc(kind="chunk")
                 return jsonify({"error": "File hash mismatch!"})
         return jsonify({"success": "File uploaded"})
     except Exception as e:
         return jsonify({"error": "Error saving file: " + str(e)})
 
 
+"""
+This function returns the folder the chunks of a legacy upload wait in until /process.
+@param userid: The ID of the user.
+@param tempid: The tempid of the upload.
+"""
+def legacy_temp_folder(userid, tempid):
+    return os.path.join(TEMP_FOLDER, userid, tempid)
+
 def check_file_exists(userid, filename):
-    file_path = os.path.join(UPLOAD_FOLDER, userid, filename)
-    return os.path.exists(file_path)
+    return STORAGE.exists(userid, filename)
+
+"""
+This function returns where a file of a user is stored, or None if the filename would escape the users folder.
+Filenames can contain folders (e.g. "photos/cat.png") when a whole directory is uploaded.
+@param userid: The ID of the user.
+@param filename: The name of the file.
+"""
+def user_file_path(userid, filename):
+    return STORAGE.file_path(userid, filename)
+
+"""
+This function writes a stream to a file of a user, replacing the file in one step once all the data is there.
+Returns None on success, otherwise the error message.
+@param userid: The ID of the user, whose quota and usage the file counts towards.
+@param stream: The file-like object to read the data from.
+@param output_path: Where to save the file.
+@param expected_hash: The hash the data should have, or None to skip the check.
+@param filename: The name of the file, to keep the file that is replaced as an old version.
+"""
+def save_stream(userid, stream, output_path, expected_hash=None, filename=None):
+    output_folder = os.path.dirname(output_path)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+
+    temp_path = STORAGE.temp_path(near=output_path)
+    file_hash_obj = hashlib.sha256() if expected_hash else None
+    try:
+        with STORAGE.io(temp_path), open(temp_path, "wb") as f:
+            while True:
+                data = stream.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                if file_hash_obj:
+                    file_hash_obj.update(data)
+                f.write(data)
+        if file_hash_obj and file_hash_obj.hexdigest() != expected_hash:
+            os.remove(temp_path)
+            HASH_MISMATCHES.inc(kind="file")
+            return "File hashes do not match!"
+        error = quota_error(userid, file_size(temp_path) - file_size(output_path))
+        if error:
+            os.remove(temp_path)
+            return error
+        replace_user_file(userid, temp_path, output_path, filename, expected_hash)
+        return None
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return "Error saving file: " + str(e)
 
 @app.route("/id", methods=["POST"])
 def check_id():
@@ -108,9 +546,14 @@ def check_id():
     # Check if the user is authenticated
     if not authorize_user(userid, auth_token):
         return jsonify({"error": "Unauthorized"})
+
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
     
     # Check if the tempid folder exists
-    temp_folder = f"{UPLOAD_FOLDER}/{userid}/{tempid}"
+    temp_folder = legacy_temp_folder(userid, tempid)
     if not os.path.exists(temp_folder):
         if not check_file_exists(userid, filename):
             return jsonify({"success": "ID is unique"})
@@ -132,9 +575,15 @@ def process_file():
     # Check if the user is authenticated
     if not authorize_user(userid, auth_token):
         return jsonify({"error": "Unauthorized"})
+
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, output_file)
+    if error:
+        return error
+    refresh_peer_usage(userid, auth_token)
     
     # Check if the tempid folder exists
-    temp_folder = f"{UPLOAD_FOLDER}/{userid}/{tempid}"
+    temp_folder = legacy_temp_folder(userid, tempid)
     if not os.path.exists(temp_folder):
         return jsonify({"error": "Temp folder does not exist"})
     
@@ -166,34 +615,66 @@ def process_file():
             return jsonify({"error": "Hashes file does not exist"})
     
     # Process the files (reconstruct the file)
+    hash_seconds = 0
+    start = time.perf_counter()
+    temp_path = None
     try:
         chunks = [chunk for chunk in files if not chunk.endswith(".hash") and not chunk.endswith(".hashes")]
         chunks.sort(key=lambda x: int(x.split(".")[-1]))
 
-        with open(f"{UPLOAD_FOLDER}/{userid}/{output_file}", "wb") as f:
+        output_path = user_file_path(userid, output_file)
+        if output_path is None:
+            return jsonify({"error": "Invalid filename"}), 400
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        old_size = file_size(output_path)
+        error = quota_error(userid, sum(file_size(f"{temp_folder}/{chunk}") for chunk in chunks) - old_size)
+        if error:
+            return jsonify({"error": error}), 413
+
+        # The file is put together next to the old one, which stays in place until the new one is verified.
+        temp_path = STORAGE.temp_path(near=output_path)
+        error = None
+        with open(temp_path, "wb") as f:
             for i, chunk in enumerate(chunks):
                 with open(f"{temp_folder}/{chunk}", "rb") as chunk_file:
                     chunk_data = chunk_file.read()
 
-                    # Verify chunk hash if enabled
-                    if check_chunk_hashes:
-                        chunk_hash_obj = hashlib.sha256()
-                        chunk_hash_obj.update(chunk_data)
-                        chunk_hash = chunk_hash_obj.hexdigest()
-                        if chunk_hashes and chunk_hash != chunk_hashes[i]:
-                            return jsonify({"error": f"Chunk {i} hash mismatch! Expected {chunk_hashes[i]}, got {chunk_hash}."})
+                # Verify chunk hash if enabled
+                if check_chunk_hashes:
+                    hash_start = time.perf_counter()
+                    chunk_hash_obj = hashlib.sha256()
+                    chunk_hash_obj.update(chunk_data)
+                    chunk_hash = chunk_hash_obj.hexdigest()
+                    hash_seconds += time.perf_counter() - hash_start
+                    if chunk_hashes and chunk_hash != chunk_hashes[i]:
+                        HASH_MISMATCHES.inc(kind="chunk")
+                        error = f"Chunk {i} hash mismatch! Expected {chunk_hashes[i]}, got {chunk_hash}."
+                        break
 
-                    f.write(chunk_data)
+                f.write(chunk_data)
 
         # Verify file-wide hash
-        if check_hash and hash_value:
-            with open(f"{UPLOAD_FOLDER}/{userid}/{output_file}", "rb") as f:
+        if error is None and check_hash and hash_value:
+            with open(temp_path, "rb") as f:
                 data = f.read()
+                hash_start = time.perf_counter()
                 file_hash_obj = hashlib.sha256()
                 file_hash_obj.update(data)
                 file_hash = file_hash_obj.hexdigest()
+                hash_seconds += time.perf_counter() - hash_start
                 if file_hash != hash_value:
-                    return jsonify({"error": "File hashes do not match!"})
+                    HASH_MISMATCHES.inc(kind="file")
+                    error = "File hashes do not match!"
+
+        if error:
+            # The broken file is thrown away, and the old file and the usage are left as they were.
+            os.remove(temp_path)
+            return jsonify({"error": error})
+        # Only a verified file replaces the old one (kept as a version) and counts towards the usage.
+        replace_user_file(userid, temp_path, output_path, output_file, hash_value if check_hash else None)
+
+        PROCESS_SECONDS.inc(hash_seconds, phase="hash")
+        PROCESS_SECONDS.inc(time.perf_counter() - start - hash_seconds, phase="copy")
 
         # Remove the temp folder
         #While the folder exists
@@ -203,6 +684,8 @@ def process_file():
         
         return jsonify({"success": "Files processed"})
     except Exception as e:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
         return jsonify({"error": "Error processing files: " + str(e)})
     
 
@@ -218,7 +701,7 @@ def cleanup():
         return jsonify({"error": "Unauthorized"})
     
     # Check if the tempid folder exists
-    temp_folder = f"{UPLOAD_FOLDER}/{userid}/{tempid}"
+    temp_folder = legacy_temp_folder(userid, tempid)
     if not os.path.exists(temp_folder):
         return jsonify({"error": "Temp folder does not exist"})
     
@@ -226,52 +709,463 @@ def cleanup():
     shutil.rmtree(temp_folder)
     return jsonify({"success": "Temp folder removed"})
 
+"""
+This function returns the folder of an upload session, or None if the session ID is not valid.
+Session IDs are generated by the server, so anything that is not a hex token is rejected.
+@param session_id: The ID of the upload session.
+"""
+def session_folder(session_id):
+    if not session_id or any(c not in "0123456789abcdef" for c in session_id):
+        return None
+    for folder in SESSION_FOLDERS:
+        if os.path.isdir(os.path.join(folder, session_id)):
+            return os.path.join(folder, session_id)
+    return None
+
+"""
+This function loads the metadata of an upload session.
+Returns the session folder and the session metadata, or (None, None) if the session does not exist.
+@param session_id: The ID of the upload session.
+"""
+def load_session(session_id):
+    folder = session_folder(session_id)
+    if folder is None:
+        return None, None
+    try:
+        with open(os.path.join(folder, "session.json"), "r") as f:
+            return folder, json.load(f)
+    except (OSError, ValueError):
+        return None, None
+
+"""
+This function lists the chunks that have been fully received for an upload session.
+Chunks are written to a temporary name first, so only complete chunks show up here.
+@param folder: The folder of the upload session.
+"""
+def present_chunks(folder):
+    return sorted(int(name) for name in os.listdir(folder) if name.isdigit())
+
+"""
+This function builds the response describing an upload session to the client.
+@param session_id: The ID of the upload session.
+@param session: The session metadata.
+@param present: The indexes of the chunks the server already has.
+@param message: The success message to send.
+"""
+def session_plan(session_id, session, present, message):
+    plan = {
+        "success": message,
+        "session": session_id,
+        "chunk_size": session["chunk_size"],
+        "num_chunks": session["num_chunks"],
+        "present": present,
+    }
+    # In a cluster, the chunks have to go to the node that has the session
+    if RING:
+        plan["node"] = NODE_URL
+    return plan
+
+"""
+This function reassembles the chunks of an upload session into the users folder.
+Several chunk requests can see the last chunk arrive at the same time, so only the request that
+manages to create the commit marker does the work; the others just report their chunk as uploaded.
+@param session: The session metadata.
+@param folder: The folder of the upload session.
+"""
+def finalize_session(session, folder):
+    try:
+        os.close(os.open(os.path.join(folder, ".commit"), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return jsonify({"success": "Chunk uploaded"})
+
+    # The file goes on the root the chunks are on, unless it already exists somewhere else.
+    output_path = STORAGE.file_path(session["userid"], session["filename"], near=folder)
+    if not os.path.exists(os.path.dirname(output_path)):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    if not session["overwrite"] and os.path.exists(output_path):
+        shutil.rmtree(folder)
+        return jsonify({"error": "File already exists"})
+    error = quota_error(session["userid"], session["size"] - file_size(output_path))
+    if error:
+        shutil.rmtree(folder)
+        return jsonify({"error": error}), 413
+
+    hash_seconds = 0
+    start = time.perf_counter()
+    try:
+        file_hash_obj = hashlib.sha256() if session["hash"] else None
+        if session["num_chunks"] == 1 and not file_hash_obj:
+            # Nothing to join or verify, so the chunk becomes the file as-is.
+            assembled_path = os.path.join(folder, "0")
+        else:
+            assembled_path = os.path.join(folder, "assembled")
+            with STORAGE.io(folder), open(assembled_path, "wb") as output_file:
+                for index in range(session["num_chunks"]):
+                    with open(os.path.join(folder, str(index)), "rb") as chunk_file:
+                        while True:
+                            data = chunk_file.read(COPY_BUFFER_SIZE)
+                            if not data:
+                                break
+                            if file_hash_obj:
+                                hash_start = time.perf_counter()
+                                file_hash_obj.update(data)
+                                hash_seconds += time.perf_counter() - hash_start
+                            output_file.write(data)
+
+        if file_hash_obj and file_hash_obj.hexdigest() != session["hash"]:
+            shutil.rmtree(folder)
+            HASH_MISMATCHES.inc(kind="file")
+            return jsonify({"error": "File hashes do not match!"})
+
+        replace_user_file(session["userid"], assembled_path, output_path, session["filename"], session["hash"])
+        copy_seconds = time.perf_counter() - start - hash_seconds
+        PROCESS_SECONDS.inc(hash_seconds, phase="hash")
+        PROCESS_SECONDS.inc(copy_seconds, phase="copy")
+        shutil.rmtree(folder)
+        # The timings let a profiling client see how long the server spent putting the file together.
+        return jsonify({"success": "File uploaded", "complete": True, "timings": {"hash": hash_seconds, "copy": copy_seconds}})
+    except Exception as e:
+        shutil.rmtree(folder, ignore_errors=True)
+        return jsonify({"error": "Error processing files: " + str(e)})
+
+# Starting an upload creates a session on the server and returns its ID along with the chunk plan.
+# The chunk requests only reference the session, and the file is put together as soon as the last chunk arrives,
+# so a file that fits in one chunk takes two requests in total.
+# Passing the ID of an earlier session resumes it, and the "present" list tells the client which chunks it can skip.
+@app.route("/begin", methods=["POST"])
+def begin_upload():
+    userid = request.form["userid"]
+    auth_token = request.form["auth_token"]
+    filename = request.form["filename"]
+    overwrite = request.form.get("overwrite", "false").lower() == "true"
+    file_hash = request.form.get("hash") or None
+
+    # Check if the user is authenticated
+    if not authorize_user(userid, auth_token):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        size = form_bytes("size")
+        chunk_size = form_bytes("chunk_size", DEFAULT_CHUNK_SIZE)
+    except ValueError:
+        return jsonify({"error": "Invalid size or chunk size"}), 400
+    if size is None:
+        return jsonify({"error": "Invalid size or chunk size"}), 400
+
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
+    refresh_peer_usage(userid, auth_token)
+
+    # Resume the previous session if it is still around and is for the same file
+    session_id = request.form.get("session")
+    if session_id:
+        folder, session = load_session(session_id)
+        if session and session["userid"] == userid and session["filename"] == filename and session["size"] == size and not os.path.exists(os.path.join(folder, ".commit")):
+            return jsonify(session_plan(session_id, session, present_chunks(folder), "Session resumed"))
+
+    if user_file_path(userid, filename) is None:
+        return jsonify({"error": "Invalid filename"}), 400
+    if check_file_exists(userid, filename) and not overwrite:
+        return jsonify({"error": "File already exists"})
+    error = quota_error(userid, size - file_size(user_file_path(userid, filename)))
+    if error:
+        return jsonify({"error": error}), 413
+
+    chunk_size = max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, chunk_size))
+
+    session = {
+        "userid": userid,
+        "filename": filename,
+        "size": size,
+        "chunk_size": chunk_size,
+        "num_chunks": math.ceil(size / chunk_size),
+        "hash": file_hash,
+        "overwrite": overwrite,
+        "created": time.time(),
+    }
+    # The chunks go on the root the file will end up on: where it is now, or the best root for a new file.
+    existing_path = STORAGE.find(userid, filename)
+    root = STORAGE.root_of(existing_path) if existing_path else STORAGE.place(size)
+    session_id = secrets.token_hex(16)
+    folder = os.path.join(root.root, ".sessions", session_id)
+    os.makedirs(folder)
+    with open(os.path.join(folder, "session.json"), "w") as f:
+        json.dump(session, f)
+
+    # An empty file has no chunks to wait for
+    if session["num_chunks"] == 0:
+        open(os.path.join(folder, "0"), "wb").close()
+        return finalize_session(dict(session, num_chunks=1), folder)
+
+    return jsonify(session_plan(session_id, session, [], "Session created"))
+
+# The body of the request is the raw chunk data.
+# If the client sends an X-Chunk-Hash header, the chunk is checked against it while it is being written.
+# A "count" query parameter lets one request carry that many consecutive chunks of the plan, so a client can
+# change how much it sends per request during the upload. The body is split back into the planned chunks,
+# and the hash covers the whole body.
+@app.route("/chunk/<session_id>/<int:index>", methods=["POST"])
+def upload_chunk(session_id, index):
+    folder, session = load_session(session_id)
+    if session is None:
+        return jsonify({"error": "Session does not exist"}), 404
+    count = request.args.get("count", 1, type=int)
+    if count < 1 or index + count > session["num_chunks"]:
+        return jsonify({"error": "Chunk index out of range"}), 400
+
+    chunk_hash = request.headers.get("X-Chunk-Hash")
+    chunk_hash_obj = hashlib.sha256() if chunk_hash else None
+    chunk_size = session["chunk_size"]
+    expected_size = min(count * chunk_size, session["size"] - index * chunk_size)
+
+    # Write to names of our own first, so a retried chunk can't clash with one still being received.
+    token = secrets.token_hex(4)
+    part_paths = [os.path.join(folder, f"{index + i}.part.{token}") for i in range(count)]
+    received = 0
+    try:
+        with STORAGE.io(folder):
+            for part_path in part_paths:
+                with open(part_path, "wb") as f:
+                    remaining = chunk_size
+                    while remaining > 0:
+                        data = request.stream.read(min(COPY_BUFFER_SIZE, remaining))
+                        if not data:
+                            break
+                        if chunk_hash_obj:
+                            chunk_hash_obj.update(data)
+                        f.write(data)
+                        received += len(data)
+                        remaining -= len(data)
+        # Anything past the last planned chunk still counts, so the size check catches it.
+        while True:
+            data = request.stream.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            received += len(data)
+
+        if received != expected_size:
+            remove_files(part_paths)
+            return jsonify({"error": f"Chunk {index} size mismatch! Expected {expected_size} bytes, got {received}."})
+        if chunk_hash_obj and chunk_hash_obj.hexdigest() != chunk_hash:
+            remove_files(part_paths)
+            HASH_MISMATCHES.inc(kind="chunk")
+            return jsonify({"error": "File hash mismatch!"})
+        for i, part_path in enumerate(part_paths):
+            os.replace(part_path, os.path.join(folder, str(index + i)))
+    except Exception as e:
+        remove_files(part_paths)
+        return jsonify({"error": "Error saving file: " + str(e)})
+
+    if len(present_chunks(folder)) < session["num_chunks"]:
+        return jsonify({"success": "Chunk uploaded"})
+    return finalize_session(session, folder)
+
+@app.route("/abort", methods=["POST"])
+def abort_upload():
+    #In the event of an error client side, the client can throw away the upload session.
+    session_id = request.form["session"]
+    folder, session = load_session(session_id)
+    if session is None:
+        return jsonify({"error": "Session does not exist"}), 404
+
+    shutil.rmtree(folder, ignore_errors=True)
+    return jsonify({"success": "Session removed"})
+
+# Files that fit in one chunk can skip the session and be uploaded with a single request.
+@app.route("/put", methods=["POST"])
+def put_file():
+    if "file" not in request.files:
+        return jsonify({"error": "No file part"})
+
+    userid = request.form["userid"]
+    auth_token = request.form["auth_token"]
+    filename = request.form["filename"]
+    overwrite = request.form.get("overwrite", "false").lower() == "true"
+    file_hash = request.form.get("hash") or None
+
+    # Check if the user is authenticated
+    if not authorize_user(userid, auth_token):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
+    refresh_peer_usage(userid, auth_token)
+
+    output_path = user_file_path(userid, filename)
+    if output_path is None:
+        return jsonify({"error": "Invalid filename"}), 400
+    if os.path.exists(output_path) and not overwrite:
+        return jsonify({"error": "File already exists"})
+
+    error = save_stream(userid, request.files["file"].stream, output_path, file_hash, filename)
+    if error:
+        return jsonify({"error": error})
+    return jsonify({"success": "File uploaded", "complete": True})
+
+# Many small files can be sent at once as an uncompressed tar stream in the body of the request.
+# The credentials go in the X-Userid and X-Auth-Token headers, since the body is read as it arrives.
+# A file can carry its hash in the "MCS.hash" PAX header if the server should verify it.
+# The archive is unpacked straight into the users folder and the result of every file is reported back.
+@app.route("/put_batch", methods=["POST"])
+def put_batch():
+    userid = request.headers.get("X-Userid", "")
+    auth_token = request.headers.get("X-Auth-Token", "")
+    overwrite = request.args.get("overwrite", "false").lower() == "true"
+
+    # Check if the user is authenticated
+    if not authorize_user(userid, auth_token):
+        return jsonify({"error": "Unauthorized"}), 401
+    refresh_peer_usage(userid, auth_token)
+
+    results = []
+    try:
+        with tarfile.open(fileobj=request.stream, mode="r|") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                if len(results) >= MAX_BATCH_FILES:
+                    results.append({"filename": member.name, "error": "Too many files in batch"})
+                    break
+
+                output_path = user_file_path(userid, member.name)
+                if output_path is None:
+                    error = "Invalid filename"
+                elif RING and RING.node_for(userid, member.name) != NODE_URL:
+                    error = f"File belongs to node {RING.node_for(userid, member.name)}"
+                elif os.path.exists(output_path) and not overwrite:
+                    error = "File already exists"
+                else:
+                    error = save_stream(userid, archive.extractfile(member), output_path, member.pax_headers.get("MCS.hash"), member.name)
+
+                if error:
+                    results.append({"filename": member.name, "error": error})
+                else:
+                    results.append({"filename": member.name, "success": "File uploaded"})
+    except tarfile.TarError as e:
+        return jsonify({"error": "Error reading batch: " + str(e), "results": results})
+
+    return jsonify({"success": "Batch processed", "results": results})
+
+"""
+This function removes the given files, skipping the ones that are already gone.
+@param paths: The paths of the files.
+"""
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+# Passing "offset" (and optionally "length") downloads just that range of the file.
+# The X-File-Size header tells the client the size of the whole file, so it can plan the other ranges.
+# Passing "version" downloads an old version of the file instead, streamed straight from its chunks.
+# The ETag header carries the hash of the file when it is known. A client that sends the hash of its copy in the
+# If-None-Match header gets 304 Not Modified instead of the file if its copy is still the same.
 @app.route("/download", methods=["POST"])
 def download():
     userid = request.form["userid"]
     auth_token = request.form["auth_token"]
-    tempid = request.form["tempid"]
     filename = request.form["filename"]
 
     # Check if the user is authenticated
     if not authorize_user(userid, auth_token):
         return jsonify({"error": "Unauthorized"}), 401
 
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
+
+    try:
+        offset = form_bytes("offset", 0)
+        length = form_bytes("length")
+    except ValueError:
+        return jsonify({"error": "Invalid range"}), 400
+    if "version" in request.form:
+        row = find_version(userid, filename, request.form["version"])
+        if row is None:
+            return jsonify({"error": "Version not found"}), 404
+        if row["hash"] and request.if_none_match.contains(row["hash"]):
+            return not_modified(row["hash"])
+        return range_response(row["size"], offset, length, lambda offset, length: VERSIONS.read_range(row, offset, length), row["hash"])
+
     # Check if the file exists
-    file_path = os.path.join(UPLOAD_FOLDER, userid, filename)
-    if not os.path.exists(file_path):
+    file_path = user_file_path(userid, filename)
+    if file_path is None or not os.path.exists(file_path):
         return jsonify({"error": "File not found"}), 404
 
-    # Create a temporary folder for the chunks
-    temp_folder = os.path.join(UPLOAD_FOLDER, userid, tempid)
-    if not os.path.exists(temp_folder):
-        os.makedirs(temp_folder)
+    # The file is only hashed here if the client asks whether its copy is the same
+    file_hash = HASHES.file_hash(file_path) if request.if_none_match else HASHES.lookup(file_path)
+    if file_hash and request.if_none_match.contains(file_hash):
+        return not_modified(file_hash)
 
-    # Split the file into chunks
-    chunk_size = (1024 * 1024) * 100  # 100 MB
-    chunk_index = 0
-    with open(file_path, "rb") as f:
-        while True:
-            chunk_data = f.read(chunk_size)
-            if not chunk_data:
-                break
-            chunk_filename = os.path.join(temp_folder, f"{filename}.{chunk_index}")
-            with open(chunk_filename, "wb") as chunk_file:
-                chunk_file.write(chunk_data)
-            chunk_index += 1
+    # The file is streamed straight from where it is stored, so a download leaves nothing behind if it is cut off.
+    # The "tempid" field older clients send is no longer needed.
+    return download_range(file_path, offset, length, file_hash)
+
+"""
+This function returns the answer for a client whose copy of a file is the same as the one on the server.
+@param file_hash: The hash of the file.
+"""
+def not_modified(file_hash):
+    NOT_MODIFIED.inc(route=request.url_rule.rule)
+    response = app.response_class(status=304)
+    response.set_etag(file_hash)
+    return response
 
-    # Stream the chunks to the client
-    def generate():
-        for index in range(chunk_index):
-            chunk_filename = os.path.join(temp_folder, f"{filename}.{index}")
-            with open(chunk_filename, "rb") as chunk_file:
-                yield chunk_file.read()
-            os.remove(chunk_filename)  # Remove the chunk after sending
+"""
+This function streams one range of a file.
+@param file_path: The path of the file.
+@param offset: Where the range starts.
+@param length: How many bytes to send, or None for everything after the offset.
+@param file_hash: The hash of the file, to send as the ETag, or None if it is not known.
+"""
+def download_range(file_path, offset, length, file_hash=None):
+    def read(offset, length):
+        with STORAGE.io(file_path), open(file_path, "rb") as f:
+            f.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = f.read(min(COPY_BUFFER_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
 
-        # Remove the temporary folder
-        os.rmdir(temp_folder)
+    return range_response(os.path.getsize(file_path), offset, length, read, file_hash)
 
-    return app.response_class(generate(), mimetype="application/octet-stream")
+"""
+This function returns the response for one range of a file or version.
+@param total_size: The size of the whole file.
+@param offset: Where the range starts.
+@param length: How many bytes to send, or None for everything after the offset.
+@param read: A function that returns a generator of the data, given the offset and the length.
+@param file_hash: The hash of the whole file, to send as the ETag, or None if it is not known.
+"""
+def range_response(total_size, offset, length, read, file_hash=None):
+    if offset < 0 or offset > total_size or (length is not None and length < 0):
+        return jsonify({"error": "Range out of bounds"}), 416
+    length = total_size - offset if length is None else min(length, total_size - offset)
+    headers = {"Content-Length": str(length), "X-File-Size": str(total_size)}
+    response = app.response_class(read(offset, length), mimetype="application/octet-stream", headers=headers)
+    if file_hash:
+        response.set_etag(file_hash)
+    return response
+
+"""
+This function returns an old version of a file of a user, or None if there is no such version (or versions are not kept).
+@param userid: The ID of the user.
+@param filename: The name of the file.
+@param version: The ID of the version, as sent by the client.
+"""
+def find_version(userid, filename, version):
+    if VERSIONS is None or not str(version).isdigit():
+        return None
+    return VERSIONS.get(userid, filename, int(version))
 
 @app.route("/get_hash", methods=["POST"])
 def get_hash():
@@ -284,20 +1178,131 @@ def get_hash():
         print("Unauthorized")
         return jsonify({"error": "Unauthorized"}), 401
 
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
+
+    # The hash of an old version was worked out when it was split into chunks
+    if "version" in request.form:
+        row = find_version(userid, filename, request.form["version"])
+        if row is None:
+            return jsonify({"error": "Version not found"}), 404
+        return jsonify({"hash": VERSIONS.file_hash(row)})
+
     # Check if the file exists
-    file_path = os.path.join(UPLOAD_FOLDER, userid, filename)
-    if not os.path.exists(file_path):
+    file_path = user_file_path(userid, filename)
+    if file_path is None or not os.path.exists(file_path):
         return jsonify({"error": "File not found"}), 404
     
 
-    # Calculate the hash of the file
-    file_hash_obj = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        data = f.read()
-        file_hash_obj.update(data)
-        file_hash = file_hash_obj.hexdigest()
+    # Calculate the hash of the file, unless it is known from before and the file did not change
+    return jsonify({"hash": HASHES.file_hash(file_path)})
+
+# Lists the hashes of the chunks of a file, so a client with an older copy can download just the chunks that changed.
+# Like /download, it answers 304 Not Modified if the If-None-Match header has the hash of the file.
+@app.route("/manifest", methods=["POST"])
+def manifest():
+    userid = request.form["userid"]
+    auth_token = request.form["auth_token"]
+    filename = request.form["filename"]
+
+    # Check if the user is authenticated
+    if not authorize_user(userid, auth_token):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        chunk_size = form_bytes("chunk_size", MANIFEST_CHUNK_SIZE)
+    except ValueError:
+        return jsonify({"error": "Invalid chunk size"}), 400
+
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
+
+    # Check if the file exists
+    file_path = user_file_path(userid, filename)
+    if file_path is None or not os.path.exists(file_path):
+        return jsonify({"error": "File not found"}), 404
+    chunk_size = max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, chunk_size))
+
+    file_hash, chunks = HASHES.chunk_hashes(file_path, chunk_size)
+    if request.if_none_match.contains(file_hash):
+        return not_modified(file_hash)
+    response = jsonify({"hash": file_hash, "size": file_size(file_path), "chunk_size": chunk_size, "chunks": chunks})
+    response.set_etag(file_hash)
+    return response
+
+# Lists the old versions of a file, newest first. A deleted file can still have versions.
+@app.route("/versions", methods=["POST"])
+def list_versions():
+    userid = request.form["userid"]
+    auth_token = request.form["auth_token"]
+    filename = request.form["filename"]
+
+    # Check if the user is authenticated
+    if not authorize_user(userid, auth_token):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
+
+    if VERSIONS is None:
+        return jsonify({"error": "Versions are not kept on this server"}), 404
+    return jsonify({"versions": VERSIONS.list(userid, filename)})
 
-    return jsonify({"hash": file_hash})
+# Puts an old version of a file back. The file it replaces is kept as a version in turn, so a restore can be undone.
+@app.route("/restore", methods=["POST"])
+def restore_version():
+    userid = request.form["userid"]
+    auth_token = request.form["auth_token"]
+    filename = request.form["filename"]
+
+    # Check if the user is authenticated
+    if not authorize_user(userid, auth_token):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
+    refresh_peer_usage(userid, auth_token)
+
+    row = find_version(userid, filename, request.form.get("version"))
+    if row is None:
+        return jsonify({"error": "Version not found"}), 404
+    output_path = STORAGE.file_path(userid, filename, size=row["size"])
+    if output_path is None:
+        return jsonify({"error": "Invalid filename"}), 400
+
+    # The chunks are streamed into the file, and checked against the hash of the version if it is known.
+    error = save_stream(userid, versions.VersionReader(VERSIONS, row), output_path, row["hash"], filename)
+    if error:
+        return jsonify({"error": error})
+    return jsonify({"success": "Version restored"})
+
+@app.route("/delete_version", methods=["POST"])
+def delete_version():
+    userid = request.form["userid"]
+    auth_token = request.form["auth_token"]
+    filename = request.form["filename"]
+
+    # Check if the user is authenticated
+    if not authorize_user(userid, auth_token):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
+
+    version = request.form.get("version")
+    if find_version(userid, filename, version) is None or not VERSIONS.delete(userid, filename, int(version)):
+        return jsonify({"error": "Version not found"}), 404
+    return jsonify({"success": "Version deleted"})
 
 @app.route("/list", methods=["POST"])
 def list_files():
@@ -308,15 +1313,57 @@ def list_files():
     if not authorize_user(userid, auth_token):
         return jsonify({"error": "Unauthorized"}), 401
 
+    # List the files in the user folder.
+    # With "recursive", every file is listed by its full name, including the folders it is in.
+    # With "details", the size, modification time and hash (if it is known without reading the file) of every file are sent too
+    recursive = request.form.get("recursive", "false").lower() == "true"
+    with_details = request.form.get("details", "false").lower() == "true"
+    found = STORAGE.user_exists(userid)
+    files = []
+    details = {}
+    if found:
+        files = STORAGE.list_files(userid) if recursive else STORAGE.list_top(userid)
+        if with_details:
+            details = file_details(userid, files)
+
+    # In a cluster, the files of the other nodes are added to the list
+    if PEERS and not from_peer():
+        try:
+            answers = ask_peers("list", request.form.to_dict())
+        except (requests.RequestException, ValueError) as e:
+            return jsonify({"error": "Error asking the other nodes: " + str(e)}), 502
+        for status_code, answer in answers.values():
+            if status_code == 200:
+                found = True
+                files.extend(answer["files"])
+                details.update(answer.get("details", {}))
+        files = list(dict.fromkeys(files))
+
     # Check if the user folder exists
-    user_folder = os.path.join(UPLOAD_FOLDER, userid)
-    if not os.path.exists(user_folder):
+    if not found:
         return jsonify({"error": "User folder does not exist"}), 404
-
-    # List the files in the user folder
-    files = os.listdir(user_folder)
+    if with_details:
+        return jsonify({"files": files, "details": details})
     return jsonify({"files": files})
 
+"""
+This function returns the size, modification time and hash of files of a user, by filename. Folders are left out.
+The hash is None unless it is known without reading the file; the "hash" operation of /batch works it out.
+@param userid: The ID of the user.
+@param filenames: The names of the files.
+"""
+def file_details(userid, filenames):
+    details = {}
+    for filename in filenames:
+        file_path = user_file_path(userid, filename)
+        try:
+            stat = os.stat(file_path)
+        except (OSError, TypeError):
+            continue
+        if os.path.isfile(file_path):
+            details[filename] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": HASHES.lookup(file_path)}
+    return details
+
 @app.route("/delete", methods=["POST"])
 def delete_file():
     userid = request.form["userid"]
@@ -327,13 +1374,18 @@ def delete_file():
     if not authorize_user(userid, auth_token):
         return jsonify({"error": "Unauthorized"}), 401
 
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, filename)
+    if error:
+        return error
+
     # Check if the file exists
-    file_path = os.path.join(UPLOAD_FOLDER, userid, filename)
-    if not os.path.exists(file_path):
+    file_path = user_file_path(userid, filename)
+    if file_path is None or not os.path.exists(file_path):
         return jsonify({"error": "File not found"}), 404
 
     # Delete the file
-    os.remove(file_path)
+    remove_user_file(userid, file_path, filename)
     return jsonify({"success": "File deleted"})
 
 @app.route("/rename", methods=["POST"])
@@ -347,15 +1399,249 @@ def rename_file():
     if not authorize_user(userid, auth_token):
         return jsonify({"error": "Unauthorized"}), 401
 
+    # In a cluster, the file has to be on this node
+    error = wrong_node(userid, old_filename)
+    if error:
+        return error
+
     # Check if the file exists
-    old_file_path = os.path.join(UPLOAD_FOLDER, userid, old_filename)
-    if not os.path.exists(old_file_path):
+    old_file_path = user_file_path(userid, old_filename)
+    if old_file_path is None or not os.path.exists(old_file_path):
         return jsonify({"error": "File not found"}), 404
 
-    # Rename the file
-    new_file_path = os.path.join(UPLOAD_FOLDER, userid, new_filename)
-    os.rename(old_file_path, new_file_path)
+    # A new name that belongs to another node moves the file there
+    new_owner = RING.node_for(userid, new_filename) if RING else NODE_URL
+    if new_owner != NODE_URL:
+        if storage.split_filename(new_filename) is None:
+            return jsonify({"error": "Invalid filename"}), 400
+        try:
+            error = send_to_node(new_owner, userid, auth_token, old_file_path, new_filename, overwrite=True)
+        except (requests.RequestException, ValueError) as e:
+            error = "Error moving the file to node " + new_owner + ": " + str(e)
+        if error:
+            return jsonify({"error": error}), 502
+        remove_user_file(userid, old_file_path)
+        return jsonify({"success": "File renamed"})
+
+    # Rename the file. A file already at the new name is replaced, and no longer counts towards the usage.
+    new_file_path = STORAGE.file_path(userid, new_filename, near=old_file_path)
+    if new_file_path is None:
+        return jsonify({"error": "Invalid filename"}), 400
+    if os.path.abspath(new_file_path) == os.path.abspath(old_file_path):
+        # Renaming a file to its own name changes nothing, so it must not replace (and keep a version of) itself.
+        return jsonify({"success": "File renamed"})
+    replaced_size = file_size(new_file_path) if os.path.isfile(new_file_path) else 0
+    os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
+    keep_version(userid, new_filename, new_file_path)
+    STORAGE.move(old_file_path, new_file_path)
+    STORAGE.forget(userid, old_file_path)
+    USAGE.add(userid, -replaced_size)
     return jsonify({"success": "File renamed"})
 
+"""
+This function runs one operation of a /batch request and returns its result.
+@param userid: The ID of the user.
+@param auth_token: The authentication token of the user, to move a renamed file to another node with.
+@param operation: The operation to run, e.g. {"op": "delete", "filename": "cat.png"}.
+"""
+def run_batch_operation(userid, auth_token, operation):
+    op = operation.get("op")
+    filename = operation.get("filename", "")
+    file_path = user_file_path(userid, filename)
+    if file_path is None:
+        return {"filename": filename, "error": "Invalid filename"}
+    if not os.path.isfile(file_path):
+        return {"filename": filename, "error": "File not found"}
+
+    if op == "stat":
+        stat = os.stat(file_path)
+        return {"filename": filename, "size": stat.st_size, "mtime": stat.st_mtime}
+    elif op == "hash":
+        stat = os.stat(file_path)
+        return {"filename": filename, "size": stat.st_size, "mtime": stat.st_mtime, "hash": HASHES.file_hash(file_path)}
+    elif op == "delete":
+        remove_user_file(userid, file_path, filename)
+        return {"filename": filename, "success": "File deleted"}
+    elif op == "rename":
+        new_filename = operation.get("new_filename", "")
+        if RING and RING.node_for(userid, new_filename) != NODE_URL:
+            if storage.split_filename(new_filename) is None:
+                return {"filename": filename, "error": "Invalid filename"}
+            error = send_to_node(RING.node_for(userid, new_filename), userid, auth_token, file_path, new_filename, operation.get("overwrite"))
+            if error:
+                return {"filename": filename, "error": error}
+            remove_user_file(userid, file_path)
+            return {"filename": filename, "success": "File renamed"}
+        new_file_path = STORAGE.file_path(userid, new_filename, near=file_path)
+        if new_file_path is None:
+            return {"filename": filename, "error": "Invalid filename"}
+        if os.path.abspath(new_file_path) == os.path.abspath(file_path):
+            return {"filename": filename, "success": "File renamed"}
+        if os.path.exists(new_file_path) and not operation.get("overwrite"):
+            return {"filename": filename, "error": "File already exists"}
+        os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
+        replaced_size = file_size(new_file_path)
+        keep_version(userid, new_filename, new_file_path)
+        STORAGE.move(file_path, new_file_path)
+        STORAGE.forget(userid, file_path)
+        USAGE.add(userid, -replaced_size)
+        return {"filename": filename, "success": "File renamed"}
+    return {"filename": filename, "error": f"Unknown operation {op}"}
+
+# Runs many delete, rename, stat and hash operations with a single request.
+# The "operations" field is a JSON list like [{"op": "rename", "filename": "a.txt", "new_filename": "b.txt"}],
+# and the response has one result per operation, in the same order.
+@app.route("/batch", methods=["POST"])
+def batch():
+    userid = request.form["userid"]
+    auth_token = request.form["auth_token"]
+
+    # Check if the user is authenticated
+    if not authorize_user(userid, auth_token):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        operations = json.loads(request.form["operations"])
+    except ValueError as e:
+        return jsonify({"error": "Error parsing operations: " + str(e)}), 400
+    if not isinstance(operations, list):
+        return jsonify({"error": "Operations must be a list"}), 400
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({"error": f"Too many operations, the limit is {MAX_BATCH_OPERATIONS}"}), 400
+
+    # In a cluster, every node runs the operations on its own files, and the results are put back in order
+    positions_by_node = {NODE_URL: []}
+    for position, operation in enumerate(operations):
+        node = NODE_URL
+        if RING and not from_peer() and isinstance(operation, dict):
+            node = RING.node_for(userid, str(operation.get("filename", "")))
+        positions_by_node.setdefault(node, []).append(position)
+    try:
+        answers = ask_nodes("batch", {node: {"userid": userid, "auth_token": auth_token, "operations": json.dumps([operations[position] for position in positions])} for node, positions in positions_by_node.items() if node != NODE_URL})
+    except (requests.RequestException, ValueError) as e:
+        return jsonify({"error": "Error asking the other nodes: " + str(e)}), 502
+
+    results = [None] * len(operations)
+    for node, (_, answer) in answers.items():
+        node_results = answer.get("results") or [{"error": answer.get("error", "No results from node " + node)}] * len(positions_by_node[node])
+        for position, result in zip(positions_by_node[node], node_results):
+            results[position] = result
+    for position in positions_by_node[NODE_URL]:
+        operation = operations[position]
+        if not isinstance(operation, dict):
+            results[position] = {"error": "Invalid operation"}
+            continue
+        try:
+            results[position] = run_batch_operation(userid, auth_token, operation)
+        except Exception as e:
+            results[position] = {"filename": operation.get("filename"), "error": str(e)}
+    return jsonify({"results": results})
+
+"""
+This function returns the last time anything happened in a temporary folder: the newest change to the folder or a file in it.
+@param folder: The folder.
+"""
+def last_activity(folder):
+    latest = os.path.getmtime(folder)
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            latest = max(latest, entry.stat(follow_symlinks=False).st_mtime)
+    return latest
+
+"""
+This function returns the subfolders of a folder, or nothing if the folder does not exist.
+@param folder: The folder.
+"""
+def subfolders(folder):
+    try:
+        with os.scandir(folder) as entries:
+            return [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return []
+
+"""
+This function removes the upload sessions, legacy temp folders and temporary files that have seen no activity for TEMP_TTL seconds.
+Returns the number of folders and files removed.
+"""
+def reap_temp_folders():
+    expired = time.time() - TEMP_TTL
+    folders = [("session", folder) for sessions in SESSION_FOLDERS for folder in subfolders(sessions)]
+    folders += [("upload", folder) for user_folder in subfolders(TEMP_FOLDER) for folder in subfolders(user_folder)]
+    removed = 0
+    for kind, folder in folders:
+        try:
+            if last_activity(folder) < expired:
+                shutil.rmtree(folder)
+                REAPED.inc(kind=kind)
+                removed += 1
+        except OSError:
+            # Finished or removed by a request in the meantime.
+            pass
+
+    # Files left in the temporary area by a /put or /put_batch that was cut off.
+    for temp_folder in STORAGE.temp_folders:
+        try:
+            with os.scandir(temp_folder) as entries:
+                for entry in entries:
+                    try:
+                        if entry.stat(follow_symlinks=False).st_mtime < expired:
+                            os.remove(entry.path)
+                            REAPED.inc(kind="file")
+                            removed += 1
+                    except OSError:
+                        pass
+        except FileNotFoundError:
+            pass
+    return removed
+
+"""
+This function measures how many bytes every user has stored, by walking the user folders.
+It is only used to start the usage counters and to correct them now and then.
+"""
+def count_usage():
+    return {userid: sum(folder_size(folder, skip_hidden=True) for folder in STORAGE.user_folders(userid)) for userid in STORAGE.users()}
+
+"""
+This function runs forever in a background thread: it removes abandoned temporary folders, saves the usage counters,
+and rebuilds them from the disk every USAGE_RECOUNT_INTERVAL seconds.
+Files that change while the disk is walked can be a little off until the next recount.
+"""
+def run_reaper():
+    last_recount = time.time()
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        try:
+            removed = reap_temp_folders()
+            if removed:
+                print(f"Reaper removed {removed} abandoned temporary folders and files.")
+            if time.time() - last_recount >= USAGE_RECOUNT_INTERVAL:
+                USAGE.recount(count_usage())
+                last_recount = time.time()
+            USAGE.save()
+        except Exception as e:
+            print("Reaper error: " + str(e))
+
+"""
+This function runs forever in a background thread: it splits new old versions into chunks, and removes the chunks no version uses anymore.
+"""
+def run_compactor():
+    while True:
+        time.sleep(VERSIONS_COMPACT_INTERVAL)
+        try:
+            compacted, removed = VERSIONS.compact()
+            if compacted or removed:
+                print(f"Compacted {compacted} versions, removed {removed} unused chunks.")
+        except Exception as e:
+            print("Compactor error: " + str(e))
+
 if __name__ == "__main__":
-    app.run(port=5000,host="0.0.0.0")
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    if not USAGE.load():
+        print("Counting disk usage...")
+        USAGE.recount(count_usage())
+    atexit.register(USAGE.save)
+    threading.Thread(target=run_reaper, daemon=True).start()
+    if VERSIONS is not None:
+        threading.Thread(target=run_compactor, daemon=True).start()
+    # Every request runs in its own thread, so transfers on different storage roots go on at the same time.
+    app.run(port=int(os.getenv("PORT", 5000)),host="0.0.0.0", threaded=True)
@@ -0,0 +1,42 @@
+# Cluster mode: several server nodes share the files, each owning a part of them through consistent hashing.
+# A file belongs to the node its user and name hash to, so adding a node only moves the files that now hash to it.
+# The client computes the same ring (client/cluster.py) from /cluster and sends every request straight to the owner.
+import bisect
+import hashlib
+
+# How many points every node gets on the ring. More points spread the files more evenly.
+VIRTUAL_NODES = 128
+
+def ring_hash(value):
+    return int(hashlib.sha256(value.encode()).hexdigest()[:16], 16)
+
+"""
+This function returns the key a file is placed by on the ring.
+@param userid: The ID of the user.
+@param filename: The name of the file.
+"""
+def ring_key(userid, filename):
+    return userid + "/" + filename.replace("\\", "/")
+
+"""
+A consistent hash ring of the nodes of a cluster.
+"""
+class HashRing:
+    """
+    @param nodes: The URLs of the nodes.
+    @param vnodes: How many points every node gets on the ring.
+    """
+    def __init__(self, nodes, vnodes=VIRTUAL_NODES):
+        self.nodes = list(nodes)
+        self.vnodes = vnodes
+        self.points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in self.points]
+
+    """
+    This function returns the node a file belongs to.
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    """
+    def node_for(self, userid, filename):
+        index = bisect.bisect(self.hashes, ring_hash(ring_key(userid, filename))) % len(self.points)
+        return self.points[index][1]
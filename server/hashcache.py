@@ -0,0 +1,120 @@
+# The hashes of the stored files, remembered until a file changes, so /get_hash, conditional downloads and /manifest
+# don't have to read the whole file every time. A file is known by its path, and counts as changed when its size,
+# modification time or inode is different. Files written with a verified hash are remembered as they are written.
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# How many files are remembered. The files used the longest time ago are forgotten first.
+DEFAULT_MAX_ENTRIES = 100000
+
+# How much data is read at a time when hashing a file.
+READ_BUFFER_SIZE = 1024 * 1024  # 1 MB
+
+def stat_key(stat):
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+"""
+Remembers the hash of every file, and the hashes of its chunks for the chunk sizes that were asked for.
+"""
+class HashCache:
+    """
+    @param max_entries: How many files to remember.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, path, key):
+        entry = self.entries.get(path)
+        if entry is None or entry["key"] != key:
+            return None
+        self.entries.move_to_end(path)
+        return entry
+
+    def _put(self, path, key, file_hash, chunk_size=None, chunks=None):
+        entry = self.entries.get(path)
+        if entry is None or entry["key"] != key:
+            entry = {"key": key, "hash": file_hash, "chunks": {}}
+            self.entries[path] = entry
+        if chunk_size:
+            entry["chunks"][chunk_size] = chunks
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    """
+    This function returns the hash of a file if it is remembered, without reading the file. Returns None otherwise.
+    @param path: The path of the file.
+    """
+    def lookup(self, path):
+        try:
+            key = stat_key(os.stat(path))
+        except OSError:
+            return None
+        with self.lock:
+            entry = self._get(path, key)
+            return entry["hash"] if entry else None
+
+    """
+    This function remembers the hash of a file that was just written, e.g. after checking it against the hash the client sent.
+    @param path: The path of the file.
+    @param file_hash: The hash of the file.
+    """
+    def remember(self, path, file_hash):
+        key = stat_key(os.stat(path))
+        with self.lock:
+            self._put(path, key, file_hash)
+
+    """
+    This function returns the hash of a file, reading the file only if it changed since it was last hashed.
+    @param path: The path of the file.
+    """
+    def file_hash(self, path):
+        return self.chunk_hashes(path, None)[0]
+
+    """
+    This function returns the hash of a file and the hashes of its chunks, as (file hash, chunk hashes),
+    reading the file only if they are not remembered yet. Both are worked out in one pass over the file.
+    @param path: The path of the file.
+    @param chunk_size: The size of the chunks, or None for just the hash of the file.
+    """
+    def chunk_hashes(self, path, chunk_size):
+        with open(path, "rb") as f:
+            # The file open now is the one hashed, even if it is replaced in the meantime.
+            key = stat_key(os.fstat(f.fileno()))
+            with self.lock:
+                entry = self._get(path, key)
+                if entry and (chunk_size is None or chunk_size in entry["chunks"]):
+                    return entry["hash"], entry["chunks"].get(chunk_size)
+
+            file_hash_obj = hashlib.sha256()
+            chunks = []
+            chunk_hash_obj = hashlib.sha256()
+            chunk_filled = 0
+            while True:
+                data = f.read(READ_BUFFER_SIZE)
+                if not data:
+                    break
+                file_hash_obj.update(data)
+                if chunk_size is None:
+                    continue
+                data = memoryview(data)
+                while data:
+                    piece = data[:chunk_size - chunk_filled]
+                    data = data[len(piece):]
+                    chunk_hash_obj.update(piece)
+                    chunk_filled += len(piece)
+                    if chunk_filled == chunk_size:
+                        chunks.append(chunk_hash_obj.hexdigest())
+                        chunk_hash_obj = hashlib.sha256()
+                        chunk_filled = 0
+            if chunk_filled:
+                chunks.append(chunk_hash_obj.hexdigest())
+
+        file_hash = file_hash_obj.hexdigest()
+        with self.lock:
+            self._put(path, key, file_hash, chunk_size, chunks if chunk_size else None)
+        return file_hash, chunks if chunk_size else None
@@ -5,6 +5,27 @@ echo Setting up MacBook Cloud Storage server...
 echo Downloading app.py...
 curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/server/app.py
 
+echo Downloading metrics.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/server/metrics.py
+
+echo Downloading usage.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/server/usage.py
+
+echo Downloading storage.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/server/storage.py
+
+echo Downloading migrate.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/server/migrate.py
+
+echo Downloading cluster.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/server/cluster.py
+
+echo Downloading versions.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/server/versions.py
+
+echo Downloading hashcache.py...
+curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/server/hashcache.py
+
 :: Step 2: Download requirements.txt
 echo Downloading requirements.txt...
 curl -O https://raw.githubusercontent.com/SlickTorpedo/MacBook-Cloud-Storage/refs/heads/main/server/requirements.txt
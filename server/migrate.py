@@ -0,0 +1,79 @@
+# Moves the stored files from one storage layout to the other (see storage.py).
+# Stop the server first, then start it again with STORAGE_LAYOUT set to the new layout once this is done.
+# If the migration is cut off, just run it again: it picks up the files that were not moved yet.
+# With several storage roots, every root is migrated on its own, so files never move to another disk.
+import argparse
+import os
+import sys
+import dotenv
+import storage
+
+"""
+This function removes the empty folders in a folder tree, and the folder itself if it ends up empty.
+Files are never removed.
+@param folder: The folder.
+"""
+def remove_empty_folders(folder):
+    for root, _, _ in os.walk(folder, topdown=False):
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+
+"""
+This function moves every file stored in any other layout into the target layout.
+Returns the number of files moved (or that would be moved, on a dry run).
+@param root: The folder everything is stored in (UPLOAD_FOLDER).
+@param layout: The layout to move to.
+@param dry_run: Whether to only count the files.
+"""
+def migrate(root, layout, dry_run=False):
+    target = storage.LAYOUTS[layout](root)
+    moved = 0
+    for name, layout_class in storage.LAYOUTS.items():
+        if name == layout:
+            continue
+        source = layout_class(root)
+        for userid in source.users():
+            filenames = source.list_files(userid)
+            print(f"{userid}: {len(filenames)} files in the {name} layout")
+            moved += len(filenames)
+            if dry_run:
+                continue
+            for filename in filenames:
+                source_path = source.file_path(userid, filename)
+                target_path = target.file_path(userid, filename)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                os.replace(source_path, target_path)
+                source.forget(userid, source_path)
+            remove_empty_folders(source.user_folder(userid))
+    if not dry_run:
+        if layout == "flat":
+            remove_empty_folders(os.path.join(root, ".sharded"))
+        storage.write_layout(root, layout)
+    return moved
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Move the stored files to another storage layout. Stop the server first.")
+    parser.add_argument("--to", required=True, choices=list(storage.LAYOUTS), help="The layout to move the files to.")
+    parser.add_argument("--upload_folder", nargs="+", help="The folders the files are stored in. Defaults to STORAGE_ROOTS, or UPLOAD_FOLDER, from the ENV.")
+    parser.add_argument("--dry_run", action="store_true", help="Only count the files that would be moved.")
+    args = parser.parse_args()
+
+    roots = args.upload_folder or storage.roots_from_env()
+    for root in roots:
+        if not os.path.isdir(root):
+            print(f"{root} does not exist.")
+            sys.exit(1)
+
+    # Until the migration finishes, the server refuses to start in either layout.
+    if not args.dry_run:
+        for root in roots:
+            storage.write_layout(root, "migrating")
+    moved = sum(migrate(root, args.to, args.dry_run) for root in roots)
+    if args.dry_run:
+        print(f"{moved} files would be moved to the {args.to} layout.")
+    else:
+        print(f"Moved {moved} files. Set STORAGE_LAYOUT={args.to} and start the server.")
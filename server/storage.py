@@ -0,0 +1,395 @@
+# Where the files of every user are kept on disk. The server only goes through a storage object to find a file,
+# so the layout on disk can change without the HTTP API noticing.
+import errno
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import threading
+from contextlib import contextmanager
+
+# The file in the root that records which layout the root is in.
+LAYOUT_FILE = ".layout"
+
+class StorageLayoutError(Exception):
+    pass
+
+"""
+This function splits a filename into the folders and name it is made of.
+Returns None if the filename would escape the users folder.
+Filenames can contain folders (e.g. "photos/cat.png") when a whole directory is uploaded.
+@param filename: The name of the file.
+"""
+def split_filename(filename):
+    parts = filename.replace("\\", "/").split("/")
+    if filename.startswith("/") or any(part in ("", ".", "..") for part in parts):
+        return None
+    return parts
+
+"""
+What both layouts have in common: the root folder, the temporary area and the listing of files.
+Everything starting with a dot in the root belongs to the server (sessions, temporary files, counters), not to a user.
+"""
+class Storage:
+    name = None
+
+    """
+    @param root: The folder everything is stored in (UPLOAD_FOLDER).
+    """
+    def __init__(self, root):
+        self.root = root
+        self.temp_folder = os.path.join(root, ".tmp")
+
+    def user_folder(self, userid):
+        raise NotImplementedError
+
+    """
+    This function returns where a file of a user is stored, or None if the filename is not valid.
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    """
+    def file_path(self, userid, filename):
+        raise NotImplementedError
+
+    """
+    This function returns the full names of all the files of a user.
+    @param userid: The ID of the user.
+    """
+    def list_files(self, userid):
+        raise NotImplementedError
+
+    """
+    This function returns the files and folders at the top of the users folder, like listing a folder would.
+    @param userid: The ID of the user.
+    """
+    def list_top(self, userid):
+        raise NotImplementedError
+
+    def exists(self, userid, filename):
+        path = self.file_path(userid, filename)
+        return path is not None and os.path.exists(path)
+
+    def user_exists(self, userid):
+        return os.path.isdir(self.user_folder(userid))
+
+    """
+    This function returns the users that have files stored.
+    """
+    def users(self):
+        base = os.path.dirname(self.user_folder("x"))
+        try:
+            with os.scandir(base) as entries:
+                return [entry.name for entry in entries if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".")]
+        except FileNotFoundError:
+            return []
+
+    """
+    This function returns a new path in the temporary area, on the same disk as the files so it can be moved into place in one step.
+    @param suffix: The end of the name, to tell what it is for.
+    """
+    def temp_path(self, suffix=".tmp"):
+        os.makedirs(self.temp_folder, exist_ok=True)
+        return os.path.join(self.temp_folder, secrets.token_hex(8) + suffix)
+
+    """
+    This function tidies up after a file was removed or moved away, e.g. by removing folders that are now empty.
+    @param userid: The ID of the user.
+    @param path: Where the file was.
+    """
+    def forget(self, userid, path):
+        pass
+
+"""
+This function lists a folder tree by the full names of the files in it, leaving out anything starting with a dot.
+@param folder: The folder to list.
+"""
+def walk_names(folder):
+    for root, folders, names in os.walk(folder):
+        folders[:] = [folder for folder in folders if not folder.startswith(".")]
+        relative_root = os.path.relpath(root, folder)
+        for name in names:
+            if name.startswith("."):
+                continue
+            yield name if relative_root == "." else f"{relative_root.replace(os.sep, '/')}/{name}"
+
+"""
+The original layout: every user has a folder in the root, and files are stored under it by their name, folders and all.
+Simple to browse by hand, but one folder can end up holding millions of files.
+"""
+class FlatStorage(Storage):
+    name = "flat"
+
+    def user_folder(self, userid):
+        return os.path.join(self.root, userid)
+
+    def file_path(self, userid, filename):
+        parts = split_filename(filename)
+        if parts is None:
+            return None
+        return os.path.join(self.user_folder(userid), *parts)
+
+    def list_files(self, userid):
+        return list(walk_names(self.user_folder(userid)))
+
+    def list_top(self, userid):
+        # Hidden entries (versions, uploads in progress) are left out, as when listing every file.
+        return [name for name in os.listdir(self.user_folder(userid)) if not name.startswith(".")]
+
+"""
+The sharded layout: a file is stored in one of 65536 folders picked by the hash of its name,
+e.g. "photos/cat.png" is stored as <root>/.sharded/<user>/3f/a2/photos/cat.png.
+No folder gets more than a small share of the files of a user, however many there are.
+"""
+class ShardedStorage(Storage):
+    name = "sharded"
+
+    def user_folder(self, userid):
+        return os.path.join(self.root, ".sharded", userid)
+
+    def file_path(self, userid, filename):
+        parts = split_filename(filename)
+        if parts is None:
+            return None
+        digest = hashlib.sha256("/".join(parts).encode()).hexdigest()
+        return os.path.join(self.user_folder(userid), digest[:2], digest[2:4], *parts)
+
+    def shard_folders(self, userid):
+        user_folder = self.user_folder(userid)
+        try:
+            first_level = sorted(os.listdir(user_folder))
+        except FileNotFoundError:
+            return
+        for first in first_level:
+            for second in sorted(os.listdir(os.path.join(user_folder, first))):
+                yield os.path.join(user_folder, first, second)
+
+    def list_files(self, userid):
+        return [name for shard in self.shard_folders(userid) for name in walk_names(shard)]
+
+    def list_top(self, userid):
+        return sorted({name.split("/")[0] for name in self.list_files(userid)})
+
+    def forget(self, userid, path):
+        # Remove the folders that are now empty, up to the user folder.
+        user_folder = self.user_folder(userid)
+        folder = os.path.dirname(path)
+        while os.path.abspath(folder) != os.path.abspath(user_folder):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+LAYOUTS = {"flat": FlatStorage, "sharded": ShardedStorage}
+
+"""
+This function returns the layout a root is in: what its layout file says, "flat" for an older root that already
+holds user folders, or None for a new, empty root.
+@param root: The root folder.
+"""
+def read_layout(root):
+    try:
+        with open(os.path.join(root, LAYOUT_FILE), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return "flat" if FlatStorage(root).users() else None
+
+def write_layout(root, layout):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, LAYOUT_FILE), "w") as f:
+        f.write(layout)
+
+"""
+This function returns the storage for a root, making sure the root is in the asked layout.
+Raises StorageLayoutError if the layout is unknown or the root is in another layout.
+@param root: The root folder.
+@param layout: The name of the layout, "flat" or "sharded".
+"""
+def open_storage(root, layout):
+    if layout not in LAYOUTS:
+        raise StorageLayoutError(f"Unknown storage layout {layout}, it should be one of: {', '.join(LAYOUTS)}.")
+    current = read_layout(root)
+    if current == "migrating":
+        raise StorageLayoutError(f"A migration of {root} did not finish. Run migrate.py again before starting the server.")
+    if current and current != layout:
+        raise StorageLayoutError(f"{root} is in the {current} layout, not {layout}. Stop the server and run migrate.py --to {layout} to switch.")
+    if current is None:
+        write_layout(root, layout)
+    return LAYOUTS[layout](root)
+
+"""
+This function returns the storage roots from the ENV: the STORAGE_ROOTS variable holds a JSON list of folders,
+e.g. ["/mnt/disk1/mcs", "/mnt/disk2/mcs"]. Without it, UPLOAD_FOLDER is the only root.
+"""
+def roots_from_env():
+    roots = os.getenv("STORAGE_ROOTS")
+    if roots:
+        roots = json.loads(roots)
+        if not isinstance(roots, list) or not roots:
+            raise StorageLayoutError("STORAGE_ROOTS should be a JSON list of folders.")
+        return roots
+    return [os.getenv("UPLOAD_FOLDER", "uploads")]
+
+"""
+Spreads the files of every user over several storage roots, one per disk, so the disks are used side by side.
+A file lives on exactly one root, so finding an existing file checks every root in turn.
+New files go to the root with the most free space per transfer already using it, among the roots that have room for them.
+The pool has the same methods as a single storage, so the server doesn't need to know how many roots there are.
+"""
+class StoragePool:
+    """
+    @param roots: The storages of the roots, all in the same layout. The first one also holds the state of the server.
+    """
+    def __init__(self, roots):
+        self.roots = roots
+        self.primary = roots[0]
+        self.lock = threading.Lock()
+        # How many reads and writes are going on in every root right now.
+        self.active = {storage.root: 0 for storage in roots}
+        self.root_paths = [(os.path.abspath(storage.root) + os.sep, storage) for storage in roots]
+
+    """
+    This function returns the storage of the root a path is in.
+    @param path: A path in one of the roots.
+    """
+    def root_of(self, path):
+        path = os.path.abspath(path)
+        for root_path, storage in self.root_paths:
+            if path.startswith(root_path):
+                return storage
+        raise ValueError(f"{path} is not in any storage root")
+
+    """
+    This function returns the free space of every root, in bytes.
+    """
+    def free_space(self):
+        free = {}
+        for storage in self.roots:
+            try:
+                free[storage.root] = shutil.disk_usage(storage.root).free
+            except OSError:
+                free[storage.root] = 0
+        return free
+
+    """
+    This function picks the root for new data.
+    @param size: How many bytes will be written, if known.
+    """
+    def place(self, size=0):
+        if len(self.roots) == 1:
+            return self.primary
+        free = self.free_space()
+        with self.lock:
+            roomy = [storage for storage in self.roots if free[storage.root] > size] or self.roots
+            return max(roomy, key=lambda storage: free[storage.root] / (1 + self.active[storage.root]))
+
+    """
+    This function counts the code inside a with block as a transfer using the root a path is in.
+    @param path: A path in the root.
+    """
+    @contextmanager
+    def io(self, path):
+        root = self.root_of(path).root
+        with self.lock:
+            self.active[root] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[root] -= 1
+
+    """
+    This function returns where an existing file of a user is stored, or None if there is no such file.
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    """
+    def find(self, userid, filename):
+        for storage in self.roots:
+            path = storage.file_path(userid, filename)
+            if path is None:
+                return None
+            if os.path.exists(path):
+                return path
+        return None
+
+    """
+    This function returns where a file of a user is stored, or None if the filename is not valid.
+    A file that does not exist yet gets a place on a root: the root of the near path if given, otherwise one picked by place().
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    @param near: A path on the root a new file should go to, so it can be moved into place without copying.
+    @param size: The size of the new file, if known.
+    """
+    def file_path(self, userid, filename, near=None, size=0):
+        if split_filename(filename) is None:
+            return None
+        path = self.find(userid, filename)
+        if path is not None:
+            return path
+        storage = self.root_of(near) if near else self.place(size)
+        return storage.file_path(userid, filename)
+
+    def exists(self, userid, filename):
+        return self.find(userid, filename) is not None
+
+    def user_exists(self, userid):
+        return any(storage.user_exists(userid) for storage in self.roots)
+
+    def user_folders(self, userid):
+        return [storage.user_folder(userid) for storage in self.roots]
+
+    def users(self):
+        return sorted({userid for storage in self.roots for userid in storage.users()})
+
+    def list_files(self, userid):
+        return list(dict.fromkeys(name for storage in self.roots if storage.user_exists(userid) for name in storage.list_files(userid)))
+
+    def list_top(self, userid):
+        return list(dict.fromkeys(name for storage in self.roots if storage.user_exists(userid) for name in storage.list_top(userid)))
+
+    """
+    This function returns a new path in the temporary area of a root.
+    @param near: A path on the root to use, so the file can be moved into place without copying. Otherwise one is picked by place().
+    @param suffix: The end of the name, to tell what it is for.
+    """
+    def temp_path(self, near=None, suffix=".tmp"):
+        storage = self.root_of(near) if near else self.place()
+        return storage.temp_path(suffix)
+
+    @property
+    def temp_folders(self):
+        return [storage.temp_folder for storage in self.roots]
+
+    def forget(self, userid, path):
+        self.root_of(path).forget(userid, path)
+
+    """
+    This function moves a file in one step, replacing what is at the destination.
+    Moving to another root copies the file to the temporary area of that root first, so the replace is still one step.
+    @param source: The file to move.
+    @param destination: Where it goes.
+    """
+    def move(self, source, destination):
+        try:
+            os.replace(source, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            temp_path = self.temp_path(near=destination)
+            try:
+                shutil.copyfile(source, temp_path)
+                os.replace(temp_path, destination)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            os.remove(source)
+
+"""
+This function returns the pool of storages for the roots, making sure every root is in the asked layout.
+Raises StorageLayoutError if the layout is unknown or a root is in another layout.
+@param roots: The root folders.
+@param layout: The name of the layout, "flat" or "sharded".
+"""
+def open_pool(roots, layout):
+    return StoragePool([open_storage(root, layout) for root in roots])
@@ -0,0 +1,69 @@
+# Per-user disk usage, kept up to date as files are written, replaced, renamed and deleted,
+# so checking a quota never has to walk the users folder.
+import json
+import os
+import threading
+
+"""
+Holds how many bytes every user has stored.
+The counters are saved to a JSON file now and then, and can be rebuilt from the disk with recount().
+"""
+class UsageTracker:
+    """
+    @param path: The file the counters are saved to.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.usage = {}
+        self.dirty = False
+
+    """
+    This function loads the saved counters. Returns False if there are none, so the caller can recount.
+    """
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.usage = json.load(f)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    """
+    This function saves the counters if they changed since the last save.
+    """
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            usage = dict(self.usage)
+            self.dirty = False
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(usage, f)
+        os.replace(temp_path, self.path)
+
+    def get(self, userid):
+        with self.lock:
+            return self.usage.get(userid, 0)
+
+    """
+    This function changes the usage of a user.
+    @param userid: The ID of the user.
+    @param delta: How many bytes were added (or, if negative, removed).
+    """
+    def add(self, userid, delta):
+        if not delta:
+            return
+        with self.lock:
+            self.usage[userid] = max(0, self.usage.get(userid, 0) + delta)
+            self.dirty = True
+
+    """
+    This function sets the usage of every user from the disk, replacing the counters.
+    @param sizes: A dictionary of user ID to the bytes they have on disk.
+    """
+    def recount(self, sizes):
+        with self.lock:
+            self.usage = dict(sizes)
+            self.dirty = True
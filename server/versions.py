@@ -0,0 +1,259 @@
+# Old versions of files. When a file is overwritten or deleted, the old file is kept as a version instead of being lost.
+# Keeping a version costs nothing at first: the old file is hard linked (or moved) into a .versions folder on its disk.
+# Later, compaction splits it into fixed-size chunks stored by their hash, and the version becomes a manifest:
+# the list of its chunks. A chunk that several versions share (like the unchanged parts of a big file) is stored once,
+# and reference counted so it is removed when the last version using it goes.
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import sqlite3
+import threading
+import time
+
+# The size of the chunks versions are split into. Versions keep the chunk size they were compacted with.
+DEFAULT_CHUNK_SIZE = (1024 * 1024) * 4  # 4 MB
+
+# How much data is read at a time when streaming a version.
+READ_BUFFER_SIZE = 1024 * 1024  # 1 MB
+
+"""
+Reads a whole version like a file, so it can be saved with the same code as an upload.
+Every read returns the next piece of the version, whatever size is asked for.
+"""
+class VersionReader:
+    """
+    @param store: The VersionStore.
+    @param row: The version, as returned by VersionStore.get().
+    """
+    def __init__(self, store, row):
+        self.data = store.read_range(row, 0, row["size"])
+
+    def read(self, size=-1):
+        return next(self.data, b"")
+
+"""
+Keeps the versions and the chunks in a SQLite database and a chunk folder in the root of the server.
+Safe to use from any number of request threads, with compaction running in one background thread.
+"""
+class VersionStore:
+    """
+    @param root: The folder to keep the database and the chunks in (UPLOAD_FOLDER).
+    @param chunk_size: The size of the chunks versions are split into.
+    """
+    def __init__(self, root, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_folder = os.path.join(root, ".chunks")
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, ".versions.db"), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS versions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                userid TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                created REAL NOT NULL,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT,
+                path TEXT,
+                chunk_size INTEGER,
+                manifest TEXT)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS versions_by_file ON versions (userid, filename)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)")
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_folder, digest[:2], digest)
+
+    """
+    This function keeps a file as the newest old version of a file of a user.
+    Returns the ID of the version.
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    @param path: Where the file is now.
+    @param root: The storage root the file is in, so the version stays on the same disk.
+    @param move: Whether to move the file instead of linking it, for a file that is going away or will be written in place.
+    """
+    def keep(self, userid, filename, path, root, move=False):
+        version_folder = os.path.join(root, ".versions")
+        os.makedirs(version_folder, exist_ok=True)
+        version_path = os.path.join(version_folder, secrets.token_hex(16))
+        if move:
+            os.replace(path, version_path)
+        else:
+            try:
+                os.link(path, version_path)
+            except OSError:
+                # The file system can't link, so the version costs a copy until it is compacted.
+                shutil.copyfile(path, version_path)
+        stat = os.stat(version_path)
+        with self.lock, self.db:
+            cursor = self.db.execute("INSERT INTO versions (userid, filename, created, mtime, size, path) VALUES (?, ?, ?, ?, ?, ?)",
+                                     (userid, filename, time.time(), stat.st_mtime, stat.st_size, version_path))
+            return cursor.lastrowid
+
+    """
+    This function returns the versions of a file of a user, newest first.
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    """
+    def list(self, userid, filename):
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM versions WHERE userid = ? AND filename = ? ORDER BY id DESC", (userid, filename)).fetchall()
+        return [{"version": row["id"], "created": row["created"], "mtime": row["mtime"], "size": row["size"], "compacted": row["manifest"] is not None} for row in rows]
+
+    """
+    This function returns a version of a file of a user, or None if there is no such version.
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    @param version: The ID of the version.
+    """
+    def get(self, userid, filename, version):
+        with self.lock:
+            return self.db.execute("SELECT * FROM versions WHERE id = ? AND userid = ? AND filename = ?", (version, userid, filename)).fetchone()
+
+    """
+    This function streams part of a version, straight from its chunks once it is compacted.
+    @param row: The version, as returned by get().
+    @param offset: Where to start.
+    @param length: How many bytes to send.
+    """
+    def read_range(self, row, offset, length):
+        if row["manifest"] is None:
+            # Not compacted yet, so the whole old file is still there.
+            pieces = [(row["path"], offset)]
+        else:
+            manifest = json.loads(row["manifest"])
+            first = offset // row["chunk_size"]
+            pieces = [(self.chunk_path(digest), offset - first * row["chunk_size"] if index == first else 0) for index, digest in enumerate(manifest) if index >= first]
+        remaining = length
+        for path, start in pieces:
+            if remaining <= 0:
+                break
+            with open(path, "rb") as f:
+                f.seek(start)
+                while remaining > 0:
+                    data = f.read(min(READ_BUFFER_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+
+    """
+    This function returns the hash of a version, working it out if compaction has not yet.
+    @param row: The version, as returned by get().
+    """
+    def file_hash(self, row):
+        if row["hash"]:
+            return row["hash"]
+        file_hash_obj = hashlib.sha256()
+        for data in self.read_range(row, 0, row["size"]):
+            file_hash_obj.update(data)
+        return file_hash_obj.hexdigest()
+
+    """
+    This function removes a version. Its chunks are removed by the next compaction, if no other version uses them.
+    Returns False if there is no such version.
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    @param version: The ID of the version.
+    """
+    def delete(self, userid, filename, version):
+        with self.lock, self.db:
+            row = self.db.execute("SELECT * FROM versions WHERE id = ? AND userid = ? AND filename = ?", (version, userid, filename)).fetchone()
+            if row is None:
+                return False
+            self._delete(row)
+        return True
+
+    def _delete(self, row):
+        self.db.execute("DELETE FROM versions WHERE id = ?", (row["id"],))
+        if row["manifest"] is not None:
+            for digest in json.loads(row["manifest"]):
+                self.db.execute("UPDATE chunks SET refs = refs - 1 WHERE hash = ?", (digest,))
+        elif row["path"] and os.path.exists(row["path"]):
+            os.remove(row["path"])
+
+    """
+    This function removes the oldest versions of a file of a user, so only the newest ones are kept.
+    @param userid: The ID of the user.
+    @param filename: The name of the file.
+    @param keep: How many versions to keep.
+    """
+    def prune(self, userid, filename, keep):
+        with self.lock, self.db:
+            rows = self.db.execute("SELECT * FROM versions WHERE userid = ? AND filename = ? ORDER BY id DESC LIMIT -1 OFFSET ?", (userid, filename, keep)).fetchall()
+            for row in rows:
+                self._delete(row)
+
+    """
+    This function splits one version that is still a whole file into chunks, storing only the chunks that are not stored yet.
+    @param row: The version.
+    """
+    def _compact(self, row):
+        manifest = []
+        file_hash_obj = hashlib.sha256()
+        with open(row["path"], "rb") as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                file_hash_obj.update(data)
+                digest = hashlib.sha256(data).hexdigest()
+                with self.lock, self.db:
+                    stored = self.db.execute("UPDATE chunks SET refs = refs + 1 WHERE hash = ?", (digest,)).rowcount
+                    if not stored:
+                        self.db.execute("INSERT INTO chunks (hash, size, refs) VALUES (?, ?, 1)", (digest, len(data)))
+                if not stored or not os.path.exists(self.chunk_path(digest)):
+                    chunk_path = self.chunk_path(digest)
+                    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                    temp_path = f"{chunk_path}.{secrets.token_hex(4)}.tmp"
+                    with open(temp_path, "wb") as chunk_file:
+                        chunk_file.write(data)
+                    os.replace(temp_path, chunk_path)
+                manifest.append(digest)
+
+        with self.lock, self.db:
+            updated = self.db.execute("UPDATE versions SET manifest = ?, chunk_size = ?, hash = ?, path = NULL WHERE id = ? AND manifest IS NULL",
+                                      (json.dumps(manifest), self.chunk_size, file_hash_obj.hexdigest(), row["id"])).rowcount
+            if not updated:
+                # The version was removed while it was being compacted.
+                for digest in manifest:
+                    self.db.execute("UPDATE chunks SET refs = refs - 1 WHERE hash = ?", (digest,))
+        if os.path.exists(row["path"]):
+            os.remove(row["path"])
+
+    """
+    This function compacts every version that is still a whole file, and removes the chunks no version uses anymore.
+    Returns the number of versions compacted and chunks removed.
+    """
+    def compact(self):
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM versions WHERE manifest IS NULL ORDER BY id").fetchall()
+        for row in rows:
+            try:
+                self._compact(row)
+            except FileNotFoundError:
+                # Removed by a request in the meantime.
+                pass
+
+        with self.lock, self.db:
+            unused = [row["hash"] for row in self.db.execute("SELECT hash FROM chunks WHERE refs <= 0").fetchall()]
+            self.db.executemany("DELETE FROM chunks WHERE hash = ?", [(digest,) for digest in unused])
+        for digest in unused:
+            try:
+                os.remove(self.chunk_path(digest))
+            except FileNotFoundError:
+                pass
+        return len(rows), len(unused)
+
+    """
+    This function returns how many bytes all the versions take on disk: the chunks, and the versions not compacted yet.
+    """
+    def stored_bytes(self):
+        with self.lock:
+            chunks = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM chunks").fetchone()[0]
+            whole = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM versions WHERE manifest IS NULL").fetchone()[0]
+        return chunks + whole
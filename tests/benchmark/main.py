@@ -0,0 +1,268 @@
+#This is a benchmark of the whole upload and download path, to catch performance regressions between commits.
+
+#It starts server/app.py on a free port against a temporary UPLOAD_FOLDER, generates files of the given sizes,
+#and times upload, /process, download and /get_hash for every combination of chunk size and concurrency.
+#The results (throughput and peak RSS of the server and the client) are written as JSON.
+#
+#Run a benchmark:      python main.py --sizes 64K,10M,1G --chunk_sizes 1,5,25 --concurrency 1,8 --output before.json
+#Compare two results:  python main.py --compare before.json after.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(REPO_ROOT, "client"))
+
+import requests
+from connection import Connection
+from upload import upload_file
+from download import download_file, retrieve_file_hash
+
+USERNAME = "bench"
+AUTH_TOKEN = "bench"
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+"""
+This function turns a size like "64K", "5M" or "2G" into bytes.
+@param text: The size to parse.
+"""
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+"""
+This function returns the peak resident memory of a process in bytes, or None where /proc is not available.
+@param pid: The process ID, or "self".
+"""
+def peak_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+"""
+This function resets the peak resident memory of a process, so every case measures its own peak.
+@param pid: The process ID, or "self".
+"""
+def reset_peak_rss(pid):
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+"""
+This function writes a file of random data, so nothing along the way can compress or deduplicate it.
+@param path: Where to write the file.
+@param size: The size of the file in bytes.
+"""
+def generate_file(path, size):
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(remaining, 1024 * 1024))
+            f.write(block)
+            remaining -= len(block)
+
+"""
+This function starts the server on a free port, storing everything in the given folder.
+Returns the server process and its URL once it answers /status.
+@param upload_folder: The folder the server stores the files in.
+"""
+def start_server(upload_folder):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ, USERS=json.dumps({USERNAME: AUTH_TOKEN}), UPLOAD_FOLDER=upload_folder, PORT=str(port))
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, "server", "app.py")], env=env, cwd=upload_folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/status", timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The server did not start.")
+
+"""
+This function uploads a file the old way (/upload for every chunk), and times only the /process call.
+@param connection: The connection to the server.
+@param path: The path of the file.
+@param filename: The name to save the file as on the server.
+@param chunk_size: The size of each chunk in bytes.
+@param concurrency: How many chunks to upload at once.
+"""
+def time_process(connection, path, filename, chunk_size, concurrency):
+    tempid = "B_" + os.urandom(5).hex()
+    size = os.path.getsize(path)
+
+    def send(index):
+        with open(path, "rb") as f:
+            f.seek(index * chunk_size)
+            data = f.read(chunk_size)
+        form = dict(connection.credentials(), tempid=tempid, chunk_hash="IGNORE")
+        connection.post("upload", data=form, files={"file": (f"{filename}.{index}", data)})
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(max(1, -(-size // chunk_size)))))
+
+    start = time.perf_counter()
+    response = connection.post("process", data=dict(connection.credentials(), tempid=tempid, output_file=filename))
+    elapsed = time.perf_counter() - start
+    if "error" in response.json():
+        raise RuntimeError(response.json()["error"])
+    return elapsed
+
+"""
+This function runs one operation and returns its measurements.
+@param server: The server process.
+@param operation: The name of the operation.
+@param size: The number of bytes the operation moves.
+@param function: The function that runs the operation. It may return the time to report instead of the wall time.
+"""
+def measure(server, operation, size, function):
+    reset_peak_rss(server.pid)
+    reset_peak_rss("self")
+    start = time.perf_counter()
+    elapsed = function()
+    if elapsed is None:
+        elapsed = time.perf_counter() - start
+    return {
+        "operation": operation,
+        "seconds": elapsed,
+        "mb_per_s": size / (1024 * 1024) / elapsed if elapsed > 0 else None,
+        "server_peak_rss": peak_rss(server.pid),
+        "client_peak_rss": peak_rss("self"),
+    }
+
+"""
+This function runs every combination of file size, chunk size and concurrency, and returns the results.
+@param sizes: The file sizes in bytes.
+@param chunk_sizes: The chunk sizes in bytes.
+@param concurrencies: The numbers of chunks to transfer at once.
+@param repeat: How many times to run every case. The fastest run is kept.
+"""
+def run_benchmark(sizes, chunk_sizes, concurrencies, repeat):
+    work_folder = tempfile.mkdtemp(prefix="mcs-bench-")
+    upload_folder = os.path.join(work_folder, "uploads")
+    os.makedirs(upload_folder)
+    server, url = start_server(upload_folder)
+    connection = Connection(url, USERNAME, AUTH_TOKEN, pool_size=max(concurrencies) + 4)
+    cases = []
+    try:
+        for size in sizes:
+            path = os.path.join(work_folder, f"file_{size}")
+            generate_file(path, size)
+            for chunk_size in chunk_sizes:
+                for concurrency in concurrencies:
+                    runs = {}
+                    for run in range(repeat):
+                        name = f"bench_{size}_{chunk_size}_{concurrency}_{run}"
+                        output = os.path.join(work_folder, "download")
+                        results = [
+                            measure(server, "upload", size, lambda: upload_file(connection, path, name, chunk_size, concurrency)),
+                            measure(server, "process", size, lambda: time_process(connection, path, name + ".legacy", chunk_size, concurrency)),
+                            measure(server, "download", size, lambda: download_file(connection, name, output, use_hash=False)),
+                            measure(server, "get_hash", size, lambda: retrieve_file_hash(connection, name) and None),
+                        ]
+                        for result in results:
+                            if result["operation"] not in runs or result["seconds"] < runs[result["operation"]]["seconds"]:
+                                runs[result["operation"]] = result
+                        os.remove(output)
+                        shutil.rmtree(os.path.join(upload_folder, USERNAME))
+                    for result in runs.values():
+                        case = dict(size=size, chunk_size=chunk_size, concurrency=concurrency, **result)
+                        cases.append(case)
+                        print(f"{case['operation']:<9} size={size:<12} chunk={chunk_size:<10} concurrency={concurrency:<3} {case['mb_per_s'] or 0:9.1f} MB/s   server rss={(case['server_peak_rss'] or 0) / 1024 ** 2:7.1f} MB")
+            os.remove(path)
+    finally:
+        server.terminate()
+        server.wait()
+        connection.close()
+        shutil.rmtree(work_folder, ignore_errors=True)
+    return cases
+
+"""
+This function returns the commit the benchmark ran on, or None outside of a git checkout.
+"""
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+"""
+This function compares two result files and prints the change of every case they have in common.
+Returns the number of cases that got slower by more than the threshold.
+@param old_path: The results to compare against.
+@param new_path: The new results.
+@param threshold: How much slower (as a fraction) a case may get before it counts as a regression.
+"""
+def compare(old_path, new_path, threshold):
+    with open(old_path, "r") as f:
+        old = json.load(f)
+    with open(new_path, "r") as f:
+        new = json.load(f)
+
+    def key(case):
+        return (case["operation"], case["size"], case["chunk_size"], case["concurrency"])
+    old_cases = {key(case): case for case in old["cases"]}
+
+    print(f"Comparing {old.get('commit') or old_path} -> {new.get('commit') or new_path}")
+    regressions = 0
+    for case in new["cases"]:
+        before = old_cases.get(key(case))
+        if not before or not before["mb_per_s"] or not case["mb_per_s"]:
+            continue
+        change = case["mb_per_s"] / before["mb_per_s"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "   REGRESSION"
+            regressions += 1
+        operation, size, chunk_size, concurrency = key(case)
+        print(f"{operation:<9} size={size:<12} chunk={chunk_size:<10} concurrency={concurrency:<3} {before['mb_per_s']:9.1f} -> {case['mb_per_s']:9.1f} MB/s ({change:+.1%}){flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark upload, /process, download and /get_hash throughput.")
+    parser.add_argument("--sizes", default="64K,1M,32M,256M", help="Comma separated file sizes, e.g. 64K,10M,2G.")
+    parser.add_argument("--chunk_sizes", default="1,5,25", help="Comma separated chunk sizes in MB.")
+    parser.add_argument("--concurrency", default="1,8", help="Comma separated numbers of chunks to transfer at once.")
+    parser.add_argument("--repeat", type=int, default=3, help="How many times to run every case. The fastest run is kept.")
+    parser.add_argument("--output", default="benchmark.json", help="Where to write the results.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files instead of running the benchmark.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="How much slower a case may get before --compare reports it, e.g. 0.1 for 10%%.")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    chunk_sizes = [int(float(size) * 1024 * 1024) for size in args.chunk_sizes.split(",")]
+    concurrencies = [int(n) for n in args.concurrency.split(",")]
+
+    cases = run_benchmark(sizes, chunk_sizes, concurrencies, args.repeat)
+    results = {
+        "commit": current_commit(),
+        "timestamp": time.time(),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "cases": cases,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,87 @@
+#This is a test to make sure handing a transfer to daemon.py doesn't load the libraries the transfer itself needs.
+
+#It starts a fake daemon on a Unix socket, runs upload.py and download.py with --daemon, each in a fresh Python,
+#and checks that the transfer was handed over without loading requests, tqdm or the connection (which reads .env).
+#Then it runs manager.py with --daemon, which needs the connection for its own commands but not the upload and download code.
+
+import json
+import os
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CLIENT_FOLDER = os.path.join(REPO_ROOT, "client")
+
+# Runs a client script as the main script, then prints which of the modules it was asked about were loaded.
+RUNNER = """
+import json, runpy, sys
+script, modules = sys.argv[1], json.loads(sys.argv[2])
+sys.argv = [script] + sys.argv[3:]
+try:
+    runpy.run_path(script, run_name="__main__")
+except SystemExit:
+    pass
+# On a line of its own, as an interactive script may have left a prompt without a newline.
+print("\\n" + json.dumps({"loaded": [name for name in modules if name in sys.modules]}))
+"""
+
+"""
+This function starts a fake daemon that answers every command with a queued job. Returns the server and the commands it got.
+@param socket_path: The socket to listen on.
+"""
+def start_fake_daemon(socket_path):
+    commands = []
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            commands.append(request)
+            job = {"id": len(commands), "kind": request["command"], "filename": request.get("filename") or os.path.basename(request.get("path", "")),
+                   "status": "queued", "transferred": 0, "total": 0, "speed": 0, "error": None}
+            self.wfile.write(json.dumps({"job": job}).encode() + b"\n")
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, commands
+
+"""
+This function runs a client script in a fresh Python. Returns the modules that were loaded, out of the ones asked about.
+@param script: The name of the script in the client folder.
+@param modules: The modules to check for.
+@param arguments: The arguments of the script.
+@param stdin: What to type into the script.
+"""
+def run_script(script, modules, arguments, stdin=""):
+    # No .env or credentials from the environment, so the test runs the same everywhere.
+    env = {key: value for key, value in os.environ.items() if not key.startswith("C_DOWNLOADER_")}
+    result = subprocess.run([sys.executable, "-c", RUNNER, os.path.join(CLIENT_FOLDER, script), json.dumps(modules)] + arguments,
+                            cwd=CLIENT_FOLDER, env=env, input=stdin, capture_output=True, text=True, timeout=60)
+    return json.loads(result.stdout.strip().splitlines()[-1])["loaded"]
+
+if __name__ == "__main__":
+    heavy_modules = ["requests", "tqdm", "dotenv", "connection", "profiling", "autotune"]
+    with tempfile.TemporaryDirectory() as work_folder:
+        socket_path = os.path.join(work_folder, "daemon.sock")
+        server, commands = start_fake_daemon(socket_path)
+        credentials = ["--username", "test", "--auth_token", "test", "--daemon", "--daemon_socket", socket_path]
+
+        loaded = run_script("upload.py", heavy_modules, [__file__] + credentials)
+        assert commands and commands[-1]["command"] == "upload", "upload.py didn't hand the upload to the daemon"
+        assert not loaded, f"upload.py loaded {loaded} before handing the upload to the daemon"
+        print("upload.py --daemon: OK")
+
+        loaded = run_script("download.py", heavy_modules, ["cat.png"] + credentials)
+        assert commands[-1]["command"] == "download", "download.py didn't hand the download to the daemon"
+        assert not loaded, f"download.py loaded {loaded} before handing the download to the daemon"
+        print("download.py --daemon: OK")
+
+        loaded = run_script("manager.py", ["upload", "download", "tqdm", "profiling", "autotune"], credentials, stdin="down cat.png\nexit\n")
+        assert commands[-1]["command"] == "download", "manager.py didn't hand the download to the daemon"
+        assert not loaded, f"manager.py loaded {loaded} while handing transfers to the daemon"
+        print("manager.py --daemon: OK")
+
+        server.shutdown()
+        server.server_close()
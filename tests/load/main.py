@@ -0,0 +1,321 @@
+#This is a load test, to see how one server behaves with many users at the same time.
+
+#It starts server/app.py with a USERS map of generated users (or targets a running server with --server_url and --users),
+#then simulates every user in its own thread, spread over several processes, running a mix of uploads, downloads,
+#lists, renames and deletes. At the end it reports requests/sec, p50/p95/p99 latency and error rate per route,
+#and how many bytes per second the server read and wrote.
+#
+#Example: python main.py --users 200 --processes 4 --duration 60 --mix upload=3,download=3,list=2,rename=1,delete=1
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(REPO_ROOT, "client"))
+
+import requests
+from connection import Connection
+from upload import upload_file, UploadFailedException
+from download import download_file, DownloadFailedException
+
+"""
+A connection that records how long every request takes, per route.
+"""
+class TimedConnection(Connection):
+    def __init__(self, *args, samples, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.samples = samples
+
+    def post(self, route, **kwargs):
+        route_name = route.split("/")[0]
+        start = time.perf_counter()
+        try:
+            response = super().post(route, **kwargs)
+        except requests.RequestException:
+            self.samples.append((route_name, time.perf_counter() - start, False))
+            raise
+        ok = response.status_code < 400
+        if ok and not kwargs.get("stream") and response.headers.get("content-type", "").startswith("application/json"):
+            ok = "error" not in response.json()
+        self.samples.append((route_name, time.perf_counter() - start, ok))
+        return response
+
+"""
+This function parses an operation mix like "upload=3,download=3,list=2" into a dictionary of weights.
+@param text: The mix to parse.
+"""
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+"""
+This function parses a file size like "256K" or "20M" into a number of bytes, for argparse.
+@param text: The size to parse.
+"""
+def parse_size(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    try:
+        if text[-1:].upper() in units:
+            size = int(float(text[:-1]) * units[text[-1].upper()])
+        else:
+            size = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size {text!r}, use a number of bytes or a number with K, M or G")
+    if size < 0:
+        raise argparse.ArgumentTypeError(f"invalid size {text!r}, it can't be negative")
+    return size
+
+"""
+This function tells whether a request that was sent went through.
+@param response: The response of the server.
+"""
+def succeeded(response):
+    try:
+        return response.status_code < 400 and "error" not in response.json()
+    except ValueError:
+        return False
+
+"""
+This function simulates one user until the deadline, running operations picked from the mix.
+Every request is recorded in the samples list of the user's connection.
+@param server_url: The server URL.
+@param username: The username of the user.
+@param auth_token: The authentication token of the user.
+@param mix: The weights of every operation.
+@param file_size: The size of the files to upload, in bytes.
+@param work_folder: A folder the user can write its files to.
+@param deadline: When to stop, as a time.time() value.
+@param think_time: How long to wait between operations, in seconds.
+@param samples: The list to record the requests in.
+"""
+def simulate_user(server_url, username, auth_token, mix, file_size, work_folder, deadline, think_time, samples):
+    connection = TimedConnection(server_url, username, auth_token, pool_size=2, samples=samples)
+    user_folder = os.path.join(work_folder, username)
+    os.makedirs(user_folder, exist_ok=True)
+    source = os.path.join(user_folder, "source")
+    with open(source, "wb") as f:
+        f.write(os.urandom(file_size))
+
+    files = []
+    counter = 0
+    operations = list(mix)
+    weights = [mix[operation] for operation in operations]
+    while time.time() < deadline:
+        operation = random.choices(operations, weights)[0]
+        if operation in ("download", "rename", "delete") and not files:
+            operation = "upload"
+        try:
+            if operation == "upload":
+                counter += 1
+                name = f"load_{counter}.bin"
+                upload_file(connection, source, name, overwrite=True)
+                files.append(name)
+            elif operation == "download":
+                # Without the last download in place, the client can't skip the download as unchanged.
+                output_path = os.path.join(user_folder, "download")
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                download_file(connection, random.choice(files), output_path, use_hash=False)
+            elif operation == "list":
+                connection.post("list", data=connection.credentials())
+            elif operation == "rename":
+                # The list of files only changes once the server has renamed or deleted the file, so it stays in step after errors.
+                index = random.randrange(len(files))
+                counter += 1
+                new_name = f"load_{counter}.bin"
+                response = connection.post("rename", data=dict(connection.credentials(), old_filename=files[index], new_filename=new_name))
+                if succeeded(response):
+                    files[index] = new_name
+            elif operation == "delete":
+                index = random.randrange(len(files))
+                response = connection.post("delete", data=dict(connection.credentials(), filename=files[index]))
+                if succeeded(response):
+                    files.pop(index)
+        except (UploadFailedException, DownloadFailedException, requests.RequestException):
+            pass
+        if think_time:
+            time.sleep(think_time)
+    connection.close()
+
+"""
+This function runs a share of the users in one process, each in its own thread, and sends back their samples.
+@param users: The (username, auth_token) pairs to simulate.
+@param result_queue: The queue to put the samples in.
+"""
+def run_worker(server_url, users, mix, file_size, work_folder, deadline, think_time, result_queue):
+    samples = []
+    threads = [threading.Thread(target=simulate_user, args=(server_url, username, auth_token, mix, file_size, work_folder, deadline, think_time, samples)) for username, auth_token in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result_queue.put(samples)
+
+"""
+This function returns the number of bytes a process has read and written so far, or None where /proc is not available.
+@param pid: The process ID.
+"""
+def process_io(pid):
+    try:
+        counters = {}
+        with open(f"/proc/{pid}/io", "r") as f:
+            for line in f:
+                name, value = line.split(":")
+                counters[name] = int(value)
+        return counters
+    except OSError:
+        return None
+
+"""
+This function starts the server on a free port with the given users, storing everything in the given folder.
+Returns the server process and its URL once it answers /status.
+@param upload_folder: The folder the server stores the files in.
+@param users: The USERS map to give the server.
+"""
+def start_server(upload_folder, users):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ, USERS=json.dumps(users), UPLOAD_FOLDER=upload_folder, PORT=str(port))
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, "server", "app.py")], env=env, cwd=upload_folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/status", timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The server did not start.")
+
+"""
+This function returns the value below which the given fraction of the sorted values fall.
+@param values: The sorted values.
+@param fraction: The fraction, e.g. 0.95.
+"""
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+"""
+This function turns the samples of all users into the report.
+@param samples: The (route, seconds, ok) samples of every request.
+@param elapsed: How long the test ran for, in seconds.
+@param io_before: The /proc io counters of the server before the test, or None.
+@param io_after: The /proc io counters of the server after the test, or None.
+"""
+def build_report(samples, elapsed, io_before, io_after):
+    routes = {}
+    for route, seconds, ok in samples:
+        routes.setdefault(route, {"latencies": [], "errors": 0})
+        routes[route]["latencies"].append(seconds)
+        if not ok:
+            routes[route]["errors"] += 1
+
+    report = {"seconds": elapsed, "requests": len(samples), "requests_per_s": len(samples) / elapsed, "routes": {}}
+    for route, data in sorted(routes.items()):
+        latencies = sorted(data["latencies"])
+        report["routes"][route] = {
+            "requests": len(latencies),
+            "requests_per_s": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "error_rate": data["errors"] / len(latencies),
+        }
+    if io_before and io_after:
+        report["server"] = {
+            "read_bytes_per_s": (io_after["rchar"] - io_before["rchar"]) / elapsed,
+            "written_bytes_per_s": (io_after["wchar"] - io_before["wchar"]) / elapsed,
+            "disk_read_bytes_per_s": (io_after["read_bytes"] - io_before["read_bytes"]) / elapsed,
+            "disk_written_bytes_per_s": (io_after["write_bytes"] - io_before["write_bytes"]) / elapsed,
+        }
+    return report
+
+"""
+This function prints the report as a table.
+@param report: The report from build_report.
+"""
+def print_report(report):
+    print(f"{report['requests']} requests in {report['seconds']:.1f}s ({report['requests_per_s']:.1f} requests/s)")
+    print(f"{'route':<12}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>9}")
+    for route, stats in report["routes"].items():
+        print(f"{route:<12}{stats['requests']:>10}{stats['requests_per_s']:>10.1f}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['error_rate']:>9.1%}")
+    if "server" in report:
+        server = report["server"]
+        print(f"Server read {server['read_bytes_per_s'] / 1024 ** 2:.1f} MB/s and wrote {server['written_bytes_per_s'] / 1024 ** 2:.1f} MB/s "
+              f"({server['disk_read_bytes_per_s'] / 1024 ** 2:.1f} MB/s and {server['disk_written_bytes_per_s'] / 1024 ** 2:.1f} MB/s on disk).")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate many users against one server and report latency percentiles.")
+    parser.add_argument("--users", default="50", help="How many users to generate, or a JSON USERS map of existing users when using --server_url.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="How many processes to spread the users over.")
+    parser.add_argument("--duration", type=float, default=30, help="How long to run for, in seconds.")
+    parser.add_argument("--mix", default="upload=3,download=3,list=2,rename=1,delete=1", help="The weight of every operation.")
+    parser.add_argument("--file_size", type=parse_size, default="256K", help="The size of the files to upload, e.g. 256K or 20M.")
+    parser.add_argument("--think_time", type=float, default=0, help="How long every user waits between operations, in seconds.")
+    parser.add_argument("--server_url", help="Use a server that is already running instead of starting one.")
+    parser.add_argument("--server_pid", type=int, help="The process ID of the --server_url server, to report its bytes/sec.")
+    parser.add_argument("--output", help="Also write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    file_size = args.file_size
+    mix = parse_mix(args.mix)
+
+    work_folder = tempfile.mkdtemp(prefix="mcs-load-")
+    server = None
+    if args.server_url:
+        users = json.loads(args.users)
+        server_url = args.server_url
+        server_pid = args.server_pid
+    else:
+        users = {f"loaduser{i}": os.urandom(8).hex() for i in range(int(args.users))}
+        upload_folder = os.path.join(work_folder, "uploads")
+        os.makedirs(upload_folder)
+        server, server_url = start_server(upload_folder, users)
+        server_pid = server.pid
+
+    user_list = list(users.items())
+    processes = max(1, min(args.processes, len(user_list)))
+    shares = [user_list[i::processes] for i in range(processes)]
+
+    print(f"Simulating {len(user_list)} users over {processes} processes for {args.duration}s against {server_url}")
+    result_queue = multiprocessing.Queue()
+    io_before = process_io(server_pid) if server_pid else None
+    start = time.time()
+    deadline = start + args.duration
+    workers = [multiprocessing.Process(target=run_worker, args=(server_url, share, mix, file_size, work_folder, deadline, args.think_time, result_queue)) for share in shares]
+    for worker in workers:
+        worker.start()
+    samples = []
+    for _ in workers:
+        samples.extend(result_queue.get())
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    io_after = process_io(server_pid) if server_pid else None
+
+    if server:
+        server.terminate()
+        server.wait()
+    shutil.rmtree(work_folder, ignore_errors=True)
+
+    report = build_report(samples, elapsed, io_before, io_after)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
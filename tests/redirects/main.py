@@ -0,0 +1,111 @@
+#This is a test to make sure a client with an out of date view of the cluster still gets its files.
+
+#It starts two fake nodes. The first answers every request with 421 and the name of the second, like a node does
+#for a file it no longer has, and the second answers for real. Then it downloads through the first one, as one
+#stream and as ranges, and uploads a chunk from a file, which has to be sent again from the start.
+
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(REPO_ROOT, "client"))
+
+import requests
+from connection import Connection
+from download import download_stream, download_range
+
+CONTENT = os.urandom(3 * 1024 * 1024 + 123)
+
+"""
+This function starts a fake node in a background thread. Returns the server.
+@param handle: A function called with the handler, the route and the body of every POST request.
+"""
+def start_node(handle):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # Not a cluster, as far as /cluster is concerned.
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            handle(self, self.path.strip("/"), body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+"""
+This function sends a response from a fake node.
+@param handler: The request handler.
+@param status: The status code.
+@param body: The body, as bytes.
+@param headers: Any more headers to send.
+"""
+def reply(handler, status, body, headers=None):
+    handler.send_response(status)
+    handler.send_header("Content-Length", str(len(body)))
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(body)
+
+if __name__ == "__main__":
+    received = []
+
+    def real_node(handler, route, body):
+        if route == "download":
+            form = dict(pair.split("=", 1) for pair in body.decode().split("&"))
+            offset = int(form.get("offset", 0))
+            length = int(form.get("length", len(CONTENT)))
+            reply(handler, 200, CONTENT[offset:offset + length], {"X-File-Size": str(len(CONTENT))})
+        else:
+            received.append(body)
+            reply(handler, 200, b'{"ok": true}', {"Content-Type": "application/json"})
+
+    real = start_node(real_node)
+    real_url = "http://127.0.0.1:{}".format(real.server_address[1])
+    stale = start_node(lambda handler, route, body: reply(handler, 421, json.dumps({"node": real_url}).encode(), {"Content-Type": "application/json"}))
+    connection = Connection("http://127.0.0.1:{}".format(stale.server_address[1]), "test", "test")
+
+    output = io.BytesIO()
+    file_hash = download_stream(connection, "cat.png", output)
+    assert output.getvalue() == CONTENT, "The streamed download doesn't match"
+    assert file_hash == hashlib.sha256(CONTENT).hexdigest(), "The hash of the streamed download doesn't match"
+    print("Streamed download through a stale node: OK")
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.truncate(len(CONTENT))
+        f.flush()
+        download_range(connection, "cat.png", f.name, 1024 * 1024, 1024 * 1024, 1)
+        f.seek(1024 * 1024)
+        assert f.read(1024 * 1024) == CONTENT[1024 * 1024:2 * 1024 * 1024], "The range doesn't match"
+    print("Range download through a stale node: OK")
+
+    # A body read from a file is sent again from where it started, not from where the first try left it.
+    body = io.BytesIO(b"skipped" + CONTENT[:4096])
+    body.seek(len(b"skipped"))
+    response = connection.post("upload_chunk", filename="cat.png", data=body)
+    assert response.status_code == 200 and received[-1] == CONTENT[:4096], "The chunk wasn't sent again in full"
+    print("File body sent again to the right node: OK")
+
+    # A body that can only be read once can't be sent again, which has to be said rather than sending nothing.
+    try:
+        connection.post("upload_chunk", filename="cat.png", data=iter([CONTENT[:4096]]))
+    except requests.RequestException as e:
+        print(f"Body that can't be sent again: OK ({e})")
+    else:
+        raise AssertionError("A body that can't be sent again was sent anyway")
+
+    stale.shutdown()
+    real.shutdown()